@@ -0,0 +1,260 @@
+"""
+Benchmarks of the serving pipeline over a matrix of model size, prompt length, batch size and
+number of ablation / patch slices
+
+Models are randomly initialised from a `HookedTransformerConfig` with a character level tokenizer
+built on the fly, so the suite runs offline. Each case runs in its own subprocess so peak RSS is
+per case and cases don't warm each other up.
+
+    python benchmarks/serving.py --out results.json
+    python benchmarks/serving.py --sizes tiny --prompt-lengths 16 --batch-sizes 1 --slices 0 4
+
+Results are JSON: the environment, then per case the latency percentiles (ms) of every stage and
+endpoint, the response size of every endpoint and the case's peak RSS, so runs can be diffed
+between versions.
+"""
+import argparse
+import json
+import platform
+import resource
+import string
+import subprocess
+import sys
+import tempfile
+import time
+from importlib.metadata import version
+from itertools import product
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+REPO = Path(__file__).resolve().parent.parent
+
+MODEL_SIZES: dict[str, dict[str, Any]] = {
+    'tiny': dict(n_layers=2, d_model=64, n_heads=4, d_head=16, d_mlp=256, d_vocab=512),
+    'small': dict(n_layers=6, d_model=256, n_heads=8, d_head=32, d_mlp=1024, d_vocab=8192),
+    'medium': dict(n_layers=12, d_model=512, n_heads=8, d_head=64, d_mlp=2048, d_vocab=50257),
+}
+PROMPT_LENGTHS = [16, 128]
+BATCH_SIZES = [1, 8]
+INTERVENTION_SLICES = [0, 16] # Number of ablation slices, and as many patch slices
+
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    """Latency summary in milliseconds"""
+    ordered = sorted(samples)
+    at = lambda q: ordered[min(len(ordered) - 1, round(q * (len(ordered) - 1)))] * 1000
+    return {
+        "p50": at(0.5),
+        "p90": at(0.9),
+        "p99": at(0.99),
+        "mean": sum(ordered) / len(ordered) * 1000,
+        "min": ordered[0] * 1000,
+        "max": ordered[-1] * 1000,
+        "n": len(ordered),
+    }
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def environment():
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True, text=True).stdout.strip()
+    return {
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "torch": version('torch'),
+        "transformer_lens": version('transformer_lens'),
+    }
+
+
+def char_tokenizer(d_vocab: int, directory: Path):
+    """
+    Character level tokenizer padded with placeholder tokens up to `d_vocab`. It's saved so
+    TransformerLens can reload it (it does to add a BOS token).
+    """
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+
+    vocab = {"<|endoftext|>": 0}
+    for char in string.printable:
+        vocab.setdefault(char, len(vocab))
+    for i in range(len(vocab), d_vocab):
+        vocab[f"<|{i}|>"] = i
+
+    tokenizer = Tokenizer(models.WordLevel(vocab=vocab, unk_token="<|endoftext|>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    special = "<|endoftext|>"
+    PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token=special, eos_token=special, pad_token=special, unk_token=special
+    ).save_pretrained(directory)
+    return PreTrainedTokenizerFast.from_pretrained(directory)
+
+
+def random_model(size: str, directory: Path):
+    import torch as t
+    from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+    dims = MODEL_SIZES[size]
+    tokenizer = char_tokenizer(dims["d_vocab"], directory)
+    cfg = HookedTransformerConfig(
+        **dims, n_ctx=1024, act_fn='gelu', normalization_type='LN', default_prepend_bos=True, seed=0
+    )
+    t.manual_seed(0)
+    return HookedTransformer(cfg, tokenizer=tokenizer)
+
+
+def prompts(length: int, batch_size: int) -> list[str]:
+    import random
+
+    rng = random.Random(0)
+    letters = string.ascii_lowercase + ' '
+    return [''.join(rng.choice(letters) for _ in range(length)) for _ in range(batch_size)]
+
+
+def interventions(n_slices: int, n_layers: int, length: int):
+    """`n_slices` zero ablations and `n_slices` patches, spread over the blocks and positions"""
+    ablations: dict[str, dict[str, Any]] = {}
+    patches: dict[str, dict[str, Any]] = {}
+    for i in range(n_slices):
+        layer, pos = i % n_layers, i % length
+        ablation_slice = [[0, -1], [pos, pos + 1], [0, -1]]
+        ablations.setdefault(f'blocks.{layer}.hook_mlp_out', {})[str(ablation_slice)] = {
+            "slice": ablation_slice, "ablationType": 'zero',
+        }
+        source_slice = [[0, -1], [pos, pos + 1], [0, -1]]
+        target_slice = [[0, -1], [(pos + 1) % length, (pos + 1) % length + 1], [0, -1]]
+        patches.setdefault(f'blocks.{layer}.hook_resid_pre', {})[str(source_slice)] = {
+            "slice": source_slice,
+            "edges": {f'blocks.{layer}.hook_resid_mid': {str(target_slice): {"slice": target_slice}}},
+        }
+    return ablations, patches
+
+
+def time_calls(fn: Callable[[], Any], repeats: int, warmup: int, before: Optional[Callable[[], None]] = None):
+    """Latencies of `repeats` calls after `warmup` untimed ones, `before` runs untimed ahead of each"""
+    import torch as t
+
+    samples = []
+    for i in range(warmup + repeats):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        fn()
+        if t.cuda.is_available():
+            t.cuda.synchronize()
+        if i >= warmup:
+            samples.append(time.perf_counter() - start)
+    return samples
+
+
+def run_case(case: dict[str, Any], repeats: int, warmup: int):
+    """Runs one case of the matrix in this process"""
+    import torch as t
+
+    directory = Path(tempfile.mkdtemp(prefix='transpector-bench-'))
+    model = random_model(case["size"], directory)
+
+    # transpector.main loads its model on import, so the loader is swapped for the random model first
+    sys.path.insert(0, str(REPO))
+    import transpector.model
+    transpector.model.load_model = lambda model_name, precision='float32', on_phase=None: model
+    from fastapi.testclient import TestClient
+    from transpector.main import app, per_token_losses, ts
+
+    prompt = prompts(case["promptLength"], case["batchSize"])
+    ablations, patches = interventions(case["slices"], model.cfg.n_layers, case["promptLength"])
+    latencies: dict[str, dict[str, float]] = {}
+    response_bytes: dict[str, int] = {}
+
+    with TestClient(app) as client:
+        client.put('/api/tokenize/toTokens', json={"input": prompt})
+        client.put('/api/ablation/sync', json={"ablations": ablations, "clientLogicalClock": 1})
+        client.put('/api/patch/sync', json={"patches": patches, "clientLogicalClock": 2})
+
+        def clear_results():
+            ts.result_cache.clear()
+            ts.activations.clear()
+
+        endpoints = {
+            "tokenize": lambda: client.put('/api/tokenize/toTokens', json={"input": prompt}),
+            "inferenceRun": lambda: client.get('/api/inference/run'),
+            "inferenceRunBinary": lambda: client.get('/api/inference/run', params={"format": 'binary'}),
+            "inferenceRunLazy": lambda: client.get('/api/inference/run', params={"lazy": True}),
+        }
+        for name, call in endpoints.items():
+            response = call()
+            response.raise_for_status()
+            response_bytes[name] = len(response.content)
+            uncached = name != 'tokenize'
+            latencies[name] = percentiles(time_calls(call, repeats, warmup, clear_results if uncached else None))
+        # A repeat of the same run is answered from the result cache
+        latencies["inferenceRunCached"] = percentiles(time_calls(endpoints["inferenceRun"], repeats, warmup))
+
+        tokens = ts.model.to_tokens(prompt)
+        outputs: dict[str, Any] = {}
+
+        def forward():
+            ts.activations.begin()
+            outputs["logits"], _loss, outputs["cache"] = ts.run_with_hooks(tokens)
+
+        latencies["runWithHooks"] = percentiles(time_calls(forward, repeats, warmup))
+        latencies["cleanCache"] = percentiles(time_calls(
+            lambda: ts.clean_cache(ts.filter_cache(outputs["cache"])), repeats, warmup
+        ))
+        latencies["cleanLogits"] = percentiles(time_calls(lambda: ts.clean_logits(outputs["logits"]), repeats, warmup))
+        latencies["perTokenLosses"] = percentiles(time_calls(
+            lambda: per_token_losses(outputs["logits"], tokens), repeats, warmup
+        ))
+
+    return {
+        **case,
+        "latencyMs": latencies,
+        "responseBytes": response_bytes,
+        "peakRssBytes": peak_rss_bytes(),
+        "peakCudaBytes": t.cuda.max_memory_allocated() if t.cuda.is_available() else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', default=['tiny', 'small'], choices=list(MODEL_SIZES))
+    parser.add_argument('--prompt-lengths', nargs='+', type=int, default=PROMPT_LENGTHS)
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=BATCH_SIZES)
+    parser.add_argument('--slices', nargs='+', type=int, default=INTERVENTION_SLICES)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--out', type=Path, help='Write the results here rather than to stdout')
+    parser.add_argument('--case', help=argparse.SUPPRESS) # Set on the subprocess running a single case
+    args = parser.parse_args()
+
+    if args.case is not None:
+        print(json.dumps(run_case(json.loads(args.case), args.repeats, args.warmup)))
+        return
+
+    results = []
+    for size, length, batch_size, slices in product(args.sizes, args.prompt_lengths, args.batch_sizes, args.slices):
+        case = {"size": size, "promptLength": length, "batchSize": batch_size, "slices": slices}
+        print(f'Running {case}', file=sys.stderr)
+        process = subprocess.run(
+            [sys.executable, __file__, '--case', json.dumps(case), '--repeats', str(args.repeats), '--warmup', str(args.warmup)],
+            capture_output=True,
+            text=True,
+        )
+        if process.returncode != 0:
+            results.append({**case, "error": (process.stderr.strip().splitlines() or [''])[-1]})
+            continue
+        results.append(json.loads(process.stdout.strip().splitlines()[-1]))
+
+    output = json.dumps({"environment": environment(), "cases": results}, indent=2)
+    if args.out is not None:
+        args.out.write_text(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
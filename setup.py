@@ -19,7 +19,8 @@ setup(
         "jupyterlab",
         "nbclient",
         "websockets",
-        "jaxtyping"
+        "jaxtyping",
+        "safetensors"
     ],
     entry_points={"console_scripts": ["transpector=transpector.__main__:cli"]},
     packages=find_packages(exclude=["*.tests", "*.tests.*", "tests.*", "tests"]),
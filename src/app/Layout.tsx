@@ -1,4 +1,4 @@
-import React, { useState } from 'react';
+import React, { useEffect, useState } from 'react';
 import { ModelFlow } from '../components/Graph';
 import { ModelSelectPopup, OpenButton } from '../components/ModelSelect';
 import dynamic from 'next/dynamic';
@@ -19,6 +19,15 @@ import "allotment/dist/style.css";
 export const Layout = () => {
   const [showModelSelect, setShowModelSelect] = useState(false);
   const [selectedModel, setSelectedModel] = useState('gpt2');
+  // The notebook needs the Jupyter server `transpector --jupyter` starts, it's hidden without one
+  const [jupyter, setJupyter] = useState(false);
+
+  useEffect(() => {
+    fetch("/api/status")
+      .then(response => response.json())
+      .then(status => setJupyter(status.jupyter))
+      .catch(() => setJupyter(false));
+  }, []);
 
   return (
     <div className='w-[100vw] h-[100vh]'>
@@ -36,8 +45,8 @@ export const Layout = () => {
           </div>
         </AllotmentPaneWrapper>
 
-        <AllotmentPaneWrapper snap={true}>
-          <NotebookWrapper />
+        <AllotmentPaneWrapper snap={true} visible={jupyter}>
+          {jupyter && <NotebookWrapper />}
         </AllotmentPaneWrapper>
       </AllotmentWrapper>
     </div>
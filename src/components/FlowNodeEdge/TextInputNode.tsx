@@ -11,7 +11,7 @@ const selector = (state) => ({
   modelInputText: state.modelInputText,
   updateModelInputText: state.updateModelInputText,
   inferencing: state.inferencing,
-  inferenceModel: state.inferenceModel,
+  inferenceModelStream: state.inferenceModelStream,
 });
 
 
@@ -112,7 +112,7 @@ export const TextInputPopup = ({ layerCount=5, headCount=5 }) => {
               <button
                 type="button"
                 className="absolute inset-y-0 right-0 pr-3 flex items-center text-green-500"
-                onClick={() => state.inferenceModel()}
+                onClick={() => state.inferenceModelStream()}
                 disabled={state.inferencing}
               >
                 {state.inferencing ?
@@ -1,9 +1,9 @@
 import { Allotment } from "allotment";
 import React from "react";
 
-export default function AllotmentPaneWrapper({ children, snap, minSize }: {children: React.ReactNode, snap?: boolean, minSize?: number}) {
+export default function AllotmentPaneWrapper({ children, snap, minSize, visible }: {children: React.ReactNode, snap?: boolean, minSize?: number, visible?: boolean}) {
   return (
-    <Allotment.Pane minSize={minSize} snap={snap}>
+    <Allotment.Pane minSize={minSize} snap={snap} visible={visible}>
       {children}
     </Allotment.Pane>
   )
@@ -21,6 +21,42 @@ import { customConnectionStyle } from './FlowNodeEdge/customConnectionLine';
 const removeKey = (key, {[key]: _, ...rest}) => rest;
 const putMsg = {method: "PUT", headers: {"Content-Type": "application/json"}}
 
+// Converts an IEEE 754 half precision bit pattern to a float
+const halfToFloat = (bits: number) => {
+  const sign = bits & 0x8000 ? -1 : 1;
+  const exponent = (bits >> 10) & 0x1f;
+  const fraction = bits & 0x3ff;
+  if (exponent === 0) return sign * 2 ** -14 * (fraction / 1024);
+  if (exponent === 0x1f) return fraction ? NaN : sign * Infinity;
+  return sign * 2 ** (exponent - 15) * (1 + fraction / 1024);
+}
+
+// Decodes a `format=binary` response: [uint32 header length][header JSON][aligned buffers]
+const decodeBinaryResponse = (buffer: ArrayBuffer) => {
+  const headerLength = new DataView(buffer).getUint32(0, true);
+  const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength)));
+  const tensors: { [name: string]: tf.Tensor } = Object.fromEntries(
+    header.tensors.map(({ name, dtype, shape, offset, length }) => {
+      const values = dtype === 'float16'
+        ? Float32Array.from(new Uint16Array(buffer, offset, length / 2), halfToFloat)
+        : new Float32Array(buffer, offset, length / 4);
+      return [name, tf.tensor(values, shape)];
+    })
+  );
+  return { ...header.meta, tensors };
+}
+
+// Query string asking a run for the activations of the components on screen only, so hidden
+// ones are neither captured nor sent. The token display colours by any layer's attention pattern.
+const visibleComponentsQuery = (nodes: Node[]) => {
+  const components = nodes
+    .filter(({ hidden, data }) => !hidden && data?.realationId)
+    .map(({ data }) => data.realationId);
+  return new URLSearchParams(
+    [...new Set([...components, 'blocks.*.attn.hook_pattern'])].map(component => ['components', component])
+  ).toString();
+}
+
 // interface VisualComponent {
 //     modelComponent: string;
 //     slice: string;
@@ -46,6 +82,13 @@ interface modelComponentSliceAblations {
   };
 }
 
+interface interventionDeltaOp {
+  op: 'add' | 'remove' | 'update';
+  component: string;
+  sliceId: string;
+  value?: any;
+}
+
 type RFState = {
   logicalClock: number;
   nodes: Node[];
@@ -60,23 +103,28 @@ type RFState = {
   modelInputTokens: number[][];
   modelInputSubWords: string[][];
 
+  inferenceRunId: string | null;
   inferencePrompt: string;
   inferenceSubWords: string[];
   inferencing: boolean;
-  modelOutputlogits: number[][][];
+  modelOutputlogits: tf.Tensor | null;
   modelOutputTokens: number[][];
   modelOutputSubWords: string[][];
+  modelOutputPredictions: { tokens: number[][][], probs: number[][][], subWords: string[][][] } | null;
   modelOutputLoss: number[][];
   modelOuputFinalLoss: number;
   modelActivations: { [modelComponent: string]: tf.Tensor };
+  fetchActivations: (runId: string, components: string[]) => Promise<void[]>;
   
   // modelVisualComponents: VisualComponent[];
 
   modelAblations: modelComponentSliceAblations;
   syncAblations: (logicalClock: number, ablations: modelComponentSliceAblations) => void;
+  syncAblationDelta: (ops: interventionDeltaOp[], ablations: modelComponentSliceAblations) => void;
 
   modelPatches: modelComponentSlicePatches;
   syncPatches: (logicalClock: number, patches: modelComponentSlicePatches) => void;
+  syncPatchDelta: (ops: interventionDeltaOp[], patches: modelComponentSlicePatches) => void;
   addPatch: (sourceRealationId: string, sourceSlice: any, targetRelationId: string, targetSlice: any) => void;
   rmPatch: (sourceRealationId: string, sourceSlice: any, targetRelationId: string, targetSlice: any) => void;
 
@@ -170,39 +218,101 @@ const useStore = create<RFState>((set, get) => ({
   },
 
   modelActivations: {},
+  inferenceRunId: null,
   inferencePrompt: '',
   inferenceSubWords: [],
   inferencing: false,
-  modelOutputlogits: [],
+  modelOutputlogits: null,
   modelOutputTokens: [],
   modelOutputSubWords: [],
+  modelOutputPredictions: null,
   modelOutputLoss: [],
   modelOuputFinalLoss: 0.,
+  // Fetches the run's metadata first (lazy=true), then each visible component's activations on
+  // their own, so the graph fills in per component rather than waiting on one response of them all
   inferenceModel() {
     set({ inferencing: true });
 
-    fetch("/api/inference/run")
-    .then(r => r.json())
+    fetch(`/api/inference/run?lazy=true&${visibleComponentsQuery(get().nodes)}`)
+    .then(r => {
+      // A newer run from this client superseded this one, its response will update the store
+      if (r.status === 409) return null;
+      return r.json();
+    })
     .then((r) => {
-      console.log(r);
+      if (r === null) return;
       set({ 
+        inferenceRunId: r.runId,
         inferencePrompt: r.inferencePrompt,
         inferenceSubWords: r.inferenceSubWords,
-        modelOutputlogits: r.logits,
+        modelOutputlogits: null,
         modelOutputTokens: r.tokens,
         modelOutputSubWords: r.subWords,
+        modelOutputPredictions: r.predictions,
         modelOutputLoss: r.tokenLoss,
         modelOuputFinalLoss: r.finalLoss,
-        modelActivations: Object.fromEntries(
-          Object.entries(r.activationData).map(([key, val]) => [key, tf.tensor(val as tf.TensorLike)]),
-        ),
+        modelActivations: {},
       })
-      set({ inferencing: false });
+      get().fetchActivations(r.runId, Object.keys(r.activationMeta))
+      .finally(() => set({ inferencing: false }));
     });    
   },
+  // Adds the activations of `components` from a stored run, dropped if a newer run replaced it meanwhile
+  fetchActivations(runId: string, components: string[]) {
+    return Promise.all(components.map(hookName =>
+      fetch("/api/inference/activation", {
+        ...putMsg,
+        body: JSON.stringify({ runId, hookName, format: 'binary' }),
+      })
+      .then(r => r.ok ? r.arrayBuffer().then(decodeBinaryResponse) : null)
+      .then((response) => {
+        if (response === null || get().inferenceRunId !== runId) return;
+        set(state => ({ modelActivations: { ...state.modelActivations, ...response.tensors } }));
+      })
+    ));
+  },
+  // Same as inferenceModel but each block's activations are rendered as soon as the server computes them
+  inferenceModelStream() {
+    set({ inferencing: true });
+
+    const toTensors = (activationData: { [modelComponent: string]: any }) => Object.fromEntries(
+      Object.entries(activationData).map(([name, values]) => [name, tf.tensor(values)])
+    );
+    const events = new EventSource(`/api/inference/stream?${visibleComponentsQuery(get().nodes)}`);
+    events.addEventListener("start", (e: MessageEvent) => {
+      const r = JSON.parse(e.data);
+      set({ inferencePrompt: r.inferencePrompt, inferenceSubWords: r.inferenceSubWords, modelActivations: {} });
+    });
+    events.addEventListener("block", (e: MessageEvent) => {
+      const r = JSON.parse(e.data);
+      set(state => ({ modelActivations: { ...state.modelActivations, ...toTensors(r.activationData) } }));
+    });
+    events.addEventListener("done", (e: MessageEvent) => {
+      events.close();
+      const r = JSON.parse(e.data);
+      set(state => ({
+        inferenceRunId: r.runId,
+        modelOutputlogits: null,
+        modelOutputTokens: r.tokens,
+        modelOutputSubWords: r.subWords,
+        modelOutputPredictions: r.predictions,
+        modelOutputLoss: r.tokenLoss,
+        modelOuputFinalLoss: r.finalLoss,
+        modelActivations: { ...state.modelActivations, ...toTensors(r.activationData) },
+        inferencing: false,
+      }));
+    });
+    events.addEventListener("error", (e: MessageEvent) => {
+      events.close();
+      // A 409 means a newer run from this client took over, its events will update the store
+      if (e.data && JSON.parse(e.data).status === 409) return;
+      set({ inferencing: false });
+    });
+  },
 
 
   modelPatches: {},
+  // A logicalClock behind the server's (e.g. -1) fetches the server's state without changing it
   syncPatches(logicalClock=get().logicalClock, patches={}) {
     fetch("/api/patch/sync", {
       ...putMsg,
@@ -218,8 +328,27 @@ const useStore = create<RFState>((set, get) => ({
       }))    
     });
   },
+  // Sends only the changed source slices, the server answers with its full state when the client is behind
+  syncPatchDelta(ops, patches) {
+    const { logicalClock } = get();
+    set({ modelPatches: patches });
+    fetch("/api/patch/delta", {
+      ...putMsg,
+      body: JSON.stringify({ ops: ops, clientLogicalClock: logicalClock }),
+    })
+    .then(r => r.ok ? r.json() : null)
+    .then((r) => {
+      // A rejected delta (e.g. removing a slice a restarted server no longer has) means the client
+      // is out of step, so it takes the server's full state
+      if (r === null) return get().syncPatches(-1);
+      set(state => ({
+        ...(r.applied ? {} : { modelPatches: { ...r.patches } }),
+        logicalClock: Math.max(state.logicalClock, r.server_logical_clock)+1
+      }))
+    });
+  },
   addPatch(sourceRealationId, sourceSlice, targetRelationId, targetSlice) {
-    const { modelPatches, logicalClock } = get();
+    const { modelPatches } = get();
     const sourceAdded = assocPath([sourceRealationId, sourceSlice, 'slice'], sourceSlice, modelPatches);
     const targetAdded = assocPath(
       [sourceRealationId, sourceSlice, 'edges', targetRelationId, targetSlice],
@@ -227,13 +356,39 @@ const useStore = create<RFState>((set, get) => ({
       sourceAdded
     );
 
-    get().syncPatches(logicalClock, targetAdded);
+    get().syncPatchDelta([{
+      op: modelPatches?.[sourceRealationId]?.[sourceSlice] ? 'update' : 'add',
+      component: sourceRealationId,
+      sliceId: `${sourceSlice}`,
+      value: targetAdded[sourceRealationId][sourceSlice],
+    }], targetAdded);
   },
   rmPatch(sourceRealationId, sourceSlice, targetRelationId, targetSlice) {
-    const { modelPatches, logicalClock } = get();
-    const updatedPatches = dissocPath([sourceRealationId, sourceSlice, 'edges', targetRelationId, targetSlice], modelPatches);
-    
-    get().syncPatches(logicalClock, updatedPatches);
+    const { modelPatches } = get();
+    if (!modelPatches?.[sourceRealationId]?.[sourceSlice]) return;
+    const edges = dissocPath([targetRelationId, targetSlice], modelPatches[sourceRealationId][sourceSlice].edges);
+    const remainingEdges = Object.fromEntries(Object.entries(edges).filter(([_, slices]) => Object.keys(slices).length));
+
+    // A source slice left without edges is removed rather than kept patching nothing
+    if (!Object.keys(remainingEdges).length) {
+      const sourceSlices = removeKey(`${sourceSlice}`, modelPatches[sourceRealationId]);
+      get().syncPatchDelta([{
+        op: 'remove',
+        component: sourceRealationId,
+        sliceId: `${sourceSlice}`,
+      }], Object.keys(sourceSlices).length
+        ? { ...modelPatches, [sourceRealationId]: sourceSlices }
+        : removeKey(sourceRealationId, modelPatches));
+      return;
+    }
+
+    const updatedPatches = assocPath([sourceRealationId, sourceSlice, 'edges'], remainingEdges, modelPatches);
+    get().syncPatchDelta([{
+      op: 'update',
+      component: sourceRealationId,
+      sliceId: `${sourceSlice}`,
+      value: updatedPatches[sourceRealationId][sourceSlice],
+    }], updatedPatches);
   },
 
   patching: false,
@@ -270,6 +425,7 @@ const useStore = create<RFState>((set, get) => ({
 
 
   modelAblations: {},
+  // A logicalClock behind the server's (e.g. -1) fetches the server's state without changing it
   syncAblations(logicalClock=get().logicalClock, ablations={}) {
     fetch("/api/ablation/sync", {
       ...putMsg,
@@ -285,8 +441,26 @@ const useStore = create<RFState>((set, get) => ({
       }))    
     });
   },
+  // Sends only the changed slices, the server answers with its full state when the client is behind
+  syncAblationDelta(ops, ablations) {
+    const { logicalClock } = get();
+    set({ modelAblations: ablations });
+    fetch("/api/ablation/delta", {
+      ...putMsg,
+      body: JSON.stringify({ ops: ops, clientLogicalClock: logicalClock }),
+    })
+    .then(r => r.ok ? r.json() : null)
+    .then((r) => {
+      // A rejected delta means the client is out of step, so it takes the server's full state
+      if (r === null) return get().syncAblations(-1);
+      set(state => ({
+        ...(r.applied ? {} : { modelAblations: { ...r.ablations } }),
+        logicalClock: Math.max(state.logicalClock, r.server_logical_clock)+1
+      }))
+    });
+  },
   addAblations(realationId, slices, ablationType) {
-    const { modelAblations, logicalClock } = get()
+    const { modelAblations } = get()
     const updatedAblations = {
       ...modelAblations,
       [realationId]: {
@@ -295,10 +469,15 @@ const useStore = create<RFState>((set, get) => ({
       }
     }  
 
-    get().syncAblations(logicalClock, updatedAblations);
+    get().syncAblationDelta(slices.map(slice => ({
+      op: modelAblations?.[realationId]?.[slice] ? 'update' : 'add',
+      component: realationId,
+      sliceId: `${slice}`,
+      value: { slice: slice, ablationType: ablationType },
+    })), updatedAblations);
   },
   rmAblations(realationId, slices) {
-    const { modelAblations, logicalClock } = get()
+    const { modelAblations } = get()
     const updatedAblations = slices.reduce((currentAblations, slice) => {
       return {
         ...currentAblations,
@@ -307,8 +486,12 @@ const useStore = create<RFState>((set, get) => ({
         },
       };
     }, { ...modelAblations });
-    
-    get().syncAblations(logicalClock, updatedAblations);
+
+    get().syncAblationDelta(slices.filter(slice => modelAblations?.[realationId]?.[slice]).map(slice => ({
+      op: 'remove',
+      component: realationId,
+      sliceId: `${slice}`,
+    })), updatedAblations);
   },
   
 
@@ -0,0 +1,64 @@
+"""Every model load is swapped for a small random model, so the tests run offline"""
+import string
+import tempfile
+from functools import cache
+import pytest
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+import transpector.catalog
+import transpector.model
+import torch as t
+
+
+@cache
+def char_tokenizer() -> PreTrainedTokenizerFast:
+    """
+    Character level tokenizer. It's saved so TransformerLens can reload it (it does to add a BOS
+    token).
+    """
+    vocab = {"<|endoftext|>": 0}
+    for char in string.printable:
+        vocab.setdefault(char, len(vocab))
+
+    tokenizer = Tokenizer(models.WordLevel(vocab=vocab, unk_token="<|endoftext|>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    special = "<|endoftext|>"
+    directory = tempfile.mkdtemp(prefix='transpector-test-tokenizer-')
+    PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token=special, eos_token=special, pad_token=special, unk_token=special
+    ).save_pretrained(directory)
+    return PreTrainedTokenizerFast.from_pretrained(directory)
+
+
+def tiny_model(model_name: str = 'gpt2', precision: str = 'float32', on_phase=None) -> HookedTransformer:
+    tokenizer = char_tokenizer()
+    cfg = HookedTransformerConfig(
+        n_layers=3, d_model=32, n_heads=4, d_head=8, d_mlp=64, n_ctx=64, d_vocab=len(tokenizer),
+        act_fn='gelu', normalization_type='LN', default_prepend_bos=True, seed=0,
+    )
+    t.manual_seed(0)
+    return HookedTransformer(cfg, tokenizer=tokenizer).to(getattr(t, precision))
+
+
+def tiny_model_bytes(model_name: str = 'gpt2', precision: str = 'float32') -> int:
+    return 150_000 * transpector.catalog.PRECISION_BYTES[precision]
+
+
+# Swapped before `transpector.model_pool` binds them as the default loader and estimate
+transpector.model.load_model = tiny_model
+transpector.catalog.estimate_model_bytes = tiny_model_bytes
+
+
+@pytest.fixture
+def client():
+    """A client of the app, with the server's state reset"""
+    from fastapi.testclient import TestClient
+    from transpector.main import app, ts
+
+    ts.ablations, ts.patches, ts.logical_clock, ts.reference_run_id = {}, {}, 0, None
+    ts.interventions.compile(ts.ablations, ts.patches)
+    ts.activations.clear()
+    ts.result_cache.clear()
+    with TestClient(app) as client:
+        yield client
@@ -0,0 +1,105 @@
+import torch as t
+from transpector.activation_store import ActivationStore, RunRecord
+
+
+def record(run_id: str, cache_floats: int = 100) -> RunRecord:
+    resid = t.full((cache_floats,), float(len(run_id)))
+    return {
+        "runId": run_id,
+        "key": run_id,
+        "modelName": 'gpt2',
+        "precision": 'float32',
+        "prompt": [run_id],
+        "tokens": t.zeros(1, 4, dtype=t.int64), # 32 bytes
+        "attentionMask": t.ones(1, 4, dtype=t.int64),
+        "logits": t.zeros(1, 4, 2), # 32 bytes
+        "loss": t.zeros(()), # 4 bytes
+        "cache": {
+            'blocks.0.hook_resid_pre': resid,
+            # Shares storage, as a block's resid_post does with the next block's resid_pre
+            'blocks.0.hook_resid_post': resid[:cache_floats // 2],
+        },
+        "ablations": {},
+        "patches": {},
+        "captured": None,
+        "referenceRunId": None,
+    }
+
+
+def test_record_nbytes():
+    store = ActivationStore(max_runs=8, max_bytes=10**9)
+    assert store.record_nbytes(record('a')) == 32 + 32 + 4 + 400 + 200
+
+
+def test_oldest_runs_go_over_max_runs():
+    removed = []
+    store = ActivationStore(max_runs=2, max_bytes=10**9, on_remove=removed.append)
+    for run_id in ['a', 'b', 'c']:
+        store.put(record(run_id))
+    assert list(store.runs) == ['b', 'c']
+    assert removed == ['a']
+
+
+def test_get_makes_a_run_most_recent():
+    store = ActivationStore(max_runs=2, max_bytes=10**9)
+    store.put(record('a'))
+    store.put(record('b'))
+    store.get('a')
+    store.put(record('c'))
+    assert list(store.runs) == ['a', 'c']
+
+
+def test_over_budget_without_spill_dir_drops_runs():
+    store = ActivationStore(max_runs=8, max_bytes=1500)
+    for run_id in ['a', 'b', 'c']:
+        store.put(record(run_id))
+    assert list(store.runs) == ['b', 'c']
+    assert store.nbytes <= store.max_bytes
+
+
+def test_most_recent_run_is_kept_over_budget():
+    store = ActivationStore(max_runs=8, max_bytes=10)
+    store.put(record('a'))
+    store.put(record('b'))
+    assert list(store.runs) == ['b']
+
+
+def test_over_budget_spills_to_memory_mapped_files(tmp_path):
+    store = ActivationStore(max_runs=8, max_bytes=1500, spill_dir=tmp_path)
+    runs = [record(run_id) for run_id in ['a', 'bb', 'ccc']]
+    expected = [{name: value.clone() for name, value in run["cache"].items()} for run in runs]
+    for run in runs:
+        store.put(run)
+
+    assert list(store.runs) == ['a', 'bb', 'ccc']
+    assert set(store.spilled) == {'a'}
+    assert store.nbytes <= store.max_bytes
+    for run, cache in zip(store.runs.values(), expected):
+        assert run["cache"].keys() == cache.keys()
+        assert all(t.equal(run["cache"][name], value) for name, value in cache.items())
+
+    store.remove('a')
+    assert not (tmp_path / 'a.safetensors').exists()
+
+
+def test_borrowed_files_are_left_in_place(tmp_path):
+    path = tmp_path / 'session.safetensors'
+    path.touch()
+    store = ActivationStore(max_runs=1, max_bytes=10**9, spill_dir=tmp_path)
+    store.put_mapped(record('a'), path)
+    assert store.record_nbytes(store.runs['a']) == 32 + 32 + 4
+    store.put(record('b'))
+
+    assert list(store.runs) == ['b']
+    assert path.exists()
+    assert store.spilled == {} and store.borrowed == set()
+
+
+def test_live_cache():
+    store = ActivationStore(max_runs=8, max_bytes=10**9)
+    seed = {'hook_embed': t.ones(2)}
+    live = store.begin(seed)
+    live['blocks.0.hook_resid_pre'] = t.zeros(2)
+    assert store.end() == live
+    assert seed == {'hook_embed': seed['hook_embed']}
+    assert store.live == {}
@@ -0,0 +1,89 @@
+import pytest
+from transpector.interventions import apply_delta
+from transpector.main import ts
+
+ZERO = {'slice': [[0, -1], [0, 1], [0, -1]], 'ablationType': 'zero'}
+FREEZE = {'slice': [[0, -1], [0, 1], [0, -1]], 'ablationType': 'freeze'}
+PATCH = {
+    'slice': [[0, -1], [0, 1], [0, -1]],
+    'edges': {'blocks.1.hook_resid_pre': {'x': {'slice': [[0, -1], [1, 2], [0, -1]]}}},
+}
+
+
+def op(kind, component, slice_id, value=None):
+    return {'op': kind, 'component': component, 'sliceId': slice_id, 'value': value}
+
+
+def test_apply_delta():
+    state = {'blocks.0.hook_mlp_out': {'a': ZERO}}
+    new_state, previous = apply_delta(state, [
+        op('add', 'blocks.1.hook_mlp_out', 'b', ZERO),
+        op('update', 'blocks.0.hook_mlp_out', 'a', FREEZE),
+    ])
+    assert new_state == {'blocks.0.hook_mlp_out': {'a': FREEZE}, 'blocks.1.hook_mlp_out': {'b': ZERO}}
+    assert previous == {('blocks.1.hook_mlp_out', 'b'): None, ('blocks.0.hook_mlp_out', 'a'): ZERO}
+    assert state == {'blocks.0.hook_mlp_out': {'a': ZERO}}
+
+
+def test_apply_delta_drops_emptied_components():
+    new_state, _ = apply_delta({'blocks.0.hook_mlp_out': {'a': ZERO}}, [op('remove', 'blocks.0.hook_mlp_out', 'a')])
+    assert new_state == {}
+
+
+@pytest.mark.parametrize('ops', [
+    [op('add', 'blocks.0.hook_mlp_out', 'a', ZERO)],
+    [op('remove', 'blocks.0.hook_mlp_out', 'b')],
+    [op('update', 'blocks.1.hook_mlp_out', 'a', ZERO)],
+    [op('add', 'blocks.1.hook_mlp_out', 'b', None)],
+    # Ops apply all or none, a valid op ahead of an invalid one isn't applied
+    [op('remove', 'blocks.0.hook_mlp_out', 'a'), op('remove', 'blocks.0.hook_mlp_out', 'a')],
+])
+def test_invalid_delta_raises(ops):
+    state = {'blocks.0.hook_mlp_out': {'a': ZERO}}
+    with pytest.raises(ValueError):
+        apply_delta(state, ops)
+    assert state == {'blocks.0.hook_mlp_out': {'a': ZERO}}
+
+
+def test_ablation_delta_is_applied(client):
+    response = client.put('/api/ablation/delta', json={
+        'ops': [op('add', 'blocks.0.hook_mlp_out', 'a', ZERO)], 'clientLogicalClock': 0,
+    }).json()
+    assert response == {'server_logical_clock': 1, 'applied': True}
+    assert ts.ablations == {'blocks.0.hook_mlp_out': {'a': ZERO}}
+    assert list(ts.interventions.hook_plans) == ['blocks.0.hook_mlp_out']
+
+
+def test_client_behind_gets_the_full_state(client):
+    client.put('/api/ablation/sync', json={'ablations': {'blocks.0.hook_mlp_out': {'a': ZERO}}, 'clientLogicalClock': 0})
+    response = client.put('/api/ablation/delta', json={
+        'ops': [op('add', 'blocks.1.hook_mlp_out', 'b', ZERO)], 'clientLogicalClock': 0,
+    }).json()
+    assert response == {
+        'server_logical_clock': 1, 'applied': False, 'ablations': {'blocks.0.hook_mlp_out': {'a': ZERO}},
+    }
+
+
+def test_invalid_delta_is_rejected(client):
+    response = client.put('/api/ablation/delta', json={
+        'ops': [op('remove', 'blocks.0.hook_mlp_out', 'a')], 'clientLogicalClock': 0,
+    })
+    assert response.status_code == 409
+    assert ts.logical_clock == 0
+
+    # A clock behind the server's fetches the full state, as the client does after a rejection
+    assert client.put('/api/ablation/sync', json={'ablations': {}, 'clientLogicalClock': -1}).json() == {
+        'server_logical_clock': 0, 'ablations': {},
+    }
+
+
+def test_patch_delta_recompiles_the_touched_targets(client):
+    client.put('/api/patch/delta', json={'ops': [op('add', 'blocks.0.hook_resid_pre', 's', PATCH)], 'clientLogicalClock': 0})
+    assert list(ts.interventions.hook_plans) == ['blocks.1.hook_resid_pre']
+
+    moved = {**PATCH, 'edges': {'blocks.2.hook_resid_pre': PATCH['edges']['blocks.1.hook_resid_pre']}}
+    client.put('/api/patch/delta', json={'ops': [op('update', 'blocks.0.hook_resid_pre', 's', moved)], 'clientLogicalClock': 1})
+    assert list(ts.interventions.hook_plans) == ['blocks.2.hook_resid_pre']
+
+    client.put('/api/patch/delta', json={'ops': [op('remove', 'blocks.0.hook_resid_pre', 's')], 'clientLogicalClock': 2})
+    assert ts.patches == {} and ts.interventions.hook_plans == {}
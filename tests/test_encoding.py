@@ -0,0 +1,80 @@
+import json
+import numpy as np
+import pytest
+import torch as t
+from transpector.encoding import BINARY_ALIGNMENT, encode_binary, sse_event
+from transpector.main import ts
+
+
+def decode_binary(message: bytes):
+    """Reads a message the way the client does, viewing each buffer in place"""
+    header_length = int.from_bytes(message[:4], 'little')
+    header = json.loads(message[4:4 + header_length])
+    tensors = {
+        entry["name"]: np.frombuffer(
+            message, dtype='<f2' if entry["dtype"] == 'float16' else '<f4', offset=entry["offset"],
+            count=entry["length"] // (2 if entry["dtype"] == 'float16' else 4),
+        ).reshape(entry["shape"])
+        for entry in header["tensors"]
+    }
+    return header, tensors
+
+
+@pytest.mark.parametrize('dtype', ['float16', 'float32'])
+def test_binary_round_trip(dtype):
+    t.manual_seed(0)
+    tensors = {
+        'logits': t.randn(2, 3, 5),
+        'blocks.0.hook_resid_pre': t.randn(2, 3, 7).transpose(1, 2), # Not contiguous
+        'scalar': t.tensor(1.5),
+        'odd': t.randn(3), # An odd byte length, so the next buffer needs padding
+        'after': t.randn(4),
+    }
+    meta = {"runId": 'abc', "subWords": [['é', '"quoted"']]}
+    header, decoded = decode_binary(encode_binary(tensors, meta, dtype))
+
+    assert header["meta"] == meta
+    assert [entry["name"] for entry in header["tensors"]] == list(tensors)
+    for entry in header["tensors"]:
+        assert entry["offset"] % BINARY_ALIGNMENT == 0
+    for name, tensor in tensors.items():
+        expected = tensor.to(getattr(t, dtype)).numpy()
+        assert decoded[name].shape == expected.shape
+        assert np.array_equal(decoded[name], expected)
+
+
+def test_buffers_dont_overlap_the_header():
+    message = encode_binary({'a': t.ones(3)}, {"pad": 'x' * 13})
+    header_length = int.from_bytes(message[:4], 'little')
+    header = json.loads(message[4:4 + header_length])
+    first = header["tensors"][0]
+    assert first["offset"] >= 4 + header_length
+    assert len(message) == first["offset"] + first["length"]
+
+
+def test_empty_message():
+    header, tensors = decode_binary(encode_binary({}, {"runId": 'abc'}))
+    assert header == {"meta": {"runId": 'abc'}, "tensors": []}
+    assert tensors == {}
+
+
+def test_sse_event():
+    assert sse_event('block', {"a": "line\nbreak"}) == 'event: block\ndata: {"a": "line\\nbreak"}\n\n'
+
+
+def test_lazy_run_then_activation_per_component(client):
+    client.put('/api/tokenize/toTokens', json={'input': ['the cat']})
+    components = ['blocks.0.hook_resid_post', 'blocks.*.attn.hook_pattern']
+    run = client.get('/api/inference/run', params={'lazy': True, 'components': components}).json()
+    assert sorted(run["activationMeta"]) == [
+        'blocks.0.attn.hook_pattern', 'blocks.0.hook_resid_post', 'blocks.1.attn.hook_pattern', 'blocks.2.attn.hook_pattern',
+    ]
+
+    record = ts.get_run(run["runId"])
+    for hook_name, meta in run["activationMeta"].items():
+        response = client.put(
+            '/api/inference/activation', json={'runId': run["runId"], 'hookName': hook_name, 'format': 'binary'}
+        )
+        _, tensors = decode_binary(response.content)
+        assert list(tensors[hook_name].shape) == meta["shape"]
+        assert np.array_equal(tensors[hook_name], record["cache"][hook_name].numpy())
@@ -0,0 +1,110 @@
+import pytest
+import torch as t
+from transpector.main import Modelling
+
+PROMPT = ['the cat sat on the mat', 'a dog']
+
+
+def zero(layer: int, pos: int):
+    return {f'blocks.{layer}.hook_mlp_out': {'a': {'slice': [[0, -1], [pos, pos + 1], [0, -1]], 'ablationType': 'zero'}}}
+
+
+def patch(source_layer: int, target_layer: int):
+    return {f'blocks.{source_layer}.hook_resid_pre': {'s': {
+        'slice': [[0, -1], [1, 2], [0, -1]],
+        'edges': {f'blocks.{target_layer}.hook_resid_mid': {'x': {'slice': [[0, -1], [3, 4], [0, -1]]}}},
+    }}}
+
+
+@pytest.fixture
+def ts(monkeypatch):
+    ts = Modelling()
+    ts.start_layers = []
+    run_with_hooks = ts.run_with_hooks
+
+    def recording(*args, start_at_layer=None, **kwargs):
+        ts.start_layers.append(start_at_layer or 0)
+        return run_with_hooks(*args, start_at_layer=start_at_layer, **kwargs)
+
+    monkeypatch.setattr(ts, 'run_with_hooks', recording)
+    return ts
+
+
+def set_interventions(ts: Modelling, ablations, patches):
+    ts.ablations, ts.patches = ablations, patches
+    ts.interventions.compile(ablations, patches)
+
+
+def full_rerun(ts: Modelling, components=None):
+    """The current interventions run from scratch, in a fresh store"""
+    fresh = Modelling()
+    fresh.incremental_runs = False
+    set_interventions(fresh, ts.ablations, ts.patches)
+    return fresh.run_cached(PROMPT, components=components)
+
+
+def assert_same_run(record, expected):
+    assert t.allclose(record["logits"], expected["logits"], atol=1e-5)
+    assert t.allclose(record["loss"], expected["loss"], atol=1e-5)
+    assert sorted(record["cache"]) == sorted(expected["cache"])
+    for name, value in expected["cache"].items():
+        assert t.allclose(record["cache"][name], value, atol=1e-5), name
+
+
+@pytest.mark.parametrize('before,after,start_layer', [
+    ((zero(2, 1), {}), (zero(2, 4), {}), 2),
+    ((zero(1, 1), {}), (zero(2, 1), {}), 1),
+    (({}, {}), ({}, patch(0, 2)), 2),
+    (({}, patch(0, 1)), ({}, patch(0, 2)), 1),
+    (({}, patch(0, 2)), ({**zero(1, 2)}, patch(0, 2)), 1),
+])
+def test_resumed_run_matches_full_rerun(ts, before, after, start_layer):
+    set_interventions(ts, *before)
+    ts.run_cached(PROMPT)
+    set_interventions(ts, *after)
+    record = ts.run_cached(PROMPT)
+
+    assert ts.start_layers == [0, start_layer]
+    assert_same_run(record, full_rerun(ts))
+
+
+def test_change_at_the_embedding_runs_from_the_start(ts):
+    ts.run_cached(PROMPT)
+    set_interventions(ts, {'hook_embed': {'a': {'slice': [[0, -1], [0, 1], [0, -1]], 'ablationType': 'zero'}}}, {})
+    record = ts.run_cached(PROMPT)
+
+    assert ts.start_layers == [0, 0]
+    assert_same_run(record, full_rerun(ts))
+
+
+def test_resumed_run_with_captured_components(ts):
+    components = ['blocks.*.hook_mlp_out']
+    ts.run_cached(PROMPT, components=components)
+    set_interventions(ts, zero(2, 3), {})
+    record = ts.run_cached(PROMPT, components=components)
+
+    assert ts.start_layers == [0, 2]
+    assert_same_run(record, full_rerun(ts, components))
+
+
+def test_run_missing_requested_components_is_not_resumed(ts):
+    ts.run_cached(PROMPT, components=['blocks.*.hook_mlp_out'])
+    set_interventions(ts, zero(2, 3), {})
+    ts.run_cached(PROMPT, components=['blocks.*.attn.hook_pattern'])
+
+    assert ts.start_layers == [0, 0]
+
+
+def test_blocks_reading_another_reference_run_are_recomputed(ts):
+    # Sourced after its block 0 target, so block 0 reads the reference run
+    backward = {'blocks.1.hook_resid_post': {'s': {
+        'slice': [[0, -1], [1, 2], [0, -1]],
+        'edges': {'blocks.0.hook_resid_post': {'x': {'slice': [[0, -1], [1, 2], [0, -1]]}}},
+    }}}
+    set_interventions(ts, {}, backward)
+    ts.run_cached(PROMPT)
+    ts.run_cached(['another prompt', 'and more'])
+    set_interventions(ts, zero(2, 1), backward)
+    ts.run_cached(PROMPT)
+
+    assert ts.start_layers == [0, 0, 0]
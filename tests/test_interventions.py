@@ -0,0 +1,146 @@
+from types import SimpleNamespace
+import pytest
+import torch as t
+from transpector.interventions import HookPlan, InterventionPlan, patch_edges
+from transpector.model import sliceByMinShape, to_py_slice
+
+SHAPE = (2, 6, 8)
+
+
+def per_slice(result, ablations, edges, sources, frozen):
+    """
+    The interventions one slice at a time, as they were applied before being compiled: freeze
+    ablations, then zero ablations, then patch edges in order
+    """
+    result = result.clone()
+    for ablation in ablations.values():
+        if ablation['ablationType'] == 'freeze':
+            py_slice = to_py_slice(ablation['slice'])
+            cache_slice, res_slice = frozen[py_slice], result[py_slice]
+            aligned = t.zeros_like(res_slice)
+            min_shape = tuple(sliceByMinShape(cache_slice, res_slice))
+            aligned[min_shape] = cache_slice[min_shape]
+            result[py_slice] = aligned
+    for ablation in ablations.values():
+        if ablation['ablationType'] == 'zero':
+            result[to_py_slice(ablation['slice'])] = 0.0
+    for edge in edges:
+        source = sources.get(edge['source_component'])
+        if source is None:
+            continue
+        source_slice = source[to_py_slice(edge['source_slice'])]
+        target_slice = to_py_slice(edge['target_slice'])
+        if result[target_slice].shape == source_slice.shape:
+            result[target_slice] = source_slice
+    return result
+
+
+def compiled(result, ablations, edges, sources, frozen, hook_name='blocks.1.hook_resid_pre'):
+    plan = HookPlan(hook_name, ablations, edges, sources.get, lambda name, value: frozen)
+    return plan.apply(result, SimpleNamespace(name=hook_name))
+
+
+def edge(source_component, source_slice, target_slice):
+    return {'source_component': source_component, 'source_slice': source_slice, 'target_slice': target_slice}
+
+
+ABLATIONS = {
+    'none': {},
+    'zero': {
+        'a': {'slice': [[0, -1], [1, 3], [0, -1]], 'ablationType': 'zero'},
+        'b': {'slice': [[1, 2], [2, -1], [4, 6]], 'ablationType': 'zero'},
+    },
+    'freeze': {
+        'a': {'slice': [[0, 1], [0, 4], [0, -1]], 'ablationType': 'freeze'},
+        'b': {'slice': [[0, -1], [3, 5], [2, 3]], 'ablationType': 'freeze'},
+    },
+    'both': {
+        'a': {'slice': [[0, -1], [0, 4], [0, -1]], 'ablationType': 'freeze'},
+        'b': {'slice': [[0, -1], [2, 5], [1, 7]], 'ablationType': 'zero'},
+    },
+}
+
+EDGES = {
+    'none': [],
+    'single': [edge('blocks.0.hook_resid_pre', [[0, -1], [0, 1], [0, -1]], [[0, -1], [5, 6], [0, -1]])],
+    # The second edge overwrites part of the first, later edges win
+    'overlapping': [
+        edge('blocks.0.hook_resid_pre', [[0, -1], [0, 3], [0, -1]], [[0, -1], [1, 4], [0, -1]]),
+        edge('blocks.0.hook_mlp_out', [[0, -1], [4, 6], [0, -1]], [[0, -1], [2, 4], [0, -1]]),
+        edge('blocks.0.hook_resid_pre', [[1, 2], [0, 1], [0, 4]], [[1, 2], [3, 4], [4, 8]]),
+    ],
+    # Slices that don't line up and sources that aren't cached are skipped
+    'skipped': [
+        edge('blocks.0.hook_resid_pre', [[0, -1], [0, 2], [0, -1]], [[0, -1], [0, 3], [0, -1]]),
+        edge('blocks.0.hook_attn_out', [[0, -1], [0, 1], [0, -1]], [[0, -1], [0, 1], [0, -1]]),
+        edge('blocks.0.hook_mlp_out', [[0, -1], [0, 1], [0, -1]], [[0, -1], [0, 1], [0, -1]]),
+    ],
+}
+
+
+@pytest.mark.parametrize('ablations', ABLATIONS.values(), ids=ABLATIONS.keys())
+@pytest.mark.parametrize('edges', EDGES.values(), ids=EDGES.keys())
+def test_compiled_plan_matches_per_slice(ablations, edges):
+    t.manual_seed(0)
+    result = t.randn(SHAPE)
+    frozen = t.randn(SHAPE)
+    sources = {'blocks.0.hook_resid_pre': t.randn(SHAPE), 'blocks.0.hook_mlp_out': t.randn(SHAPE)}
+
+    expected = per_slice(result, ablations, edges, sources, frozen)
+    assert t.equal(compiled(result, ablations, edges, sources, frozen), expected)
+
+
+def test_compiled_plan_is_reused_across_calls():
+    t.manual_seed(0)
+    sources = {'blocks.0.hook_resid_pre': t.randn(SHAPE)}
+    plan = HookPlan('blocks.1.hook_resid_pre', ABLATIONS['zero'], EDGES['single'], sources.get, lambda name, value: value)
+    hook = SimpleNamespace(name='blocks.1.hook_resid_pre')
+
+    first = plan.apply(t.randn(SHAPE), hook)
+    masks = plan.compiled_masks[(first.shape, first.device)]
+    sources['blocks.0.hook_resid_pre'] = t.randn(SHAPE) # Values change between runs, shapes don't
+    result = t.randn(SHAPE)
+    assert t.equal(plan.apply(result, hook), per_slice(result, ABLATIONS['zero'], EDGES['single'], sources, result))
+    assert plan.compiled_masks[(first.shape, first.device)] is masks
+
+
+def test_freeze_to_a_shorter_activation_keeps_the_rest_zeroed():
+    t.manual_seed(0)
+    result, frozen = t.randn(SHAPE), t.randn(2, 4, 8)
+    ablations = {'a': {'slice': [[0, -1], [0, -1], [0, -1]], 'ablationType': 'freeze'}}
+
+    frozen_result = compiled(result, ablations, [], {}, frozen)
+    assert t.equal(frozen_result[:, :4], frozen)
+    assert not frozen_result[:, 4:].any()
+
+
+def test_recompile_matches_compile():
+    ablations = {
+        'blocks.0.hook_resid_post': {'a': {'slice': [[0, -1], [0, 1], [0, -1]], 'ablationType': 'zero'}},
+        'blocks.1.hook_mlp_out': {'b': {'slice': [[0, -1], [1, 2], [0, -1]], 'ablationType': 'zero'}},
+    }
+    patches = {
+        'blocks.0.hook_resid_pre': {'s': {
+            'slice': [[0, -1], [0, 1], [0, -1]],
+            'edges': {'blocks.1.hook_resid_pre': {'x': {'slice': [[0, -1], [1, 2], [0, -1]]}}},
+        }},
+    }
+    plan = InterventionPlan(lambda name: None, lambda name, value: value)
+    plan.compile(ablations, patches)
+    untouched = plan.hook_plans['blocks.0.hook_resid_post']
+
+    ablations = {**ablations, 'blocks.1.hook_mlp_out': {}}
+    patches = {'blocks.0.hook_resid_pre': {'s': {**patches['blocks.0.hook_resid_pre']['s'], 'edges': {
+        'blocks.2.hook_resid_pre': {'y': {'slice': [[0, -1], [2, 3], [0, -1]]}},
+    }}}}
+    plan.recompile(ablations, patches, {'blocks.1.hook_mlp_out', 'blocks.1.hook_resid_pre', 'blocks.2.hook_resid_pre'})
+
+    full = InterventionPlan(lambda name: None, lambda name, value: value)
+    full.compile(ablations, patches)
+    assert sorted(plan.hook_plans) == sorted(full.hook_plans)
+    assert plan.hook_plans['blocks.0.hook_resid_post'] is untouched
+    for name, hook_plan in plan.hook_plans.items():
+        assert hook_plan.zero_slices == full.hook_plans[name].zero_slices
+        assert hook_plan.freeze_slices == full.hook_plans[name].freeze_slices
+        assert hook_plan.patches == full.hook_plans[name].patches
+    assert patch_edges(patches) == {name: plan.patches for name, plan in full.hook_plans.items() if plan.patches}
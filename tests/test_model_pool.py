@@ -0,0 +1,83 @@
+import torch as t
+from transpector.model_pool import ModelPool, model_nbytes
+
+
+def fake_model(*_args, **_kwargs):
+    return t.nn.Linear(1000, 1, bias=False) # 4000 bytes
+
+
+def fake_estimate(*_args):
+    return 4000
+
+
+def fake_pool(max_bytes: int, estimate=fake_estimate, load=fake_model) -> ModelPool:
+    return ModelPool(max_bytes=max_bytes, load=load, estimate=estimate, warm_up=False)
+
+
+def test_fake_model_size():
+    assert model_nbytes(fake_model()) == 4000
+
+
+def test_get_evicts_least_recently_used():
+    pool = fake_pool(8100)
+    pool.get('a')
+    pool.get('b')
+    pool.get('a')
+    pool.get('c')
+    assert list(pool.models) == [('a', 'float32'), ('c', 'float32')]
+
+
+def test_preload_keeps_the_model_in_use():
+    pool = fake_pool(4100)
+    in_use = pool.get('a')
+    pool.preload('b').result()
+    assert pool.resident('a') is in_use
+    assert pool.resident('b') is None
+    assert pool.load_progress(('a', 'float32'))["phase"] == 'ready'
+    assert pool.nbytes <= pool.max_bytes
+
+
+def test_preload_that_wont_fit_is_skipped_before_loading():
+    loaded = []
+    pool = fake_pool(4100, load=lambda *args, **kwargs: loaded.append(args[0]) or fake_model())
+    pool.get('a')
+    assert pool.preload('b').result() is None
+    assert loaded == ['a']
+    progress = pool.load_progress(('b', 'float32'))
+    assert progress["phase"] == 'skipped'
+    assert progress["error"] is not None
+
+
+def test_preload_bigger_than_estimated_is_skipped_after_loading():
+    pool = fake_pool(4100, estimate=lambda *_: 0)
+    pool.get('a')
+    assert pool.preload('b').result() is not None
+    assert pool.resident('b') is None
+    assert pool.load_progress(('b', 'float32'))["phase"] == 'skipped'
+
+
+def test_unknown_estimate_is_checked_after_loading():
+    def unknown(*_args):
+        raise OSError('offline')
+
+    pool = fake_pool(8100, estimate=unknown)
+    pool.get('a')
+    pool.preload('b').result()
+    assert pool.resident('b') is not None
+
+
+def test_preload_evicts_older_models_before_the_model_in_use():
+    pool = fake_pool(8100)
+    pool.get('a')
+    pool.get('b')
+    pool.preload('c').result()
+    assert list(pool.models) == [('c', 'float32'), ('b', 'float32')]
+
+
+def test_get_after_skipped_preload_loads_the_model():
+    pool = fake_pool(4100)
+    pool.get('a')
+    pool.preload('b').result()
+    pool.get('b')
+    assert list(pool.models) == [('b', 'float32')]
+    assert pool.load_progress(('b', 'float32'))["phase"] == 'ready'
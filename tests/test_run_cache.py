@@ -0,0 +1,93 @@
+import torch as t
+from transpector.main import Modelling
+from transpector.run_cache import RunResultCache, fingerprint
+
+TOKENS = t.tensor([[0, 5, 6, 7]])
+ABLATION = {'blocks.0.hook_mlp_out': {'a': {'slice': [[0, -1], [1, 2], [0, -1]], 'ablationType': 'zero'}}}
+
+
+def backward_patch():
+    """A patch whose source runs after its target, so it reads the reference run"""
+    return {'blocks.1.hook_resid_post': {'s': {
+        'slice': [[0, -1], [1, 2], [0, -1]],
+        'edges': {'blocks.0.hook_resid_post': {'x': {'slice': [[0, -1], [1, 2], [0, -1]]}}},
+    }}}
+
+
+def set_interventions(ts: Modelling, ablations, patches):
+    ts.ablations, ts.patches = ablations, patches
+    ts.interventions.compile(ablations, patches)
+
+
+def test_fingerprint_covers_the_run_state():
+    key = fingerprint('gpt2', TOKENS, 'float32', None, ABLATION, {}, None)
+    assert key == fingerprint('gpt2', TOKENS, 'float32', None, dict(reversed(ABLATION.items())), {}, None)
+    assert key != fingerprint('gpt2-medium', TOKENS, 'float32', None, ABLATION, {}, None)
+    assert key != fingerprint('gpt2', TOKENS[:, :-1], 'float32', None, ABLATION, {}, None)
+    assert key != fingerprint('gpt2', TOKENS, 'bfloat16', None, ABLATION, {}, None)
+    assert key != fingerprint('gpt2', TOKENS, 'float32', None, {}, {}, None)
+    assert key != fingerprint('gpt2', TOKENS, 'float32', None, ABLATION, {}, 'run')
+
+
+def test_responses_are_evicted_over_budget():
+    cache = RunResultCache(max_bytes=10)
+    cache.put('a', 'run a')
+    cache.put('b', 'run b')
+    cache.add_response('a', 'json', b'123456')
+    cache.add_response('b', 'json', b'123456')
+    assert list(cache.entries) == ['b']
+
+
+def test_repeated_run_is_answered_from_the_cache():
+    ts = Modelling()
+    set_interventions(ts, ABLATION, {})
+    first = ts.run_cached(['the cat'])
+    assert ts.run_cached(['the cat'])["runId"] == first["runId"]
+
+    set_interventions(ts, {}, {})
+    assert ts.run_cached(['the cat'])["runId"] != first["runId"]
+
+
+def test_run_evicted_from_the_store_is_rerun():
+    ts = Modelling()
+    first = ts.run_cached(['the cat'])
+    ts.activations.remove(first["runId"])
+    rerun = ts.run_cached(['the cat'])
+    assert rerun["runId"] != first["runId"]
+    assert t.equal(rerun["logits"], first["logits"])
+
+
+def test_runs_reading_the_latest_run_are_keyed_by_it():
+    ts = Modelling()
+    set_interventions(ts, {}, backward_patch())
+    ts.run_cached(['the cat'])
+    first_b = ts.run_cached(['a dog'])
+    rat = ts.run_cached(['the rat'])
+    second_b = ts.run_cached(['a dog'])
+    assert second_b["runId"] != first_b["runId"]
+
+    # The same prompt run after a different reference run isn't answered with the stale result
+    ts.reference_run_id = rat["runId"]
+    ts.result_cache.clear()
+    ts.incremental_runs = False
+    expected = ts.run_cached(['a dog'])
+    assert t.allclose(second_b["loss"], expected["loss"])
+    assert not t.allclose(second_b["loss"], first_b["loss"])
+
+
+def test_runs_not_reading_the_reference_ignore_it():
+    ts = Modelling()
+    set_interventions(ts, ABLATION, {})
+    first = ts.run_cached(['the cat'])
+    ts.run_cached(['a dog'])
+    assert ts.run_cached(['the cat'])["runId"] == first["runId"]
+
+
+def test_entries_leave_with_their_run():
+    ts = Modelling()
+    ts.activations.max_runs = 2
+    first = ts.run_cached(['the cat'])
+    ts.run_cached(['a dog'])
+    ts.run_cached(['the rat'])
+    assert len(ts.result_cache.entries) == 2
+    assert first["key"] not in ts.result_cache.entries
@@ -0,0 +1,60 @@
+import pytest
+import torch as t
+from transpector.main import ts
+from transpector.session import session_path
+
+PROMPT = ['the cat sat', 'a dog']
+ABLATION = {'blocks.1.hook_mlp_out': {'a': {'slice': [[0, -1], [1, 2], [0, -1]], 'ablationType': 'zero'}}}
+
+
+@pytest.fixture
+def sessions(tmp_path, monkeypatch):
+    monkeypatch.setenv('TRANSPECTOR_SESSION_DIR', str(tmp_path))
+    return tmp_path
+
+
+def test_saved_session_is_restored(client, sessions):
+    ts.ablations = ABLATION
+    ts.interventions.compile(ts.ablations, ts.patches)
+    saved = ts.run_cached(PROMPT)
+    response = client.put('/api/session/save', json={'name': 'demo'})
+    assert response.status_code == 200
+    assert [run["runId"] for run in response.json()["runs"]] == [saved["runId"]]
+
+    ts.ablations = {}
+    ts.interventions.compile(ts.ablations, ts.patches)
+    ts.activations.clear()
+    ts.result_cache.clear()
+
+    response = client.put('/api/session/load', json={'name': 'demo'})
+    assert response.status_code == 200
+    assert response.json()["ablations"] == ABLATION
+    assert ts.reference_run_id is None
+
+    # The saved prompt with the saved interventions is answered with the saved run
+    loaded = ts.run_cached(PROMPT)
+    assert loaded["runId"] == saved["runId"]
+    assert t.equal(loaded["logits"], saved["logits"])
+    for name, value in saved["cache"].items():
+        assert t.equal(loaded["cache"][name], value), name
+
+    assert [session["name"] for session in client.get('/api/session/list').json()] == ['demo']
+
+
+def test_saved_components(client, sessions):
+    ts.run_cached(PROMPT)
+    response = client.put('/api/session/save', json={'name': 'mlp', 'components': ['blocks.*.hook_mlp_out']})
+    assert response.json()["runs"][0]["hooks"] == 3
+
+
+@pytest.mark.parametrize('name', ['../x', '.hidden', 'a/b', ''])
+def test_invalid_names_are_rejected(client, sessions, name):
+    with pytest.raises(ValueError):
+        session_path(name)
+    assert client.put('/api/session/save', json={'name': name}).status_code == 400
+    assert client.put('/api/session/load', json={'name': name}).status_code == 400
+
+
+def test_unknown_session(client, sessions):
+    assert client.put('/api/session/load', json={'name': 'missing'}).status_code == 404
+    assert client.get('/api/session/list').json() == []
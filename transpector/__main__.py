@@ -1,6 +1,17 @@
 import click
-from transpector.launch import launch_server
+from transpector.launch import launch_app, launch_server
 
 @click.command()
-def cli():
-    launch_server()
+@click.option('--host', default='127.0.0.1', show_default=True, help='Interface to serve on')
+@click.option('--port', default=8000, show_default=True, help='Port to serve on')
+@click.option('--jupyter', is_flag=True, help='Also start a Jupyter server for notebooks')
+@click.option('--notebook', is_flag=True, help='Boot through a Jupyter kernel running notebooks/main.ipynb')
+def cli(host: str, port: int, jupyter: bool, notebook: bool):
+    if notebook:
+        launch_server()
+    else:
+        launch_app(host, port, jupyter)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,174 @@
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Optional, TypedDict
+from safetensors.torch import load_file, save_file
+from transpector.interventions import AblationsType, HookName, PatchesType
+from transpector.model import AttentionMask, Logits, Precision
+from jaxtyping import Integer
+import torch as t
+
+Cache = dict[HookName, t.Tensor]
+
+RunId = str # Id of a stored inference run
+
+class RunRecord(TypedDict):
+    runId: RunId
+    key: str # Fingerprint of the model, tokens and interventions that produced the run
+    modelName: str
+    precision: Precision
+    prompt: list[str]
+    tokens: Integer[t.Tensor, "batch pos"]
+    attentionMask: AttentionMask # Zero at the padding of batched prompts
+    logits: Logits
+    loss: t.Tensor
+    cache: Cache
+    ablations: AblationsType # Interventions the run was made with
+    patches: PatchesType
+    captured: Optional[list[str]] # Hook name patterns the cache holds, None when it holds every hook point
+    referenceRunId: Optional[RunId] # Run its interventions read from, None when they read none
+
+
+def tensors_nbytes(*tensors: t.Tensor) -> int:
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+class ActivationStore:
+    """
+    The activations of the last `max_runs` runs, with the caches of runs held in memory kept under
+    `max_bytes`
+
+    When the in memory caches go over budget the least recently used run's cache is spilled to a
+    safetensors file in `spill_dir` and memory mapped back, so it stays readable while the OS pages
+    it in on demand. Without a `spill_dir` the run is dropped instead. The most recent run is
+    always kept in memory.
+
+    `live` holds the activations of the run in progress, the caching hooks write to it.
+
+    Runs can also be added already memory mapped from a file the store doesn't own (see
+    `put_mapped`), they're treated as spilled but their file is left in place.
+
+    `on_remove` is called with the id of every run removed, e.g. to drop what refers to it.
+    """
+
+    def __init__(
+            self,
+            max_runs: int,
+            max_bytes: int,
+            spill_dir: Optional[Path] = None,
+            on_remove: Optional[Callable[[RunId], None]] = None,
+    ):
+        self.max_runs = max_runs
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.on_remove = on_remove
+        self.runs: OrderedDict[RunId, RunRecord] = OrderedDict()
+        self.spilled: dict[RunId, Path] = {}
+        self.borrowed: set[RunId] = set() # Spilled runs whose file belongs to someone else
+        self.live: Cache = {}
+
+    def record_nbytes(self, record: RunRecord) -> int:
+        """Memory held by a run, a spilled cache is on disk so it doesn't count"""
+        cache = {} if record["runId"] in self.spilled else record["cache"]
+        return tensors_nbytes(record["tokens"], record["logits"], record["loss"], *cache.values())
+
+    @property
+    def nbytes(self) -> int:
+        return sum(self.record_nbytes(record) for record in self.runs.values())
+
+    def begin(self, seed: Optional[Cache] = None) -> Cache:
+        """Starts the live cache of a new run, seeded with activations it doesn't recompute"""
+        self.live = dict(seed or {})
+        return self.live
+
+    def end(self) -> Cache:
+        cache, self.live = self.live, {}
+        return cache
+
+    def put(self, record: RunRecord):
+        self.runs[record["runId"]] = record
+        self.runs.move_to_end(record["runId"])
+        self.evict()
+
+    def put_mapped(self, record: RunRecord, path: Path):
+        """Stores a run whose cache is memory mapped from `path`, e.g. from a saved session"""
+        self.spilled[record["runId"]] = path
+        self.borrowed.add(record["runId"])
+        self.put(record)
+
+    def get(self, run_id: RunId) -> Optional[RunRecord]:
+        """A stored run, making it the most recently used"""
+        record = self.runs.get(run_id)
+        if record is not None:
+            self.runs.move_to_end(run_id)
+        return record
+
+    def remove(self, run_id: RunId):
+        self.runs.pop(run_id, None)
+        path = self.spilled.pop(run_id, None)
+        if path is not None and run_id not in self.borrowed:
+            path.unlink(missing_ok=True)
+        self.borrowed.discard(run_id)
+        if self.on_remove is not None:
+            self.on_remove(run_id)
+
+    def spill(self, record: RunRecord):
+        """Moves a run's cache to disk, replacing it with memory mapped tensors"""
+        assert self.spill_dir is not None
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        path = self.spill_dir / f"{record['runId']}.safetensors"
+
+        # Activations can share storage (e.g. a block's resid_post is the next block's resid_pre),
+        # which safetensors doesn't allow, so each is written from its own copy
+        save_file({
+            name: value.detach().cpu().clone(memory_format=t.contiguous_format) for name, value in record["cache"].items()
+        }, path)
+        record["cache"] = load_file(path)
+        self.spilled[record["runId"]] = path
+
+    def evict(self):
+        while len(self.runs) > self.max_runs:
+            self.remove(next(iter(self.runs)))
+
+        total = self.nbytes
+        for run_id in list(self.runs)[:-1]:
+            if total <= self.max_bytes:
+                break
+            if run_id in self.spilled:
+                continue
+            record = self.runs[run_id]
+            before = self.record_nbytes(record)
+            if self.spill_dir is not None:
+                self.spill(record)
+                total -= before - self.record_nbytes(record)
+            else:
+                self.remove(run_id)
+                total -= before
+
+    def clear(self):
+        for run_id in list(self.runs):
+            self.remove(run_id)
+        self.live = {}
+
+    def status(self):
+        return {
+            "runs": [
+                {
+                    "runId": run_id,
+                    "modelName": record["modelName"],
+                    "prompt": record["prompt"],
+                    "spilled": run_id in self.spilled,
+                    "bytes": self.record_nbytes(record),
+                }
+                for run_id, record in self.runs.items()
+            ],
+            "bytes": self.nbytes,
+            "maxBytes": self.max_bytes,
+            "maxRuns": self.max_runs,
+        }
+
+
+def spill_dir_from_env() -> Optional[Path]:
+    """Spilling is enabled by setting TRANSPECTOR_ACTIVATION_SPILL_DIR"""
+    spill_dir = os.environ.get('TRANSPECTOR_ACTIVATION_SPILL_DIR')
+    return Path(spill_dir).expanduser() if spill_dir else None
@@ -0,0 +1,222 @@
+from typing import Literal, Optional
+from transformer_lens import HookedTransformer
+from transformer_lens.components import LayerNorm, LayerNormPre
+from transpector.interventions import Hook, HookName
+from transpector.model import HookPoint, Logits
+from jaxtyping import Float, Integer
+import torch as t
+
+SweepType = Literal['layerPosition', 'layerHead'] # Patch every (layer, position) or every (layer, head)
+PositionComponent = Literal['resid_pre', 'resid_mid', 'resid_post', 'attn_out', 'mlp_out']
+HeadComponent = Literal['z', 'q', 'k', 'v']
+SweepMetric = Literal['logitDiff', 'logProb'] # Measured on the logits of the final position
+
+HEAD_DIM = 2 # [batch pos head d_head]
+
+
+def sweep_hook_name(sweep: SweepType, component: str, layer: int) -> HookName:
+    if sweep == 'layerHead':
+        return f'blocks.{layer}.attn.hook_{component}'
+    return f'blocks.{layer}.hook_{component}'
+
+
+def answer_metric(
+        logits: Logits,
+        metric: SweepMetric,
+        correct_token: int,
+        incorrect_token: Optional[int] = None,
+) -> Float[t.Tensor, "batch"]:
+    """Metric of each batch row's final position prediction"""
+    final = logits[:, -1].float()
+    if metric == 'logitDiff':
+        assert incorrect_token is not None
+        return final[:, correct_token] - final[:, incorrect_token]
+    if metric == 'logProb':
+        return final.log_softmax(dim=-1)[:, correct_token]
+    raise ValueError(f"Unknown metric: {metric}")
+
+
+def sweep_hooks(
+        sweep: SweepType,
+        component: str,
+        clean_cache: dict[HookName, t.Tensor],
+        cell_layers: t.Tensor,
+        cell_indices: t.Tensor,
+        n_layers: int,
+) -> list[Hook]:
+    """
+    One hook per layer that patches the clean activation into the batch rows whose cell is at
+    that layer, at the cell's position (or head). Each row of the batch is one cell of the sweep.
+    """
+    def patch(activation: t.Tensor, hook: HookPoint, layer: int) -> t.Tensor:
+        at_layer = cell_layers == layer
+        if not at_layer.any():
+            return activation
+        rows = at_layer.nonzero().squeeze(-1).to(activation.device)
+        indices = cell_indices[at_layer].to(activation.device)
+        clean = clean_cache[sweep_hook_name(sweep, component, layer)][0].to(activation.dtype)
+
+        activation = activation.clone()
+        if sweep == 'layerHead':
+            # Advanced indices either side of a slice put their dimension first: [cells pos d_head]
+            activation[rows, :, indices] = clean[:, indices].transpose(0, 1)
+        else:
+            activation[rows, indices] = clean[indices]
+        return activation
+
+    return [
+        (sweep_hook_name(sweep, component, layer), lambda activation, hook, layer=layer: patch(activation, hook, layer))
+        for layer in range(n_layers)
+    ]
+
+
+def patching_sweep(
+        model: HookedTransformer,
+        clean_tokens: Integer[t.Tensor, "1 pos"],
+        corrupted_tokens: Integer[t.Tensor, "1 pos"],
+        sweep: SweepType,
+        component: str,
+        metric: SweepMetric,
+        correct_token: int,
+        incorrect_token: Optional[int] = None,
+        batch_size: int = 32,
+):
+    """
+    Activation patching over every (layer, position) or (layer, head): for each cell the clean
+    run's activation of `component` is patched into the corrupted run and the metric measured
+
+    Cells are run `batch_size` at a time on the batch dimension, each row of a batch being the
+    corrupted prompt with a different cell patched, so a sweep takes (cells / batch_size) forward
+    passes rather than one per cell.
+
+    Returns the metric of each cell [n_layers, positions or heads], and of the clean and
+    corrupted runs.
+    """
+    if clean_tokens.shape != corrupted_tokens.shape:
+        raise ValueError("Clean and corrupted prompts must have the same number of tokens")
+
+    n_layers = model.cfg.n_layers
+    hook_names = [sweep_hook_name(sweep, component, layer) for layer in range(n_layers)]
+
+    with t.inference_mode():
+        clean_logits, clean_run = model.run_with_cache(clean_tokens, names_filter=hook_names)
+        clean_cache = clean_run.cache_dict
+        corrupted_logits = model(corrupted_tokens)
+
+        width = clean_cache[hook_names[0]].shape[HEAD_DIM if sweep == 'layerHead' else 1]
+        cells = t.cartesian_prod(t.arange(n_layers), t.arange(width))
+
+        results = []
+        for batch in cells.split(batch_size):
+            hooks = sweep_hooks(sweep, component, clean_cache, batch[:, 0], batch[:, 1], n_layers)
+            logits = model.run_with_hooks(corrupted_tokens.expand(len(batch), -1), fwd_hooks=hooks)
+            results.append(answer_metric(logits, metric, correct_token, incorrect_token))
+
+    return (
+        t.cat(results).view(n_layers, width).cpu(),
+        answer_metric(clean_logits, metric, correct_token, incorrect_token)[0].item(),
+        answer_metric(corrupted_logits, metric, correct_token, incorrect_token)[0].item(),
+    )
+
+
+AttributionMetric = Literal['loss', 'logitDiff', 'logProb']
+
+
+def attribution_patching(
+        activations: dict[HookName, t.Tensor],
+        gradients: dict[HookName, t.Tensor],
+        baseline: Optional[dict[HookName, t.Tensor]] = None,
+) -> dict[HookName, t.Tensor]:
+    """
+    Linear approximation of the change in the metric from patching each activation with its value
+    in the baseline run, (baseline - activation) . gradient, or from zero ablating it when there's
+    no baseline. Activations and gradients come from the same run, the run being patched into.
+
+    Products are summed over the model / head dimension so the effect is given per position (and
+    per head), attention patterns are left per element.
+    """
+    effects: dict[HookName, t.Tensor] = {}
+    for name, gradient in gradients.items():
+        activation = activations[name]
+        target = baseline[name] if baseline is not None else t.zeros_like(activation)
+        effect = (target.to(activation.dtype) - activation) * gradient.to(activation.dtype)
+        effects[name] = effect if name.endswith('hook_pattern') else effect.sum(dim=-1)
+    return effects
+
+
+def unembed_directions(model: HookedTransformer, target_tokens: list[int]) -> Float[t.Tensor, "d_model targets"]:
+    """
+    Directions in the residual stream that read off the target tokens' logits once the final layer
+    norm's scale is divided out, with its weight and centering folded in
+    """
+    directions = model.W_U[:, target_tokens].float()
+    ln_final = getattr(model, 'ln_final', None)
+    if getattr(ln_final, 'w', None) is not None:
+        directions = directions * ln_final.w.float()[:, None]
+    if isinstance(ln_final, (LayerNorm, LayerNormPre)):
+        directions = directions - directions.mean(dim=0, keepdim=True)
+    return directions
+
+
+def logit_lens(
+        model: HookedTransformer,
+        cache: dict[HookName, t.Tensor],
+        target_tokens: list[int],
+        top_k: int = 5,
+):
+    """
+    Unembeds every block's `resid_post` as if it were the final residual stream, all blocks at once
+
+    Returns the log probs of the target tokens [batch layer pos targets] and the top k predictions
+    (log probs and token ids) [batch layer pos k].
+    """
+    n_layers = model.cfg.n_layers
+    with t.inference_mode():
+        resid = t.stack([cache[f'blocks.{layer}.hook_resid_post'] for layer in range(n_layers)])
+        resid = resid.to(device=model.W_U.device, dtype=model.W_U.dtype)
+        if hasattr(model, 'ln_final'):
+            resid = model.ln_final(resid)
+        log_probs = (resid @ model.W_U + model.b_U).float().log_softmax(dim=-1).transpose(0, 1)
+
+        top = log_probs.topk(min(top_k, log_probs.shape[-1]), dim=-1)
+        return log_probs[..., target_tokens].cpu(), top.values.cpu(), top.indices.cpu()
+
+
+def direct_logit_attribution(
+        model: HookedTransformer,
+        cache: dict[HookName, t.Tensor],
+        target_tokens: list[int],
+):
+    """
+    Direct contribution of the embeddings, every attention head and every MLP to the target
+    tokens' logits, through the final layer norm scale of the run
+
+    Heads are projected through `W_O` and the unembedding in one product per layer stack rather
+    than materialising each head's [pos d_model] output.
+
+    Returns the embedding [batch pos targets], head [batch layer head pos targets] and MLP
+    [batch layer pos targets] contributions, the MLPs being None for attention only models.
+    """
+    n_layers = model.cfg.n_layers
+    with t.inference_mode():
+        directions = unembed_directions(model, target_tokens)
+        device = directions.device
+
+        scale = cache.get('ln_final.hook_scale')
+        scale = scale.to(device).float() if scale is not None else t.ones(1, device=device)
+
+        z = t.stack([cache[f'blocks.{layer}.attn.hook_z'] for layer in range(n_layers)]).to(device).float()
+        heads = t.einsum('lbphd,lhdt->blhpt', z, model.W_O.float() @ directions) / scale[:, None, None]
+
+        mlps = None
+        if not model.cfg.attn_only:
+            mlp_out = t.stack([cache[f'blocks.{layer}.hook_mlp_out'] for layer in range(n_layers)]).to(device).float()
+            mlps = t.einsum('lbpm,mt->blpt', mlp_out, directions) / scale[:, None]
+
+        embed = cache['hook_embed'].to(device).float()
+        # Shortformer and rotary models don't add a positional embedding to the residual stream
+        if model.cfg.positional_embedding_type == 'standard':
+            embed = embed + cache['hook_pos_embed'].to(device).float()
+        embed = embed @ directions / scale
+
+    return embed.cpu(), heads.cpu(), mlps.cpu() if mlps is not None else None
@@ -0,0 +1,80 @@
+import json
+import os
+import threading
+from functools import lru_cache
+from importlib.metadata import version
+from pathlib import Path
+from typing import Any
+from transformer_lens.loading_from_pretrained import OFFICIAL_MODEL_NAMES, get_pretrained_model_config
+from transpector.model import Precision
+from transpector.weight_cache import cache_dir, config_to_json
+
+# JSON friendly HookedTransformerConfig of a pretrained model
+ModelConfig = dict[str, Any]
+
+catalog_lock = threading.Lock()
+
+PRECISION_BYTES: dict[Precision, int] = {'float32': 4, 'float16': 2, 'bfloat16': 2, 'int8': 1}
+
+
+def catalog_path() -> Path:
+    """The catalog is rebuilt for each transformer_lens version as its configs can change between them"""
+    return cache_dir() / f"catalog-transformer_lens-{version('transformer_lens')}.json"
+
+
+def read_catalog() -> dict[str, ModelConfig]:
+    try:
+        return json.loads(catalog_path().read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def write_catalog(catalog: dict[str, ModelConfig]):
+    path = catalog_path()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + '.tmp')
+        tmp.write_text(json.dumps(catalog))
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f'Could not save model catalog: {e}')
+
+
+@lru_cache(maxsize=None)
+def get_model_config(model_name: str) -> ModelConfig:
+    """Pretrained config of a model, from the catalog when it's been built"""
+    config = read_catalog().get(model_name)
+    if config is not None:
+        return config
+    return config_to_json(get_pretrained_model_config(model_name))
+
+
+def estimate_model_bytes(model_name: str, precision: Precision = 'float32') -> int:
+    """
+    Rough size of a model once loaded, from its config so it's known before loading. The config's
+    `n_params` leaves out the embeddings, which are added.
+    """
+    config = get_model_config(model_name)
+    embedding_params = config["d_model"] * (config["d_vocab"] + config["d_vocab_out"] + config["n_ctx"])
+    return (config["n_params"] + embedding_params) * PRECISION_BYTES[precision]
+
+
+@lru_cache(maxsize=1)
+def get_available_models() -> list[ModelConfig]:
+    """
+    Configs of every official transformer_lens model, built on first use and saved so later starts
+    only read a JSON file. Models whose config can't be built are left out and retried next start.
+    """
+    with catalog_lock:
+        catalog = read_catalog()
+        missing = [model_name for model_name in OFFICIAL_MODEL_NAMES if model_name not in catalog]
+        for model_name in missing:
+            try:
+                catalog[model_name] = get_model_config(model_name)
+            except Exception as e:
+                print(f'Could not load config for {model_name}: {e}')
+
+        if missing:
+            write_catalog(catalog)
+
+    return [catalog[model_name] for model_name in OFFICIAL_MODEL_NAMES if model_name in catalog]
@@ -0,0 +1,78 @@
+import json
+from typing import Any, Literal
+import numpy as np
+import torch as t
+
+ResponseFormat = Literal['json', 'binary'] # Wire formats supported for activation responses
+BinaryDType = Literal['float16', 'float32'] # Element types supported in binary responses
+
+BINARY_MEDIA_TYPE = 'application/octet-stream'
+SSE_MEDIA_TYPE = 'text/event-stream'
+BINARY_ALIGNMENT = 8 # Buffers are aligned so the client can view them directly as typed arrays
+
+binary_numpy_dtypes: dict[BinaryDType, np.dtype] = {
+    'float16': np.dtype('<f2'),
+    'float32': np.dtype('<f4'),
+}
+
+
+def align(offset: int, alignment: int = BINARY_ALIGNMENT) -> int:
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def to_numpy(tensor: t.Tensor, dtype: BinaryDType) -> np.ndarray:
+    """Converts a tensor to a contiguous little-endian numpy array of the requested dtype"""
+    torch_dtype = t.float16 if dtype == 'float16' else t.float32
+    array = tensor.detach().to(device='cpu', dtype=torch_dtype).numpy()
+    # astype rather than ascontiguousarray, which turns scalars into shape [1]
+    return array.astype(binary_numpy_dtypes[dtype], order='C', copy=False)
+
+
+def encode_binary(tensors: dict[str, t.Tensor], meta: dict[str, Any], dtype: BinaryDType = 'float32') -> bytes:
+    """
+    Packs tensors into a single binary message that can be read without per-element parsing
+
+    Layout (all integers little-endian):
+        [uint32 header length][header JSON, utf-8][padding][buffer 0][padding][buffer 1]...
+
+    The header holds the `meta` dict alongside a description of every tensor buffer:
+        {"meta": {...}, "tensors": [{"name", "dtype", "shape", "offset", "length"}, ...]}
+
+    Offsets are absolute byte offsets into the message and are aligned to `BINARY_ALIGNMENT`, so
+    buffers can be wrapped as Float32Array/Uint16Array views on the client without copying.
+    """
+    arrays = {name: to_numpy(tensor, dtype) for name, tensor in tensors.items()}
+
+    # The header length depends on the offsets it contains, so lay the buffers out relative to
+    # the start of the data section first and shift them once the header size is known
+    entries: list[dict[str, Any]] = []
+    data_length = 0
+    for name, array in arrays.items():
+        data_length = align(data_length)
+        entries.append({"name": name, "dtype": dtype, "shape": list(array.shape), "offset": data_length, "length": array.nbytes})
+        data_length += array.nbytes
+
+    data_start = 0
+    while True:
+        header = json.dumps({
+            "meta": meta,
+            "tensors": [{**entry, "offset": entry["offset"] + data_start} for entry in entries],
+        }).encode('utf-8')
+        required_start = align(4 + len(header))
+        if required_start == data_start:
+            break
+        data_start = required_start
+
+    message = np.zeros(data_start + data_length, dtype=np.uint8)
+    message[0:4] = np.frombuffer(len(header).to_bytes(4, 'little'), dtype=np.uint8)
+    message[4:4 + len(header)] = np.frombuffer(header, dtype=np.uint8)
+    for entry, array in zip(entries, arrays.values()):
+        offset = entry["offset"] + data_start
+        message[offset:offset + array.nbytes] = array.reshape(-1).view(np.uint8)
+
+    return message.tobytes()
+
+
+def sse_event(event: str, data: Any) -> str:
+    """Formats a Server-Sent Event carrying `data` as JSON, JSON never spans lines so one data line does"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
@@ -0,0 +1,278 @@
+from typing import Any, Callable, Literal, Optional, Union, TypedDict
+from transpector.metrics import span
+from transpector.model import HookPoint, sliceByMinShape, to_py_slice
+import torch as t
+
+HookName = str
+Hook = tuple[Union[HookName, Callable[..., Any]], Callable[..., Any]]
+
+ModelComponentName = str # Id of a model compnent as a string
+SliceName = str # Id of a slice as a string
+
+Slice = list[int] # Slice of a single dinension[from, to]
+TensorSlice = list[Slice] # Slice for a whole tensor
+AblationTypes = Literal['zero', 'freeze'] # Types of ablation we support
+
+class ModelComponentSlice(TypedDict):
+    slice: TensorSlice
+ModelComponent = dict[ModelComponentName, dict[SliceName, ModelComponentSlice]]
+
+class AblationSliceComponents(TypedDict):
+    slice: TensorSlice
+    ablationType: AblationTypes
+AblationsType = dict[ModelComponentName, dict[SliceName, AblationSliceComponents]]
+
+class PatchSliceComponents(TypedDict):
+    slice: TensorSlice
+    edges: ModelComponent
+PatchesType = dict[ModelComponentName, dict[SliceName, PatchSliceComponents]]
+
+DeltaOpType = Literal['add', 'remove', 'update']
+
+class DeltaOp(TypedDict):
+    op: DeltaOpType
+    component: ModelComponentName
+    sliceId: SliceName
+    value: Optional[Any] # The slice's new state, None for removes
+
+class PatchEdge(TypedDict):
+    source_component: ModelComponentName
+    source_slice: TensorSlice
+    target_slice: TensorSlice
+
+# Reads the activation a patch copies from, None when it hasn't been cached
+SourceReader = Callable[[ModelComponentName], Optional[t.Tensor]]
+# Reads the activation a freeze ablation holds a hook point to, given the hook point's current value
+FrozenReader = Callable[[HookName, t.Tensor], t.Tensor]
+
+
+def slices_mask(slices: list[TensorSlice], shape: t.Size, device: t.device) -> Optional[t.Tensor]:
+    """Boolean mask of every element covered by any of the slices"""
+    if not slices:
+        return None
+    mask = t.zeros(shape, dtype=t.bool, device=device)
+    for tensor_slice in slices:
+        mask[to_py_slice(tensor_slice)] = True
+    return mask
+
+
+class HookPlan:
+    """
+    All ablations and patches applied at one hook point, compiled into a single hook
+
+    Ablations are applied before patches, and freeze ablations before zero ablations. Slices are
+    compiled into boolean masks and flat index tensors the first time a tensor shape is seen, so
+    each forward pass costs a few tensor ops no matter how many slices there are.
+
+    For the purpose of Transpector a patch is a hook that takes an activation from a slice of a
+    model component and applies it to a slice of another model component. These two components
+    are called the source and the target, source is where the copy happens and target is where the
+    paste is applied. To do this we use our cache that has saved the source previously and add a
+    hook on the target to apply from the saved cache.
+    """
+
+    def __init__(
+            self,
+            hook_name: HookName,
+            ablations: dict[SliceName, AblationSliceComponents],
+            patches: list[PatchEdge],
+            read_source: SourceReader,
+            read_frozen: FrozenReader,
+    ):
+        self.hook_name = hook_name
+        self.zero_slices = [a['slice'] for a in ablations.values() if a['ablationType'] == 'zero']
+        self.freeze_slices = [a['slice'] for a in ablations.values() if a['ablationType'] == 'freeze']
+        self.patches = patches
+        self.patch_sources = list(dict.fromkeys(edge['source_component'] for edge in patches))
+        self.read_source = read_source
+        self.read_frozen = read_frozen
+
+        self.compiled_masks: dict[Any, tuple[Optional[t.Tensor], Optional[t.Tensor]]] = {}
+        self.compiled_patches: dict[Any, Optional[tuple[list[tuple[int, t.Tensor]], t.Tensor, t.Tensor]]] = {}
+
+    def masks(self, result: t.Tensor):
+        key = (result.shape, result.device)
+        if key not in self.compiled_masks:
+            self.compiled_masks[key] = (
+                slices_mask(self.zero_slices, result.shape, result.device),
+                slices_mask(self.freeze_slices, result.shape, result.device),
+            )
+        return self.compiled_masks[key]
+
+    def patch_indices(self, result: t.Tensor, sources: list[Optional[t.Tensor]]):
+        """
+        Flat indices for every patch edge whose source is cached and whose slices line up: a
+        (source number, source indices) gather per source, the target indices, and which of the
+        gathered values goes to each target. Later edges win where targets overlap.
+        """
+        key = (result.shape, result.device, *(None if s is None else s.shape for s in sources))
+        if key in self.compiled_patches:
+            return self.compiled_patches[key]
+
+        target_positions = t.arange(result.numel(), device=result.device).view(result.shape)
+        source_positions = [
+            None if s is None else t.arange(s.numel(), device=result.device).view(s.shape) for s in sources
+        ]
+        edges: list[tuple[int, t.Tensor, t.Tensor]] = [] # (source number, source indices, target indices)
+        for edge in self.patches:
+            source_no = self.patch_sources.index(edge['source_component'])
+            if source_positions[source_no] is None:
+                continue
+            source_index = source_positions[source_no][to_py_slice(edge['source_slice'])] # type: ignore
+            target_index = target_positions[to_py_slice(edge['target_slice'])]
+            if source_index.shape == target_index.shape:
+                edges.append((source_no, source_index.flatten(), target_index.flatten()))
+
+        if not edges:
+            self.compiled_patches[key] = None
+            return None
+
+        # Values are gathered one source at a time, so find where each edge's values land
+        gathers: list[tuple[int, t.Tensor]] = []
+        value_indices: list[Optional[t.Tensor]] = [None] * len(edges)
+        gathered = 0
+        for source_no in range(len(sources)):
+            source_edges = [i for i, edge in enumerate(edges) if edge[0] == source_no]
+            if not source_edges:
+                continue
+            gathers.append((source_no, t.cat([edges[i][1] for i in source_edges])))
+            for i in source_edges:
+                n = edges[i][1].numel()
+                value_indices[i] = t.arange(gathered, gathered + n, device=result.device)
+                gathered += n
+
+        target = t.cat([edge[2] for edge in edges])
+        value_index = t.cat(value_indices) # type: ignore
+
+        # Keep only the last write to each target element, a stable sort keeps edge order within
+        # each target so the last of every run of equal targets is the one to keep
+        order = t.argsort(target, stable=True)
+        sorted_target = target[order]
+        is_last = t.ones_like(sorted_target, dtype=t.bool)
+        is_last[:-1] = sorted_target[1:] != sorted_target[:-1]
+        keep = order[is_last]
+
+        self.compiled_patches[key] = (gathers, target[keep], value_index[keep])
+        return self.compiled_patches[key]
+
+    def __call__(self, result: t.Tensor, hook: HookPoint) -> t.Tensor:
+        with span('interventions'):
+            return self.apply(result, hook)
+
+    def apply(self, result: t.Tensor, hook: HookPoint) -> t.Tensor:
+        assert hook.name
+        zero_mask, freeze_mask = self.masks(result)
+
+        if freeze_mask is not None:
+            frozen = self.read_frozen(hook.name, result).to(result.device)
+            aligned = t.zeros_like(result)
+            min_shape = tuple(sliceByMinShape(frozen, result))
+            aligned[min_shape] = frozen[min_shape].to(result.dtype)
+            result = t.where(freeze_mask, aligned, result)
+
+        if zero_mask is not None:
+            result = result.masked_fill(zero_mask, 0.0)
+
+        if self.patches:
+            sources = [self.read_source(name) for name in self.patch_sources]
+            sources = [None if source is None else source.to(result.device) for source in sources]
+            compiled = self.patch_indices(result, sources)
+            if compiled is not None:
+                gathers, target, value_index = compiled
+                values = t.cat([
+                    sources[source_no].reshape(-1)[source_index].to(result.dtype) # type: ignore
+                    for source_no, source_index in gathers
+                ])
+                result = result.reshape(-1).index_put((target,), values[value_index]).view(result.shape)
+
+        return result
+
+
+def apply_delta(state: dict[ModelComponentName, dict[SliceName, Any]], ops: list[DeltaOp]):
+    """
+    Applies add, remove and update ops to an ablation or patch state, all or none of them
+
+    Adds must be of new slices and removes and updates of existing ones, otherwise a ValueError is
+    raised and the state is left as it was. Components left without slices are dropped. Returns
+    the new state, only the touched components are copied, and the previous state of every
+    touched slice.
+    """
+    new_state = dict(state)
+    previous: dict[tuple[ModelComponentName, SliceName], Any] = {}
+    for op in ops:
+        component, slice_id = op['component'], op['sliceId']
+        slices = dict(new_state.get(component, {}))
+        exists = slice_id in slices
+        if op['op'] == 'add' and exists:
+            raise ValueError(f"Slice {slice_id} of {component} already exists")
+        if op['op'] != 'add' and not exists:
+            raise ValueError(f"Slice {slice_id} of {component} doesn't exist")
+        if op['op'] != 'remove' and op['value'] is None:
+            raise ValueError(f"{op['op']} of slice {slice_id} of {component} needs a value")
+
+        previous.setdefault((component, slice_id), slices.get(slice_id))
+        if op['op'] == 'remove':
+            del slices[slice_id]
+        else:
+            slices[slice_id] = op['value']
+
+        if slices:
+            new_state[component] = slices
+        else:
+            new_state.pop(component, None)
+
+    return new_state, previous
+
+
+def patch_edges(patches: PatchesType, targets: Optional[set[HookName]] = None) -> dict[HookName, list[PatchEdge]]:
+    """The patch edges applied at each target hook point, limited to `targets` when given"""
+    # When creating a patch we want to read from the source and transfer the activations to
+    # the target, so the hook has to be triggered on the target's name not the sources
+    edges: dict[HookName, list[PatchEdge]] = {}
+    for source_component_name, source_slices in patches.items():
+        for source_slice_info in source_slices.values():
+            for target_component_name, target_slices in source_slice_info['edges'].items():
+                if targets is not None and target_component_name not in targets:
+                    continue
+                for target_slice_config in target_slices.values():
+                    edges.setdefault(target_component_name, []).append({
+                        'source_component': source_component_name,
+                        'source_slice': source_slice_info['slice'],
+                        'target_slice': target_slice_config['slice'],
+                    })
+    return edges
+
+
+class InterventionPlan:
+    """The ablation and patch state compiled into one `HookPlan` per hook point"""
+
+    def __init__(self, read_source: SourceReader, read_frozen: FrozenReader):
+        self.read_source = read_source
+        self.read_frozen = read_frozen
+        self.hook_plans: dict[HookName, HookPlan] = {}
+
+    def compile(self, ablations: AblationsType, patches: PatchesType):
+        edges = patch_edges(patches)
+        self.hook_plans = {
+            name: HookPlan(name, ablations.get(name, {}), edges.get(name, []), self.read_source, self.read_frozen)
+            for name in [*ablations, *edges]
+            if ablations.get(name) or edges.get(name)
+        }
+
+    def recompile(self, ablations: AblationsType, patches: PatchesType, hook_names: set[HookName]):
+        """
+        Rebuilds the plans of the given hook points only, the plans of every other hook point
+        (and the masks and indices they've compiled) are kept
+        """
+        edges = patch_edges(patches, hook_names)
+        for name in hook_names:
+            if ablations.get(name) or edges.get(name):
+                self.hook_plans[name] = HookPlan(
+                    name, ablations.get(name, {}), edges.get(name, []), self.read_source, self.read_frozen
+                )
+            else:
+                self.hook_plans.pop(name, None)
+
+    @property
+    def fwd_hooks(self) -> list[Hook]:
+        return list(self.hook_plans.items())
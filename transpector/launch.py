@@ -1,34 +1,95 @@
 import asyncio
 import json
+import os
 import random
 import re
+import subprocess
 import sys
 import threading
 import time
-from typing import Any, Optional
+from typing import Any, Callable, Optional
 
 import requests
-import websockets
-from tqdm import tqdm
-from jupyter_server.serverapp import main as jupyter_main
 
 from os.path import join, dirname
 
 
+JUPYTER_CONFIG = join(dirname(__file__), "jupyter_server_config.py")
+# Tells the app a Jupyter server is running, so the UI shows its notebook, see `/api/status`
+JUPYTER_ENV = 'TRANSPECTOR_JUPYTER'
+
+
+def wait_until(ready: Callable[[], bool], timeout: float = 120, interval: float = 0.05) -> bool:
+    """Polls `ready` until it's true, False if it isn't within `timeout` seconds"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if ready():
+            return True
+        time.sleep(interval)
+    return False
+
+
+def responds(url: str, **kwargs) -> Callable[[], bool]:
+    def ready():
+        try:
+            return requests.get(url, timeout=1, **kwargs).ok
+        except requests.ConnectionError:
+            return False
+    return ready
 
 
 def start_jupyter_server():
-    sys.argv = ['jupyter-server', f'--config={join(dirname(__file__), "jupyter_server_config.py")}']
+    from jupyter_server.serverapp import main as jupyter_main
+
+    sys.argv = ['jupyter-server', f'--config={JUPYTER_CONFIG}']
     sys.argv[0] = re.sub(r'(-script\.pyw|\.exe)?$', '', sys.argv[0])
     jupyter_main()
 
 
-def launch_script():
-    # Give the server time to start up
-    time.sleep(10)
+def launch_app(host: str = "127.0.0.1", port: int = 8000, jupyter: bool = False):
+    """
+    Serves the app from `transpector.main` under uvicorn in this process
 
-    # Create a session, which can store cookies
-    session = requests.Session()
+    Importing `transpector.main` starts loading the default model on a background thread, so the
+    model loads while the server starts up. Requests that need the model wait for it. With
+    `jupyter` a Jupyter server is started alongside for notebooks, it isn't needed to serve the app
+    and without it the UI hides its notebook panel.
+    """
+    import uvicorn
+
+    jupyter_process = None
+    if jupyter:
+        os.environ[JUPYTER_ENV] = '1'
+        jupyter_process = subprocess.Popen([sys.executable, '-m', 'jupyter', 'server', f'--config={JUPYTER_CONFIG}'])
+
+    from transpector.main import app, ts
+
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    model_name = ts.model_name
+
+    def announce():
+        if wait_until(lambda: server.started):
+            print(f'Transpector serving at http://{host}:{port}/index.html')
+        # Waits on the preload rather than `ts.model`, which is only touched on the worker
+        if ts.initial_load is not None:
+            try:
+                ts.initial_load.result()
+            except Exception as e:
+                print(f"Couldn't load model {model_name}: {e}")
+                return
+        print(f'Loaded model: {model_name}')
+
+    threading.Thread(target=announce, daemon=True).start()
+    try:
+        server.run()
+    finally:
+        if jupyter_process is not None:
+            jupyter_process.terminate()
+
+
+def launch_script():
+    import websockets
+    from tqdm import tqdm
 
     # The base URL for requests
     base_url = "http://localhost:8686/api"
@@ -39,6 +100,13 @@ def launch_script():
         "Content-Type": "application/json",
     }
 
+    # Wait for the server to start up
+    if not wait_until(responds(base_url + "/jupyter/api", headers=headers)):
+        raise TimeoutError("Jupyter server didn't start")
+
+    # Create a session, which can store cookies
+    session = requests.Session()
+
     # Send an OPTIONS request
     options_url = base_url + "/jupyter/api"
     session.options(options_url, headers=headers)
@@ -133,7 +201,6 @@ def launch_script():
                     status = message["content"]["execution_state"]
                     if status == "idle" and execute_reply_received:
                         break
-                time.sleep(1)
 
             return output
 
@@ -226,7 +293,7 @@ def launch_script():
 
     run_all_cells(
         notebook,
-        messages=['Initialising', 'Loading Libs', 'Setting Types', 'Loading Model', 'Loading endpoints', 'Starting Server']
+        messages=['Initialising', 'Loading Transpector', 'Starting Server']
     )
     print('Transpector loaded')
 
@@ -234,6 +301,10 @@ def launch_script():
 
 
 def launch_server():
+    """Boots the app through a Jupyter kernel running `notebooks/main.ipynb`, see `launch_app`"""
+    # Inherited by the kernel the app runs in
+    os.environ[JUPYTER_ENV] = '1'
+
     # Run the launch script
     launch_script_thread = threading.Thread(target=launch_script, daemon=True)
     launch_script_thread.start()
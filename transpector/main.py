@@ -1,45 +1,103 @@
 # uvicorn main:app --reload
-from bisect import insort
-from functools import partial
-from typing import Any, Callable, Literal, Optional, Union, Sequence, TypedDict
-from fastapi import FastAPI
+import json
+import os
+import time
+from copy import deepcopy
+from fnmatch import fnmatchcase
+from uuid import uuid4
+from typing import Any, Callable, Optional, Union, Sequence, get_args
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from os.path import dirname, join
 from pydantic import BaseModel
-from transpector.model import get_available_models, get_pretrained_model_config, load_model, HookPoint, Logits, per_token_losses, sliceByMinShape
+from transpector.interventions import AblationSliceComponents, AblationsType, DeltaOpType, Hook, HookName, InterventionPlan, ModelComponentName, PatchSliceComponents, PatchesType, SliceName, TensorSlice, apply_delta
+from transpector.encoding import BINARY_MEDIA_TYPE, SSE_MEDIA_TYPE, BinaryDType, ResponseFormat, encode_binary, sse_event
+from transpector.worker import ModelWorker, Superseded, client_id
+from transpector.metrics import METRICS_MEDIA_TYPE, cached_bytes, hook_label, registry, request_seconds, response_bytes, runs, span
+from transpector.model_pool import ModelPool
+from transpector.run_cache import RunResultCache, fingerprint
+from transpector.analysis import AttributionMetric, HeadComponent, PositionComponent, SweepMetric, SweepType, answer_metric, attribution_patching, direct_logit_attribution, logit_lens, patching_sweep
+from transpector.activation_store import ActivationStore, Cache, RunId, RunRecord, spill_dir_from_env
+from transpector.catalog import get_available_models, get_model_config
+from transpector.session import MANIFEST_FILE, load_session_run, read_manifest, save_session, session_path, session_summary, sessions_dir
+from transpector.model import AttentionMask, CacheDType, Precision, activation_grads_only, input_grad_hooks, HookPoint, Logits, Reduction, hook_layer, per_token_losses, reduce_activation, select_positions, to_py_slice, topk_logits
+from transformer_lens import HookedTransformer
+from transformer_lens.utils import get_attention_mask
 from jaxtyping import Integer, Float
+import numpy as np
 import torch as t
 
 app = FastAPI()
 
-HookName = str
-Cache = dict[HookName, t.Tensor]
-
 NamesFilter = Optional[Union[Callable[[str], bool], Sequence[str]]]
-Hook = tuple[Union[HookName, Callable[..., Any]], Callable[..., Any]]
 
+BlockCallback = Callable[[int, Cache], None] # Called with each block's activations as soon as they're computed
 
-ModelComponentName = str # Id of a model compnent as a string
-SliceName = str # Id of a slice as a string
+class ActivationReduction(BaseModel):
+    slice: Optional[TensorSlice] = None # Applied before the reduction
+    reduce: Optional[Reduction] = None
 
-Slice = list[int] # Slice of a single dinension[from, to]
-TensorSlice = list[Slice] # Slice for a whole tensor
-AblationTypes = Literal['zero', 'freeze'] # Types of ablation we support
 
-class ModelComponentSlice(TypedDict):
-    slice: TensorSlice
-ModelComponent = dict[ModelComponentName, dict[SliceName, ModelComponentSlice]]
+def covers(captured: Optional[list[str]], patterns: Optional[list[str]]) -> bool:
+    """Whether a run that captured the `captured` patterns has captured all of `patterns`"""
+    return captured is None or (patterns is not None and set(patterns) <= set(captured))
 
-class AblationSliceComponents(TypedDict):
-    slice: TensorSlice
-    ablationType: AblationTypes
-AblationsType = dict[ModelComponentName, dict[SliceName, AblationSliceComponents]]
 
-ablation_priority: dict[AblationTypes, int] = {'freeze': 1, 'zero': 2}
+def intervention_targets(ablations: AblationsType, patches: PatchesType) -> dict[HookName, str]:
+    """
+    Canonical description of the interventions applied at each hook point, ablations are applied at
+    their own component and patches at their target component
+    """
+    targets: dict[HookName, list[str]] = {}
+    for component_name, component_slices in ablations.items():
+        if component_slices:
+            targets.setdefault(component_name, []).append(json.dumps(component_slices, sort_keys=True))
+
+    for source_component_name, source_slices in patches.items():
+        for source_slice_info in source_slices.values():
+            for target_component_name, target_slices in source_slice_info['edges'].items():
+                for target_slice_config in target_slices.values():
+                    targets.setdefault(target_component_name, []).append(json.dumps(
+                        [source_component_name, source_slice_info['slice'], target_slice_config['slice']]
+                    ))
+
+    return {name: json.dumps(sorted(configs)) for name, configs in targets.items()}
+
+
+def first_changed_layer(
+        n_layers: int,
+        old_ablations: AblationsType,
+        old_patches: PatchesType,
+        new_ablations: AblationsType,
+        new_patches: PatchesType,
+) -> int:
+    """
+    First block whose interventions differ between two states, n_layers + 1 if nothing changed.
+    Every block before it computes exactly what it did in a run with the old state.
+    """
+    old_targets = intervention_targets(old_ablations, old_patches)
+    new_targets = intervention_targets(new_ablations, new_patches)
+    changed = [name for name in old_targets.keys() | new_targets.keys() if old_targets.get(name) != new_targets.get(name)]
+    return min((hook_layer(name, n_layers) for name in changed), default=n_layers + 1)
 
-class PatchSliceComponents(TypedDict):
-    slice: TensorSlice
-    edges: ModelComponent
-PatchesType = dict[ModelComponentName, dict[SliceName, PatchSliceComponents]]
+
+def first_reference_layer(n_layers: int, ablations: AblationsType, patches: PatchesType) -> int:
+    """
+    First block with an intervention that reads the reference run rather than the run itself, n_layers
+    + 1 if none does: a freeze ablation, or a patch whose source doesn't run before its target's block
+    """
+    layers = [
+        hook_layer(name, n_layers) for name, slices in ablations.items()
+        if any(ablation['ablationType'] == 'freeze' for ablation in slices.values())
+    ]
+    for source_name, source_slices in patches.items():
+        for source_slice in source_slices.values():
+            layers.extend(
+                hook_layer(target_name, n_layers) for target_name, target_slices in source_slice['edges'].items()
+                if target_slices and hook_layer(source_name, n_layers) >= hook_layer(target_name, n_layers)
+            )
+    return min(layers, default=n_layers + 1)
 
 
 
@@ -47,22 +105,61 @@ class Modelling:
     def __init__(self):
         self.logical_clock = 0
 
+        # Recently used models stay loaded so switching back to them is instant
+        self.models = ModelPool(
+            max_bytes=int(os.environ.get('TRANSPECTOR_MODEL_POOL_BYTES', 8 * 1024**3)),
+            warm_up=os.environ.get('TRANSPECTOR_WARM_UP', '1') != '0',
+        )
+
         self.model_name: str = 'gpt2'
-        self.model = load_model(self.model_name)
-        self.model_config = get_pretrained_model_config(self.model_name)
-        self.available_models = get_available_models()
+        self.precision: Precision = 'float32'
+        self.cache_dtype: Optional[CacheDType] = None # Dtype cached activations are stored in, the model's when None
+        # The first model loads in the background so the server can start up while it does
+        self.initial_load = self.models.preload(self.model_name, self.precision)
+        self.current_model: Optional[HookedTransformer] = None
         self.last_prompt: list[str] = []
 
-        self.live_cache: Cache = {}
-        self.last_cache: Cache = {}
-
         self.ablations: AblationsType = {}
-        self.fwd_ablation_hooks: list[Hook] = []
-        self.bwd_ablation_hooks: list[Hook] = []
-
         self.patches: PatchesType = {}
-        self.fwd_patch_hooks: list[Hook] = []
-        self.bwd_patch_hooks: list[Hook] = []
+
+        # Ablations and patches compiled into one forward hook per hook point
+        self.interventions = InterventionPlan(self.patch_source, self.frozen_activation)
+
+        # Decoded string for every token id, built on first use so detokenization is a lookup
+        self.vocab_strings: Optional[np.ndarray] = None
+
+        # Resume runs from the first block whose interventions changed since a run of the same tokens
+        self.incremental_runs = True
+
+        # Past runs keyed by model, tokens and interventions so repeats skip the model
+        self.result_cache = RunResultCache(
+            max_bytes=int(os.environ.get('TRANSPECTOR_RESULT_CACHE_BYTES', 2 * 1024**3))
+        )
+
+        # Recent runs kept server side so activations can be fetched on demand, and read by
+        # interventions, under a memory budget. Cached results of a run go with it.
+        self.activations = ActivationStore(
+            max_runs=int(os.environ.get('TRANSPECTOR_MAX_RUNS', 8)),
+            max_bytes=int(os.environ.get('TRANSPECTOR_ACTIVATION_BYTES', 2 * 1024**3)),
+            spill_dir=spill_dir_from_env(),
+            on_remove=self.result_cache.drop_run,
+        )
+
+        # Run freeze ablations and patch sources read from, the latest run of the model when None
+        self.reference_run_id: Optional[RunId] = None
+        # Latest run made with each model, reading a stored run doesn't change it
+        self.latest_run_ids: dict[tuple[str, Precision], RunId] = {}
+
+    @property
+    def model(self) -> HookedTransformer:
+        """The current model, waiting for it if it's still loading"""
+        if self.current_model is None:
+            self.current_model = self.models.get(self.model_name, self.precision)
+        return self.current_model
+
+    @property
+    def model_config(self):
+        return get_model_config(self.model_name)
 
     @property
     def session_config(self):
@@ -71,14 +168,245 @@ class Modelling:
             "ablations": self.ablations
         }
     
-    def set_model(self, model_name: str):
+    def set_model(self, model_name: str, precision: Precision = 'float32', cache_dtype: Optional[CacheDType] = None):
+        # The new model is current while it loads so `/api/status` reports its progress, and the
+        # previous one is restored if it fails to load
+        previous = (self.model_name, self.precision, self.cache_dtype)
         self.model_name = model_name
-        self.model = load_model(self.model_name)
-        self.model_config = get_pretrained_model_config(self.model_name)
+        self.precision = precision
+        self.cache_dtype = cache_dtype
+        try:
+            self.current_model = self.models.get(self.model_name, self.precision)
+        except Exception:
+            self.model_name, self.precision, self.cache_dtype = previous
+            raise
+        # Stored runs are kept, they're keyed by model so they stay valid for when we switch back
+        self.reference_run_id = None
+        self.vocab_strings = None
+
+    def is_current_model(self, record: RunRecord) -> bool:
+        return record["modelName"] == self.model_name and record["precision"] == self.precision
+
+    def reference_run(self) -> Optional[RunRecord]:
+        """The run interventions read activations from that the current run hasn't computed yet"""
+        if self.reference_run_id is not None:
+            return self.activations.runs.get(self.reference_run_id)
+        latest_run_id = self.latest_run_ids.get((self.model_name, self.precision))
+        return self.activations.runs.get(latest_run_id) if latest_run_id is not None else None
+
+    def effective_reference_run_id(self) -> Optional[RunId]:
+        """The reference run a run with the current interventions reads from, None if it reads none"""
+        if first_reference_layer(self.model.cfg.n_layers, self.ablations, self.patches) > self.model.cfg.n_layers:
+            return None
+        reference = self.reference_run()
+        return reference["runId"] if reference is not None else None
+
+    def run_cached(
+            self,
+            prompt: list[str],
+            on_block: Optional[BlockCallback] = None,
+            components: Optional[list[str]] = None,
+    ) -> RunRecord:
+        """
+        Runs the prompt with the current ablations and patches, reusing the stored result when the
+        same model, tokens and interventions have been run before
+
+        `on_block` is called with the activations of every block in order, as each block finishes
+        or straight away for blocks that come from a stored run.
+
+        `components` limits the hook points captured to those matching the given names or glob
+        patterns (plus what interventions and later runs need, see `capture_patterns`), otherwise
+        every hook point is captured.
+        """
+        with span('tokenize'):
+            tokens = self.model.to_tokens(prompt)
+            attention_mask = get_attention_mask(self.model.tokenizer, tokens, self.model.cfg.default_prepend_bos)
+        reference_run_id = self.effective_reference_run_id()
+        key = fingerprint(
+            self.model_name, tokens, self.precision, self.cache_dtype, self.ablations, self.patches, reference_run_id
+        )
+        captured = self.capture_patterns(components)
+
+        cached = self.result_cache.get(key)
+        record = self.activations.get(cached.run_id) if cached is not None else None
+        if cached is not None and record is None:
+            self.result_cache.pop(key) # The run has been evicted from the activation store
+        if record is not None and not covers(record["captured"], captured):
+            # Rerun capturing what the stored run did as well, so it keeps answering its requests
+            if captured is not None and record["captured"] is not None:
+                captured = sorted({*captured, *record["captured"]})
+            record = None
+
+        if record is not None:
+            runs.inc(result='stored')
+            if on_block is not None:
+                for layer in range(self.model.cfg.n_layers):
+                    on_block(layer, self.block_activations(record["cache"], layer))
+        else:
+            logits, loss, cache = self.run_incremental(prompt, tokens, attention_mask, on_block, captured, reference_run_id)
+            for name, value in cache.items():
+                cached_bytes.inc(value.numel() * value.element_size(), hook=hook_label(name))
+            record = {
+                "runId": uuid4().hex,
+                "key": key,
+                "modelName": self.model_name,
+                "precision": self.precision,
+                "prompt": prompt,
+                "tokens": tokens,
+                "attentionMask": attention_mask,
+                "logits": logits.detach(),
+                "loss": loss.detach(),
+                "cache": cache,
+                "ablations": deepcopy(self.ablations),
+                "patches": deepcopy(self.patches),
+                "captured": captured,
+                "referenceRunId": reference_run_id,
+            }
+            self.result_cache.put(key, record["runId"])
+
+        self.activations.put(record)
+        self.latest_run_ids[(record["modelName"], record["precision"])] = record["runId"]
+        return record
+
+    def run_incremental(
+            self,
+            prompt: list[str],
+            tokens: Integer[t.Tensor, "batch pos"],
+            attention_mask: AttentionMask,
+            on_block: Optional[BlockCallback] = None,
+            captured: Optional[list[str]] = None,
+            reference_run_id: Optional[RunId] = None,
+    ):
+        """
+        Runs the prompt, resuming from the residual stream of a stored run of the same tokens when
+        only later blocks have had their ablations or patches changed since
+
+        The resumed run starts at the first changed block N from the stored
+        `blocks.{N-1}.hook_resid_post`, with the stored activations of the earlier blocks seeding
+        the cache so patches sourced from them still apply. Blocks reading the reference run are
+        only reused from a run that read the same one (`reference_run_id`).
+        """
+        n_layers = self.model.cfg.n_layers
+        reference_layer = first_reference_layer(n_layers, self.ablations, self.patches)
+        start_at_layer, resume_from = 0, None
+        # A residual stream cached at a lower precision would change the resumed run's results
+        lossless_cache = self.cache_dtype is None or getattr(t, self.cache_dtype) == self.model.cfg.dtype
+        if self.incremental_runs and lossless_cache and self.model.cfg.positional_embedding_type != 'shortformer':
+            for record in self.activations.runs.values():
+                if not self.is_current_model(record):
+                    continue
+                if record["tokens"].shape != tokens.shape or not t.equal(record["tokens"], tokens):
+                    continue
+                if not covers(record["captured"], captured):
+                    continue
+                layer = first_changed_layer(n_layers, record["ablations"], record["patches"], self.ablations, self.patches)
+                if record["referenceRunId"] != reference_run_id:
+                    layer = min(layer, reference_layer)
+                if start_at_layer < layer <= n_layers and f'blocks.{layer - 1}.hook_resid_post' in record["cache"]:
+                    start_at_layer, resume_from = layer, record
+
+        stream_hooks = self.block_stream_hooks(on_block) if on_block is not None else None
+        names_filter = self.names_filter(captured)
+        runs.inc(result='computed' if resume_from is None else 'resumed')
+        if resume_from is None:
+            self.activations.begin()
+            return self.run_with_hooks(
+                tokens, custom_fwd_hooks=stream_hooks, names_filter=names_filter, attention_mask=attention_mask
+            )
+
+        live = self.activations.begin({
+            name: value for name, value in resume_from["cache"].items() if hook_layer(name, n_layers) < start_at_layer
+        })
+        if on_block is not None:
+            for layer in range(start_at_layer):
+                on_block(layer, self.block_activations(live, layer))
+
+        resid = resume_from["cache"][f'blocks.{start_at_layer - 1}.hook_resid_post']
+        return self.run_with_hooks(
+            resid.to(device=self.model.cfg.device, dtype=self.model.cfg.dtype),
+            custom_fwd_hooks=stream_hooks,
+            names_filter=names_filter,
+            start_at_layer=start_at_layer,
+            tokens=tokens,
+            attention_mask=attention_mask,
+        )
+
+    def capture_patterns(self, components: Optional[list[str]]) -> Optional[list[str]]:
+        """
+        Hook name patterns a run has to capture to return `components`, None captures everything
+
+        Besides the requested components this holds the activations interventions read back (patch
+        sources and freeze ablation targets) and every block's residual stream for resuming runs.
+        """
+        if components is None:
+            return None
+
+        freeze_targets = [
+            name for name, slices in self.ablations.items()
+            if any(ablation['ablationType'] == 'freeze' for ablation in slices.values())
+        ]
+        return sorted({*components, *self.patches, *freeze_targets, 'blocks.*.hook_resid_post'})
+
+    def names_filter(self, patterns: Optional[list[str]]) -> NamesFilter:
+        """The hook points matching any of the patterns, matched once per run rather than per hook call"""
+        if patterns is None:
+            return None
+        return [name for name in self.model.hook_dict if any(fnmatchcase(name, pattern) for pattern in patterns)]
+
+    def block_activations(self, cache: Cache, layer: int) -> Cache:
+        """Activations of one block, block 0 includes the embeddings and block n_layers the final layer norm"""
+        return {name: value for name, value in cache.items() if hook_layer(name, self.model.cfg.n_layers) == layer}
+
+    def block_stream_hooks(self, on_block: BlockCallback) -> list[Hook]:
+        """
+        Hooks on every `blocks.N.hook_resid_post` that pass the block's activations to `on_block`.
+        They run after the caching hooks, so every activation of the block is in the live cache.
+        """
+        def stream_block(activation: t.Tensor, hook: HookPoint):
+            assert hook.name
+            layer = hook_layer(hook.name, self.model.cfg.n_layers)
+            on_block(layer, self.block_activations(self.activations.live, layer))
+
+        return [(f'blocks.{layer}.hook_resid_post', stream_block) for layer in range(self.model.cfg.n_layers)]
+
+    def precision_fidelity(self, prompt: list[str]):
+        """
+        Per token losses of the current model and of the float32 model on the same prompt, so the
+        cost of running at a reduced precision can be seen. No interventions are applied.
+        """
+        baseline = self.models.resident(self.model_name)
+        if baseline is None:
+            # Loaded through the pool so it's kept for later checks, as a preload so it doesn't push
+            # out the current model
+            loading = self.models.preload(self.model_name)
+            baseline = loading.result() if loading is not None else self.models.get(self.model_name)
+            if baseline is None:
+                # Skipped as it doesn't fit beside the current model, so it's only loaded for this check
+                baseline = self.models.load_tracked((self.model_name, 'float32'))
+        tokens = self.model.to_tokens(prompt)
+        attention_mask = get_attention_mask(self.model.tokenizer, tokens, self.model.cfg.default_prepend_bos)
+
+        with t.no_grad():
+            losses = per_token_losses(self.model(tokens, attention_mask=attention_mask).float(), tokens)
+            baseline_losses = per_token_losses(baseline(tokens, attention_mask=attention_mask).float(), tokens)
+
+        # Only positions predicting a real token count towards the summary
+        return losses, baseline_losses, attention_mask[:, 1:].bool()
+
+    @classmethod
+    def prompt_positions(cls, record: RunRecord) -> list[t.Tensor]:
+        """Positions of the real (non padding) tokens of each prompt in a batched run"""
+        return [row.nonzero().squeeze(-1).cpu() for row in record["attentionMask"]]
+
+    def get_run(self, run_id: RunId) -> RunRecord:
+        record = self.activations.get(run_id)
+        if record is None:
+            raise HTTPException(status_code=404, detail=f"Unknown or expired run: {run_id}")
+        return record
 
     def run_with_hooks(
             self,
-            prompt: str | list[str],
+            prompt: str | list[str] | Float[t.Tensor, "batch pos d_model"],
             custom_fwd_hooks: Optional[list[Hook]]=None,
             custom_bwd_hooks: Optional[list[Hook]]=None,
             names_filter: NamesFilter = None,
@@ -87,6 +415,10 @@ class Modelling:
             incl_bwd: bool=False,
             reset_hooks_end: bool=True,
             clear_contexts: bool=False,
+            start_at_layer: Optional[int]=None,
+            tokens: Optional[Integer[t.Tensor, "batch pos"]]=None,
+            attention_mask: Optional[AttentionMask]=None,
+            backward_metric: Optional[Callable[[Logits, t.Tensor], t.Tensor]]=None,
     ):
         """
         Modified version of run_with_hooks from Transformer Lens
@@ -95,7 +427,8 @@ class Modelling:
         and patching hooks set on the modelling object
 
         Args:
-            prompt: Model prompt, can be batched list or single string 
+            prompt: Model prompt, can be batched list or single string, or the residual stream
+                entering `start_at_layer`
             custom_fwd_hooks: A list of (name, hook), where name is
                 either the name of a hook point or a boolean function on hook names, and hook is the
                 function to add to that hook point. Hooks with names that evaluate to True are added
@@ -105,19 +438,22 @@ class Modelling:
                 patching hooks)
             device: Device to run the model on
             remove_batch_dim: Strips the batch dimension
-            incl_bwd: Enable doing a backward pass in addition to foward
+            incl_bwd: Enable doing a backward pass in addition to foward, the gradients of every hook
+                point in `names_filter` are cached under '{hook name}_grad'. Parameters don't get
+                gradients.
             reset_hooks_end (bool): If True, all hooks are removed at the end, including those added
                 during this run. Default is True.
             clear_contexts (bool): If True, clears hook contexts whenever hooks are reset. Default is
                 False.
-
-        Note:
-            If you want to use backward hooks, set `reset_hooks_end` to False, so the backward hooks
-            remain active. This function only runs a forward pass.
+            start_at_layer: Skip the embedding and earlier blocks, starting from this block
+            tokens: Tokens of the prompt, needed for the loss when starting at a later layer
+            attention_mask: Mask of the padding in batched prompts, excluded from the loss
+            backward_metric: Scalar the backward pass differentiates, computed from the logits and
+                loss. The loss when None.
         """
         
         _, fwd, bwd = self.model.get_caching_hooks(
-            names_filter, incl_bwd, device, remove_batch_dim=remove_batch_dim, cache=self.live_cache
+            names_filter, incl_bwd, device, remove_batch_dim=remove_batch_dim, cache=self.activations.live
         )
 
         if custom_fwd_hooks:
@@ -127,85 +463,56 @@ class Modelling:
             bwd.extend(custom_bwd_hooks)
 
         # We want to do ablations before patches and patches before caching activations
-        fwd = [*self.fwd_ablation_hooks, *self.fwd_patch_hooks, *fwd]
-        bwd = [*self.bwd_ablation_hooks, *self.bwd_patch_hooks, *bwd]
+        fwd = [*self.interventions.fwd_hooks, *fwd]
+
+        if incl_bwd:
+            fwd = [*input_grad_hooks, *fwd]
 
         with self.model.hooks(
             fwd_hooks=fwd,
             bwd_hooks=bwd,
             reset_hooks_end=reset_hooks_end,
             clear_contexts=clear_contexts,
-        ):
-            model_out_logits, model_out_loss = self.model(prompt, return_type='both')
+        ), activation_grads_only(self.model) if incl_bwd else t.no_grad():
+            # Without a backward pass no autograd graph is built, stored runs would otherwise keep theirs alive
+            with span('forward'):
+                model_out_logits, model_out_loss = self.model(
+                    prompt, return_type='both', start_at_layer=start_at_layer, tokens=tokens, attention_mask=attention_mask
+                )
             if incl_bwd:
-                model_out.backward()
+                with span('backward'):
+                    metric = backward_metric(model_out_logits, model_out_loss) if backward_metric else model_out_loss
+                    metric.backward()
 
-        self.last_cache = self.live_cache.copy()
-        self.live_cache = {} # Reset live cache after run
+        cache = self.activations.end()
+        if self.cache_dtype is not None:
+            cache_dtype = getattr(t, self.cache_dtype)
+            cache = {name: value.to(cache_dtype) for name, value in cache.items()}
 
-        return model_out_logits, model_out_loss, self.last_cache
+        return model_out_logits, model_out_loss, cache
     
-    def patch_hook(
-            self,
-            result: t.Tensor,
-            hook: HookPoint,
-            source_component: ModelComponentName,
-            source_slice: TensorSlice,
-            target_component: ModelComponentName,
-            target_slice: TensorSlice,
-    ):
+    def patch_source(self, source_component: ModelComponentName) -> Optional[t.Tensor]:
         """
-        For the purpose of Transpector a patch is a hook that takes an activation from a slice of a
-        model component and applies it to a slice of another model component.
-
-        These two components are called the source and the target, source is where the copy happens
-        and target is where the paste is applied. To do this we use our cache that has saved the source
-        previously and add a hook on the target to apply from the saved cache.
+        Activation a patch copies from, taken from this run when the source has already been
+        computed and otherwise from the reference run
         """
+        if source_component in self.activations.live:
+            return self.activations.live[source_component]
+        reference = self.reference_run()
+        return reference["cache"].get(source_component) if reference is not None else None
 
-        source_py_slice = [slice(r0, r1 if r1!=-1 else None) for (r0, r1) in source_slice]
-        target_py_slice = [slice(r0, r1 if r1!=-1 else None) for (r0, r1) in target_slice]
-
-        if source_component in self.live_cache:
-            result[target_py_slice] = self.live_cache[source_component][source_py_slice]
-        elif source_component in self.last_cache and \
-            result[target_py_slice].shape == self.last_cache[source_component][source_py_slice].shape:
-            result[target_py_slice] = self.last_cache[source_component][source_py_slice]
-
-        return result
-    
-    def ablation_hook(
-        self,
-        result: t.Tensor,
-        hook: HookPoint,
-        slices: TensorSlice,
-        ablation_type: AblationTypes='zero',
-    ) -> t.Tensor:
-        assert hook.name
-        py_slice = [slice(r0, r1 if r1!=-1 else None) for (r0, r1) in slices]
-
-        if ablation_type == 'zero':
-            print('albating', hook.name)
-            result[py_slice] = 0.0
-        elif ablation_type == 'freeze':
-            
-            print('freezing', hook.name)
-            if hook.name not in self.last_cache:
-                self.last_cache[hook.name] = result.clone().detach()
-
-            cache_slice = self.last_cache[hook.name][py_slice]
-            res_slice = result[py_slice]
-            frozen = t.zeros_like(res_slice)
-            frozen[sliceByMinShape(cache_slice, res_slice)] = cache_slice[sliceByMinShape(cache_slice, res_slice)]
-
-            result[py_slice] = frozen
-
-        return result
-
-
+    def frozen_activation(self, hook_name: HookName, result: t.Tensor) -> t.Tensor:
+        """
+        Activation a freeze ablation holds a hook point to, its value in the reference run. If the
+        reference run didn't capture it, it's frozen as is (and captured, see `capture_patterns`).
+        """
+        reference = self.reference_run()
+        if reference is None or hook_name not in reference["cache"]:
+            return result
+        return reference["cache"][hook_name]
 
     @classmethod
-    def clean_cache(cls, cache: Cache):
+    def filter_cache(cls, cache: Cache) -> Cache:
         """
         # Attrs to keep
         'hook_embed',
@@ -230,28 +537,92 @@ class Modelling:
         'blocks.*.mlp.hook_pre',
         'blocks.*.mlp.hook_post',
         """
-        cache_copy: dict[ModelComponentName, Float[list[float], "..."]] = {}
+        return {key: value for key, value in cache.items() if cls.is_displayed(key)}
+
+    @classmethod
+    def is_displayed(cls, hook_name: HookName) -> bool:
+        """Whether the frontend displays a hook point, see `filter_cache`"""
+        match hook_name.split('.'):
+            case ['hook_embed'] | ['hook_pos_embed'] | ['ln_final', 'hook_normalized']:
+                return True
+            case ['blocks', _blockno, ('hook_resid_pre' | 'hook_attn_out' | 'hook_resid_mid' | 'hook_mlp_out' | 'hook_resid_post')]:
+                return True
+            case ['blocks', _blockno, 'attn', ('hook_q' | 'hook_k' | 'hook_v' | 'hook_z' | 'hook_pattern')]:
+                return True
+            case _:
+                return False
+
+    @classmethod
+    def select_components(cls, cache: Cache, components: Optional[list[str]]) -> Cache:
+        """Keeps the activations matching any of the hook names or glob patterns, all when None"""
+        if components is None:
+            return cache
+        return {key: value for key, value in cache.items() if any(fnmatchcase(key, pattern) for pattern in components)}
+
+    @classmethod
+    def reduce_cache(cls, cache: Cache, reductions: dict[str, ActivationReduction]) -> Cache:
+        """
+        Slices and reduces cached activations server side so only what is displayed gets sent
+
+        `reductions` maps hook names or glob patterns (e.g. 'blocks.*.attn.hook_z') to the slice
+        and reduction to apply, the first matching pattern wins. Hooks matching no pattern are
+        dropped.
+        """
+        reduced: Cache = {}
         for key, value in cache.items():
-            match key.split('.'):
-                case ['hook_embed'] | ['hook_pos_embed'] | ['ln_final', 'hook_normalized']:
-                    cache_copy[key] = value.tolist()
-                case ['blocks', _blockno, ('hook_resid_pre' | 'hook_attn_out' | 'hook_resid_mid' | 'hook_mlp_out' | 'hook_resid_post')]:
-                    cache_copy[key] = value.tolist()
-                case ['blocks', _blockno, 'attn', ('hook_q' | 'hook_k' | 'hook_v' | 'hook_z' | 'hook_pattern')]:
-                    cache_copy[key] = value.tolist()
-                case _:
-                    pass
+            spec = next((spec for pattern, spec in reductions.items() if fnmatchcase(key, pattern)), None)
+            if spec is None:
+                continue
+            reduced[key] = cls.reduce_tensor(value, spec)
+
+        return reduced
 
+    @classmethod
+    def reduce_tensor(cls, activation: t.Tensor, spec: ActivationReduction) -> t.Tensor:
+        if spec.slice is not None:
+            activation = activation[to_py_slice(spec.slice)]
+        if spec.reduce is not None:
+            activation = reduce_activation(activation, spec.reduce)
+        return activation
+
+    @classmethod
+    def clean_cache(cls, cache: Cache):
+        """Filters the cache down to the components the frontend displays, as nested lists"""
+        cache_copy: dict[ModelComponentName, Float[list[float], "..."]] = {
+            key: value.tolist() for key, value in cls.filter_cache(cache).items()
+        }
         return cache_copy
     
-    def clean_logits(self, logits: Logits):
-        tokens: Integer[t.Tensor, "batch seq"] | Integer[t.Tensor, "seq"] = logits.argmax(dim=-1).squeeze()[:-1]
-        if tokens.dim() == 1:
-            tokens = tokens.unsqueeze(0)
+    def to_str_tokens(self, tokens: Integer[t.Tensor, "..."]) -> list:
+        """Vectorized detokenization of any shape of token ids into nested lists of strings"""
+        if self.vocab_strings is None:
+            self.vocab_strings = np.array(self.model.to_str_tokens(t.arange(self.model.cfg.d_vocab)), dtype=object)
+        return self.vocab_strings[tokens.cpu().numpy()].tolist()
+
+    def clean_predicted_tokens(self, logits: Logits):
+        tokens: Integer[t.Tensor, "batch seq"] = logits.argmax(dim=-1)[:, :-1]
 
         output_tokens: list[list[int]] = tokens.tolist()
-        sub_words: list[list[str]] = [self.model.to_str_tokens(t) for t in tokens]
-        output_logits: list[list[list[float]]] = logits.tolist()
+        sub_words: list[list[str]] = self.to_str_tokens(tokens)
+
+        return output_tokens, sub_words
+
+    def clean_predictions(self, logits: Logits, k: int):
+        """Top k next token predictions at each position with their probabilities and strings"""
+        probs, tokens = topk_logits(logits.detach().softmax(dim=-1), k)
+        return {
+            "tokens": tokens.tolist(),
+            "probs": probs.tolist(),
+            "subWords": self.to_str_tokens(tokens),
+        }
+
+    @classmethod
+    def clean_full_logits(cls, logits: Logits) -> list[list[list[float]]]:
+        return logits.tolist()
+
+    def clean_logits(self, logits: Logits):
+        output_tokens, sub_words = self.clean_predicted_tokens(logits)
+        output_logits = self.clean_full_logits(logits)
 
         return  output_tokens, sub_words, output_logits
 
@@ -266,28 +637,113 @@ class Modelling:
 
 ts = Modelling()
 
+# All model work happens one job at a time on this worker, so endpoints never race on `ts`
+worker = ModelWorker()
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Times every request and records its response size, labelled by the matched route's path"""
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get('route')
+    labels = {"path": getattr(route, 'path', None) or '/', "method": request.method}
+    request_seconds.observe(time.perf_counter() - start, **labels)
+    if 'content-length' in response.headers:
+        response_bytes.observe(int(response.headers['content-length']), **labels)
+    return response
+
+@app.get("/metrics")
+def metrics():
+    """Timings, counters and histograms in the Prometheus text format"""
+    return Response(content=registry.render(), media_type=METRICS_MEDIA_TYPE)
+
+@app.exception_handler(Superseded)
+def superseded_handler(request: Request, exc: Superseded):
+    return JSONResponse(status_code=409, content={"detail": str(exc)})
+
+
+@app.get("/api/status")
+def status():
+    """
+    Whether the current model is loaded and warmed up, and the phase and progress of its load and
+    any preloads, including those skipped for not fitting the model pool. Not run on the worker, so
+    it answers while a model is loading.
+
+    `jupyter` is whether a Jupyter server was started alongside (`transpector --jupyter` or
+    `--notebook`), the UI only shows its notebook panel when one is.
+    """
+    key = (ts.model_name, ts.precision)
+    return {
+        "ready": ts.models.resident(*key) is not None,
+        "modelName": ts.model_name,
+        "precision": ts.precision,
+        "jupyter": os.environ.get('TRANSPECTOR_JUPYTER') == '1',
+        "load": ts.models.load_progress(key),
+        "preloads": [ts.models.load_progress(loading) for loading in list(ts.models.loading) if loading != key],
+        "failed": [
+            ts.models.load_progress(failed) for failed, status in list(ts.models.load_status.items())
+            if status["phase"] == 'failed'
+        ],
+        "skipped": [
+            ts.models.load_progress(skipped) for skipped, status in list(ts.models.load_status.items())
+            if status["phase"] == 'skipped'
+        ],
+    }
 
 @app.get("/api/models/getModels")
 def get_models(): 
-    return ts.available_models
+    return get_available_models()
 
 @app.get("/api/models/getModelConfig/{model_name}")
-def get_model_config(model_name: str): 
+def model_config(model_name: str): 
     return {
-        "config": get_pretrained_model_config(model_name),
+        "config": get_model_config(model_name),
         "sessionConfig": ts.session_config 
     }
 
 class ModelItem(BaseModel):
     model_name: str
+    precision: Precision = 'float32' # Reduced precisions trade accuracy for speed and memory, see `/api/models/fidelity`
+    cache_dtype: Optional[CacheDType] = None
 
 @app.put("/api/models/setModel")
+@worker.endpoint()
 def set_models(model_name: ModelItem):
-    print(f'Loading model: {model_name.model_name}')
-    ts.set_model(model_name.model_name)
-    print('Loaded model')
+    ts.set_model(model_name.model_name, model_name.precision, model_name.cache_dtype)
     return {"Loaded model": model_name}
 
+@app.put("/api/models/preloadModel")
+def preload_model(model_name: ModelItem):
+    """Loads a model in the background so a later `setModel` to it doesn't have to wait"""
+    ts.models.preload(model_name.model_name, model_name.precision)
+    return ts.models.status()
+
+@app.get("/api/models/pool")
+def model_pool_status():
+    return ts.models.status()
+
+class FidelityItem(BaseModel):
+    prompts: Optional[list[str]] = None # Defaults to the last tokenized prompt
+
+@app.put("/api/models/fidelity")
+@worker.endpoint()
+def model_fidelity(input: FidelityItem):
+    """Per token loss delta of the current model's precision against float32"""
+    losses, baseline_losses, real_positions = ts.precision_fidelity(input.prompts or ts.last_prompt)
+    delta = losses - baseline_losses
+    real_delta = delta[real_positions]
+
+    return {
+        "modelName": ts.model_name,
+        "precision": ts.precision,
+        "tokenLoss": ts.clean_token_loss(losses),
+        "baselineTokenLoss": ts.clean_token_loss(baseline_losses),
+        "tokenLossDelta": ts.clean_token_loss(delta),
+        "meanLossDelta": ts.clean_loss(real_delta.mean()),
+        "meanAbsLossDelta": ts.clean_loss(real_delta.abs().mean()),
+        "maxAbsLossDelta": ts.clean_loss(real_delta.abs().max()),
+    }
+
 class InputStringListItem(BaseModel):
     input: list[str]
 
@@ -295,92 +751,580 @@ class InputIntListItem(BaseModel):
     input: list[int]
 
 @app.put("/api/tokenize/toStringTokens")
+@worker.endpoint()
 def tokenize_to_string_tokens(inputItem: InputStringListItem):
     return {"stringTokens": ts.model.to_str_tokens(inputItem.input)}
 
 @app.put("/api/tokenize/toTokens")
+@worker.endpoint()
 def tokenize_to_tokens(inputItem: InputStringListItem):
     ts.last_prompt = inputItem.input
-    tokens: list[list[int]] = ts.model.to_tokens(inputItem.input).tolist()
-    print('tokenizing', inputItem.input, 'to', tokens)
+    with span('tokenize'):
+        tokens: list[list[int]] = ts.model.to_tokens(inputItem.input).tolist()
     return {"tokens": tokens}
 
 @app.put("/api/tokenize/toString")
+@worker.endpoint()
 def tokenize_to_string(inputItem: InputIntListItem):
     return {"string": ts.model.to_tokens(inputItem.input)}
 
 
+class InferenceRunItem(BaseModel):
+    format: ResponseFormat = 'json'
+    dtype: BinaryDType = 'float32'
+    lazy: bool = False
+    predictionsTopK: int = 5 # Number of next token predictions to send per position
+    fullLogits: bool = False # Send the full vocab logits, otherwise they're fetched from `/api/inference/logits`
+    logitsTopK: Optional[int] = None # Only send the top k logits at each position
+    reductions: Optional[dict[str, ActivationReduction]] = None # See `Modelling.reduce_cache`
+    components: Optional[list[str]] = None # Hook names or glob patterns to capture and send, all when None
+
 @app.get("/api/inference/run")
-def inference_run():
+@worker.endpoint(supersede='inference')
+def inference_run(
+    request: Request,
+    response_format: ResponseFormat = Query('json', alias='format'),
+    dtype: BinaryDType = 'float32',
+    lazy: bool = False,
+    predictionsTopK: int = 5,
+    fullLogits: bool = False,
+    logitsTopK: Optional[int] = None,
+    components: Optional[list[str]] = Query(None),
+):
+    return run_inference(InferenceRunItem(
+        format=response_format,
+        dtype=dtype,
+        lazy=lazy,
+        predictionsTopK=predictionsTopK,
+        fullLogits=fullLogits,
+        logitsTopK=logitsTopK,
+        components=components,
+    ))
+
+@app.put("/api/inference/run")
+@worker.endpoint(supersede='inference')
+def inference_run_with_options(request: Request, options: InferenceRunItem):
+    return run_inference(options)
+
+def run_inference(options: InferenceRunItem):
+    """
+    Runs the last tokenized prompt through the model with all ablations and patches applied
+
+    With `format=binary` the activations and logits are sent as raw `dtype` buffers (see
+    `encode_binary`) and all other fields are carried in the binary header's meta dict.
+
+    With `lazy` no activations or logits are sent, only the run id and the name, shape and
+    dtype of each activation. Activations are then fetched on demand from
+    `/api/inference/activation`.
+
+    Logits are summarised as the top `predictionsTopK` next token predictions per position, the
+    full logits are only sent with `fullLogits`, or as just the top k logits with `logitsTopK`
+    (alongside their token ids in `logitIndices`). With `reductions` activations are sliced and
+    reduced before being sent. With `components` only the matching hook points are captured during
+    the forward pass and sent, which saves memory and copies for hook points the client never shows.
+
+    Results are cached on the model, tokens and interventions (see `Modelling.run_cached`) along
+    with the encoded response for each set of options, so repeated runs return immediately.
+    """
     prompt = ts.last_prompt
-    sub_words = ts.model.to_str_tokens(prompt)
-
-    logits, loss, cache = ts.run_with_hooks(prompt)
-    print('logtis are')
-    print(logits)
-    out_cache = ts.clean_cache(cache)
-    out_tokens, out_sub_words, out_logits = ts.clean_logits(logits)
-    out_final_loss = ts.clean_loss(loss)
-    out_token_loss = ts.clean_token_loss(per_token_losses(logits, ts.model.to_tokens(prompt)))
-    return {
-        "activationData": out_cache,
+    record = ts.run_cached(prompt, components=options.components)
+    options_key = json.dumps(options.dict(), sort_keys=True)
+
+    cached = ts.result_cache.get(record["key"])
+    if cached is not None and options_key in cached.responses:
+        return Response(
+            content=cached.responses[options_key],
+            media_type=BINARY_MEDIA_TYPE if options.format == 'binary' else 'application/json',
+        )
+
+    response = encode_inference_response(record, options)
+    ts.result_cache.add_response(record["key"], options_key, response.body)
+    return response
+
+def inference_meta(record: RunRecord, predictions_top_k: int):
+    """Everything about a run the frontend needs other than its activations and logits"""
+    prompt, logits, loss = record["prompt"], record["logits"], record["loss"]
+
+    with span('meta'):
+        sub_words = ts.model.to_str_tokens(prompt)
+        out_tokens, out_sub_words = ts.clean_predicted_tokens(logits)
+        out_final_loss = ts.clean_loss(loss)
+        out_token_loss = ts.clean_token_loss(per_token_losses(logits, record["tokens"])[0])
+        return {
+            "runId": record["runId"],
+            "inferencePrompt": prompt,
+            "inferenceSubWords": sub_words,
+            "tokens": out_tokens,
+            "subWords": out_sub_words,
+            "finalLoss": out_final_loss,
+            "tokenLoss": out_token_loss,
+            "predictions": ts.clean_predictions(logits, predictions_top_k),
+        }
+
+def encode_inference_response(record: RunRecord, options: InferenceRunItem) -> Response:
+    logits = record["logits"]
+    meta = inference_meta(record, options.predictionsTopK)
+
+    activations = ts.select_components(ts.filter_cache(record["cache"]), options.components)
+    if options.reductions is not None:
+        activations = ts.reduce_cache(activations, options.reductions)
+
+    if options.lazy:
+        return JSONResponse({
+            **meta,
+            "activationMeta": {
+                key: {"shape": list(value.shape), "dtype": str(value.dtype).removeprefix('torch.')}
+                for key, value in activations.items()
+            },
+        })
+
+    out_logits: dict[str, t.Tensor] = {}
+    if options.logitsTopK is not None:
+        out_logits["logits"], logit_indices = topk_logits(logits, options.logitsTopK)
+        meta["logitIndices"] = logit_indices.tolist()
+    elif options.fullLogits:
+        out_logits["logits"] = logits
+
+    if options.format == 'binary':
+        tensors = {**activations, **out_logits}
+        with span('encode'):
+            return Response(content=encode_binary(tensors, meta, options.dtype), media_type=BINARY_MEDIA_TYPE)
+
+    with span('toList'):
+        content = {
+            **meta,
+            "activationData": ts.clean_cache(activations),
+            **{key: ts.clean_full_logits(value) for key, value in out_logits.items()},
+        }
+    with span('encode'):
+        return JSONResponse(content)
+
+@app.get("/api/inference/stream")
+async def inference_stream(
+    request: Request,
+    predictionsTopK: int = 5,
+    components: Optional[list[str]] = Query(None),
+):
+    """
+    Runs the last tokenized prompt like `/api/inference/run`, streaming the results as Server-Sent
+    Events so the frontend can render each block as soon as it has been computed
+
+    Events, each with a JSON data line:
+        start: {"inferencePrompt", "inferenceSubWords", "nLayers"}
+        block: {"layer", "activationData"} once per block, in order
+        done: the same fields as `/api/inference/run` with the final layer norm as "activationData"
+        error: {"status", "detail"} when the run fails or is superseded by a newer run
+    """
+    events = worker.stream(stream_inference, predictionsTopK, components, supersede_key=(client_id(request), 'inference'))
+
+    async def event_stream():
+        try:
+            async for event in events:
+                yield event
+        except Superseded as e:
+            yield sse_event('error', {"status": 409, "detail": str(e)})
+        except HTTPException as e:
+            yield sse_event('error', {"status": e.status_code, "detail": e.detail})
+
+    return StreamingResponse(event_stream(), media_type=SSE_MEDIA_TYPE, headers={"Cache-Control": "no-cache"})
+
+def stream_inference(emit: Callable[[str], None], predictions_top_k: int, components: Optional[list[str]]) -> str:
+    """Runs on the model worker, emitting an event per block from inside the forward pass"""
+    prompt = ts.last_prompt
+    emit(sse_event('start', {
         "inferencePrompt": prompt,
-        "inferenceSubWords": sub_words,
-        "logits": out_logits,
-        "tokens": out_tokens,
-        "subWords": out_sub_words,
-        "finalLoss": out_final_loss,
-        "tokenLoss": out_token_loss,
+        "inferenceSubWords": ts.model.to_str_tokens(prompt),
+        "nLayers": ts.model.cfg.n_layers,
+    }))
+
+    def on_block(layer: int, activations: Cache):
+        activations = ts.select_components(activations, components)
+        emit(sse_event('block', {"layer": layer, "activationData": ts.clean_cache(activations)}))
+
+    record = ts.run_cached(prompt, on_block=on_block, components=components)
+    final_activations = ts.select_components(ts.block_activations(record["cache"], ts.model.cfg.n_layers), components)
+    return sse_event('done', {
+        **inference_meta(record, predictions_top_k),
+        "activationData": ts.clean_cache(final_activations),
+    })
+
+@app.get("/api/inference/logits/{run_id}")
+@worker.endpoint()
+def inference_logits(
+    run_id: RunId,
+    response_format: ResponseFormat = Query('json', alias='format'),
+    dtype: BinaryDType = 'float32',
+):
+    """Full vocab logits of a stored run"""
+    logits = ts.get_run(run_id)["logits"]
+    if response_format == 'binary':
+        return Response(content=encode_binary({"logits": logits}, {"runId": run_id}, dtype), media_type=BINARY_MEDIA_TYPE)
+
+    return {"runId": run_id, "logits": ts.clean_full_logits(logits)}
+
+class InferenceBatchItem(BaseModel):
+    prompts: list[str]
+    predictionsTopK: int = 5
+    includeActivations: bool = False
+    reductions: Optional[dict[str, ActivationReduction]] = None # See `Modelling.reduce_cache`
+
+@app.put("/api/inference/batch")
+@worker.endpoint(supersede='batch')
+def inference_batch(request: Request, input: InferenceBatchItem):
+    """
+    Runs many prompts padded together in one forward pass, with results per prompt trimmed to
+    each prompt's real length
+
+    The padded run is stored under `runId`, so activations of prompt `i` can also be fetched from
+    `/api/inference/activation` with a slice starting [[i, i+1], ...].
+    """
+    record = ts.run_cached(input.prompts)
+    logits, tokens = record["logits"], record["tokens"]
+
+    token_losses = per_token_losses(logits, tokens)
+    predictions = ts.clean_predictions(logits, input.predictionsTopK)
+    sub_words = ts.to_str_tokens(tokens)
+    activations = ts.filter_cache(record["cache"]) if input.includeActivations or input.reductions else {}
+
+    results = []
+    for i, (prompt, positions) in enumerate(zip(input.prompts, ts.prompt_positions(record))):
+        positions_list = positions.tolist()
+        prompt_token_losses = token_losses[i, positions[1:] - 1]
+        result = {
+            "prompt": prompt,
+            "batchIndex": i,
+            "inputTokens": tokens[i, positions].tolist(),
+            "inputSubWords": [sub_words[i][p] for p in positions_list],
+            "tokenLoss": ts.clean_token_loss(prompt_token_losses),
+            "finalLoss": ts.clean_loss(prompt_token_losses.mean()),
+            "predictions": {key: [value[i][p] for p in positions_list] for key, value in predictions.items()},
+        }
+        if activations:
+            prompt_activations = {
+                name: select_positions(name, value[i:i + 1], positions) for name, value in activations.items()
+            }
+            if input.reductions is not None:
+                prompt_activations = ts.reduce_cache(prompt_activations, input.reductions)
+            result["activationData"] = ts.clean_cache(prompt_activations)
+        results.append(result)
+
+    return {"runId": record["runId"], "results": results}
+
+class InputActivationItem(BaseModel):
+    runId: RunId
+    hookName: HookName
+    slice: Optional[TensorSlice] = None
+    reduce: Optional[Reduction] = None
+    format: ResponseFormat = 'json'
+    dtype: BinaryDType = 'float32'
+
+@app.put("/api/inference/activation")
+@worker.endpoint()
+def inference_activation(input: InputActivationItem):
+    """Fetches a single (optionally sliced and reduced) activation from a stored run"""
+    cache = ts.get_run(input.runId)["cache"]
+    if input.hookName not in cache:
+        raise HTTPException(status_code=404, detail=f"Activation not cached for run: {input.hookName}")
+
+    activation = ts.reduce_tensor(cache[input.hookName], ActivationReduction(slice=input.slice, reduce=input.reduce))
+
+    meta = {"runId": input.runId, "hookName": input.hookName, "slice": input.slice, "reduce": input.reduce}
+    if input.format == 'binary':
+        return Response(
+            content=encode_binary({input.hookName: activation}, meta, input.dtype), media_type=BINARY_MEDIA_TYPE
+        )
+
+    return {
+        **meta,
+        "shape": list(activation.shape),
+        "activation": activation.tolist(),
     }
     
+@app.get("/api/inference/runs")
+@worker.endpoint()
+def inference_runs():
+    """Runs held in the activation store, oldest first, and the run interventions read from"""
+    reference = ts.reference_run()
+    return {
+        **ts.activations.status(),
+        "referenceRunId": reference["runId"] if reference is not None else None,
+        "referenceRunPinned": ts.reference_run_id is not None,
+    }
+
+class ReferenceRunItem(BaseModel):
+    runId: Optional[RunId] = None # None follows the latest run
+
+@app.put("/api/inference/referenceRun")
+@worker.endpoint()
+def set_reference_run(input: ReferenceRunItem):
+    """Pins the run freeze ablations and patch sources read their activations from"""
+    if input.runId is not None:
+        ts.get_run(input.runId)
+    ts.reference_run_id = input.runId
+    return {"referenceRunId": input.runId}
+
+class PatchingSweepItem(BaseModel):
+    cleanPrompt: str
+    corruptedPrompt: str
+    sweep: SweepType = 'layerPosition'
+    component: Union[PositionComponent, HeadComponent] = 'resid_pre' # Position components for layerPosition, head components for layerHead
+    metric: SweepMetric = 'logitDiff'
+    correctAnswer: str # Single token answers the metric is measured on
+    incorrectAnswer: Optional[str] = None # Required for logitDiff
+    batchSize: int = 32 # Cells patched per forward pass
+
+@app.put("/api/analysis/patchingSweep")
+@worker.endpoint()
+def analysis_patching_sweep(input: PatchingSweepItem):
+    """
+    Patches the clean prompt's activations into the corrupted prompt at every (layer, position)
+    or (layer, head) and returns the metric of each as a heatmap, see `patching_sweep`
+
+    `normalized` rescales each cell so 0 is the corrupted run and 1 the clean run. The current
+    ablations and patches aren't applied.
+    """
+    position_sweep = input.sweep == 'layerPosition'
+    if position_sweep != (input.component in get_args(PositionComponent)):
+        raise HTTPException(status_code=400, detail=f"Component {input.component} can't be swept by {input.sweep}")
+    if input.metric == 'logitDiff' and input.incorrectAnswer is None:
+        raise HTTPException(status_code=400, detail="logitDiff needs an incorrectAnswer")
+
+    try:
+        correct_token = ts.model.to_single_token(input.correctAnswer)
+        incorrect_token = ts.model.to_single_token(input.incorrectAnswer) if input.incorrectAnswer is not None else None
+        results, clean_metric, corrupted_metric = patching_sweep(
+            ts.model,
+            ts.model.to_tokens(input.cleanPrompt),
+            ts.model.to_tokens(input.corruptedPrompt),
+            input.sweep,
+            input.component,
+            input.metric,
+            correct_token,
+            incorrect_token,
+            max(1, input.batchSize),
+        )
+    except (AssertionError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {
+        "sweep": input.sweep,
+        "component": input.component,
+        "metric": input.metric,
+        "labels": ts.model.to_str_tokens(input.cleanPrompt) if position_sweep else list(range(results.shape[1])),
+        "results": results.tolist(),
+        "normalized": ((results - corrupted_metric) / (clean_metric - corrupted_metric or 1.0)).tolist(),
+        "cleanMetric": clean_metric,
+        "corruptedMetric": corrupted_metric,
+    }
+
+class AttributionItem(BaseModel):
+    prompt: str
+    corruptedPrompt: Optional[str] = None # Attributes patching the prompt into this, otherwise zero ablating the prompt
+    metric: AttributionMetric = 'loss'
+    correctAnswer: Optional[str] = None # Single token answers, needed by logitDiff and logProb
+    incorrectAnswer: Optional[str] = None # Needed by logitDiff
+    components: Optional[list[str]] = None # Hook names or glob patterns, the displayed hook points when None
+
+@app.put("/api/analysis/attribution")
+@worker.endpoint()
+def analysis_attribution(input: AttributionItem):
+    """
+    Attribution patching: the effect of patching (or zero ablating) every activation on the metric,
+    approximated linearly from one forward and one backward pass, see `attribution_patching`
+
+    With a corrupted prompt the gradients are taken on the corrupted run and the effects are of
+    patching in the prompt's activations, otherwise the effects are of zero ablating each
+    activation of the prompt. The current ablations and patches are applied to every run.
+    """
+    if input.metric != 'loss' and input.correctAnswer is None:
+        raise HTTPException(status_code=400, detail=f"{input.metric} needs a correctAnswer")
+    if input.metric == 'logitDiff' and input.incorrectAnswer is None:
+        raise HTTPException(status_code=400, detail="logitDiff needs an incorrectAnswer")
+
+    def metric(logits: Logits, loss: t.Tensor) -> t.Tensor:
+        if input.metric == 'loss':
+            return loss
+        return answer_metric(logits, input.metric, correct_token, incorrect_token).sum()
+
+    try:
+        correct_token = ts.model.to_single_token(input.correctAnswer) if input.correctAnswer is not None else 0
+        incorrect_token = ts.model.to_single_token(input.incorrectAnswer) if input.incorrectAnswer is not None else None
+    except AssertionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    tokens = ts.model.to_tokens(input.prompt)
+    names = [
+        name for name in ts.model.hook_dict
+        if (ts.is_displayed(name) if input.components is None else any(fnmatchcase(name, p) for p in input.components))
+    ]
+
+    clean_cache, clean_metric = None, None
+    if input.corruptedPrompt is not None:
+        corrupted_tokens = ts.model.to_tokens(input.corruptedPrompt)
+        if corrupted_tokens.shape != tokens.shape:
+            raise HTTPException(status_code=400, detail="Prompt and corrupted prompt must have the same number of tokens")
+        ts.activations.begin()
+        clean_logits, clean_loss, clean_cache = ts.run_with_hooks(tokens, names_filter=names)
+        clean_metric = metric(clean_logits, clean_loss).item()
+        tokens = corrupted_tokens
+
+    ts.activations.begin()
+    logits, loss, cache = ts.run_with_hooks(tokens, names_filter=names, incl_bwd=True, backward_metric=metric)
+    gradients = {name.removesuffix('_grad'): value for name, value in cache.items() if name.endswith('_grad')}
+    effects = attribution_patching(cache, gradients, clean_cache)
+
+    return {
+        "metric": input.metric,
+        "baseline": "corrupted" if clean_cache is not None else "zero",
+        "metricValue": metric(logits.detach(), loss.detach()).item(),
+        "cleanMetricValue": clean_metric,
+        "attributions": {name: effect[0].tolist() for name, effect in effects.items()},
+    }
+
+LENS_COMPONENTS = [
+    'hook_embed', 'hook_pos_embed', 'blocks.*.hook_resid_post', 'blocks.*.attn.hook_z', 'blocks.*.hook_mlp_out',
+    'ln_final.hook_scale',
+]
+
+class LensItem(BaseModel):
+    prompts: Optional[list[str]] = None # Defaults to the last tokenized prompt
+    targets: list[str] = [] # Single token strings to read the logits of
+    topK: int = 5 # Top predictions per layer and position, logit lens only
+
+def lens_run(input: LensItem) -> tuple[RunRecord, list[int]]:
+    """
+    Run of the prompts with the current ablations and patches, capturing what the logit lens and
+    direct logit attribution read, and the target token ids
+    """
+    try:
+        target_tokens = [ts.model.to_single_token(target) for target in input.targets]
+    except AssertionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return ts.run_cached(input.prompts or ts.last_prompt, components=LENS_COMPONENTS), target_tokens
+
+@app.put("/api/analysis/logitLens")
+@worker.endpoint()
+def analysis_logit_lens(input: LensItem):
+    """
+    Logit lens over every block's residual stream, see `logit_lens`. Only the target tokens' log
+    probs and the top k predictions are sent, not the activations.
+    """
+    record, target_tokens = lens_run(input)
+    target_log_probs, top_log_probs, top_tokens = logit_lens(ts.model, record["cache"], target_tokens, input.topK)
+
+    return {
+        "runId": record["runId"],
+        "targets": input.targets,
+        "targetLogProbs": target_log_probs.tolist(), # [batch layer pos targets]
+        "topLogProbs": top_log_probs.tolist(), # [batch layer pos k]
+        "topTokens": ts.to_str_tokens(top_tokens), # [batch layer pos k]
+    }
+
+@app.put("/api/analysis/directLogitAttribution")
+@worker.endpoint()
+def analysis_direct_logit_attribution(input: LensItem):
+    """
+    Direct logit attribution of the target tokens to the embeddings, every head and every MLP, see
+    `direct_logit_attribution`
+    """
+    record, target_tokens = lens_run(input)
+    embed, heads, mlps = direct_logit_attribution(ts.model, record["cache"], target_tokens)
+
+    return {
+        "runId": record["runId"],
+        "targets": input.targets,
+        "logits": record["logits"][..., target_tokens].float().tolist(), # [batch pos targets]
+        "embed": embed.tolist(), # [batch pos targets]
+        "heads": heads.tolist(), # [batch layer head pos targets]
+        "mlps": mlps.tolist() if mlps is not None else None, # [batch layer pos targets]
+    }
+
 class InputAblationState(BaseModel):
     ablations: AblationsType
     clientLogicalClock: int
 
 
 @app.put("/api/ablation/sync")
+@worker.endpoint()
 def ablation_sync(input: InputAblationState):
 
     if input.clientLogicalClock >= ts.logical_clock:
         ts.logical_clock += 1
+        ts.ablations = input.ablations
+        ts.interventions.compile(ts.ablations, ts.patches)
 
-        temp_hooks_list: list[tuple[int, Hook]] = []
+    return {
+        "server_logical_clock": ts.logical_clock,
+        "ablations": ts.ablations
+    }
 
-        for transformer_component_name, component_slices in input.ablations.items():
-            print('transformer comp', transformer_component_name)
-            print('transformer comp', component_slices)
 
-            for _target_sub_component, hook_config in component_slices.items():
-                print('hook config', hook_config)
-                ablation_hook = partial(
-                    ts.ablation_hook,
-                    slices=hook_config['slice'],
-                    ablation_type=hook_config['ablationType']
-                )
-                # Create a tuple with ablationType priority as the first element and the hook as the second
-                hook_tuple = (ablation_priority[hook_config['ablationType']], (transformer_component_name, ablation_hook))
-                
-                # Use insort to insert the tuple in the correct place in the list
-                insort(temp_hooks_list, hook_tuple, key=lambda x: x[0])
+class AblationOp(BaseModel):
+    op: DeltaOpType
+    component: ModelComponentName
+    sliceId: SliceName
+    value: Optional[AblationSliceComponents] = None
 
-                ts.fwd_ablation_hooks.append((transformer_component_name, ablation_hook)) # TODO, can kill this line?
+class InputAblationDelta(BaseModel):
+    ops: list[AblationOp]
+    clientLogicalClock: int
 
-        # Reassign fwd_ablation_hooks to contain only the second element of each tuple (preserving the original format)
-        ts.fwd_ablation_hooks = [hook for _, hook in temp_hooks_list]
+@app.put("/api/ablation/delta")
+@worker.endpoint()
+def ablation_delta(input: InputAblationDelta):
+    """
+    Applies add, remove and update ops to the ablations, recompiling only the hook points they
+    touch, see `intervention_delta`
+    """
+    def touched_hooks(slices: dict[tuple[ModelComponentName, SliceName], Any]) -> set[HookName]:
+        return {component for component, _slice_id in slices}
 
-        ts.ablations = input.ablations
+    delta = intervention_delta(input.ops, input.clientLogicalClock, ts.ablations, touched_hooks)
+    if delta is not None:
+        ts.ablations, hook_names = delta
+        ts.interventions.recompile(ts.ablations, ts.patches, hook_names)
 
     return {
         "server_logical_clock": ts.logical_clock,
-        "ablations": ts.ablations
+        "applied": delta is not None,
+        **({} if delta is not None else {"ablations": ts.ablations}),
     }
 
+def intervention_delta(
+        ops: Sequence[BaseModel],
+        client_logical_clock: int,
+        state: dict[ModelComponentName, dict[SliceName, Any]],
+        touched_hooks: Callable[[dict[tuple[ModelComponentName, SliceName], Any]], set[HookName]],
+):
+    """
+    Applies delta ops to the ablation or patch state, returning the new state and the hook points
+    whose plans have to be recompiled, those `touched_hooks` finds in the touched slices before
+    and after the ops
+
+    Like a full sync, ops are only applied when the client has seen the latest state
+    (`clientLogicalClock` isn't behind the server's), otherwise None is returned and the client
+    gets the full state back to resync from. Invalid ops (adding a slice that exists, or removing
+    or updating one that doesn't) are rejected with a 409 and none are applied.
+    """
+    if client_logical_clock < ts.logical_clock:
+        return None
+
+    try:
+        new_state, previous = apply_delta(state, [op.dict() for op in ops]) # type: ignore
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    ts.logical_clock += 1
+    current = {key: new_state.get(key[0], {}).get(key[1]) for key in previous}
+    return new_state, touched_hooks(previous) | touched_hooks(current)
+
 
 class InputPatchState(BaseModel):
     patches: PatchesType
     clientLogicalClock: int
 
 @app.put("/api/patch/sync")
+@worker.endpoint()
 def patch_sync(input: InputPatchState):
     """
     Sync hook patches between frontend and backend code
@@ -395,38 +1339,143 @@ def patch_sync(input: InputPatchState):
 
     if input.clientLogicalClock >= ts.logical_clock:
         ts.logical_clock += 1
+        ts.patches = input.patches
+        ts.interventions.compile(ts.ablations, ts.patches)
 
-        temp_hooks_list: list[Hook] = []
+    return {
+        "server_logical_clock": ts.logical_clock,
+        "patches": ts.patches
+    }
 
-        for source_component_name, source_slices in input.patches.items():
-            print('transformer comp', source_component_name)
-            print('transformer comp', source_slices)
+class PatchOp(BaseModel):
+    op: DeltaOpType
+    component: ModelComponentName # The patch source
+    sliceId: SliceName
+    value: Optional[PatchSliceComponents] = None # The source slice and every edge from it
 
-            for _source_slice_id, source_slice_info in source_slices.items():
-                print('hook config', source_slice_info)
+class InputPatchDelta(BaseModel):
+    ops: list[PatchOp]
+    clientLogicalClock: int
 
-                for target_component_name, target_slices in source_slice_info['edges'].items():
-                    for _target_slice_id, target_slice_config in target_slices.items():
+@app.put("/api/patch/delta")
+@worker.endpoint()
+def patch_delta(input: InputPatchDelta):
+    """
+    Applies add, remove and update ops to the patches, keyed by source component and slice, see
+    `intervention_delta`. Only the target hook points of the touched source slices are recompiled.
+    """
+    def touched_hooks(slices: dict[tuple[ModelComponentName, SliceName], Any]) -> set[HookName]:
+        return {target for value in slices.values() if value is not None for target in value['edges']}
 
-                        # When creating a patch we want to read from the source and transfer the
-                        # activations to the target, so the hook has to be triggered on the
-                        # target's name not the sources
-                        patch_hook = partial(
-                            ts.patch_hook,
-                            source_component=source_component_name,
-                            source_slice=source_slice_info['slice'],
-                            target_component=target_component_name,
-                            target_slice=target_slice_config['slice']
-                        )
-                        temp_hooks_list.append((target_component_name, patch_hook))
+    delta = intervention_delta(input.ops, input.clientLogicalClock, ts.patches, touched_hooks)
+    if delta is not None:
+        ts.patches, hook_names = delta
+        ts.interventions.recompile(ts.ablations, ts.patches, hook_names)
 
-        ts.fwd_patch_hooks = temp_hooks_list
+    return {
+        "server_logical_clock": ts.logical_clock,
+        "applied": delta is not None,
+        **({} if delta is not None else {"patches": ts.patches}),
+    }
 
-        ts.patches = input.patches
+class SessionItem(BaseModel):
+    name: str # Letters, digits, '_', '-' and '.'
+
+class SaveSessionItem(SessionItem):
+    runIds: Optional[list[RunId]] = None # Runs to save, the reference run when None
+    components: Optional[list[str]] = None # Hook names or glob patterns of the activations to save, all when None
+
+def named_session(name: str):
+    try:
+        return session_path(name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.put("/api/session/save")
+@worker.endpoint()
+def session_save(input: SaveSessionItem):
+    """
+    Saves the session to disk: the model, last prompt, ablations and patches, and stored runs with
+    the activations of the selected components, see `save_session`
+    """
+    path = named_session(input.name)
+    if input.runIds is None:
+        reference = ts.reference_run()
+        records = [reference] if reference is not None else []
+    else:
+        records = [ts.get_run(run_id) for run_id in input.runIds]
+
+    hooks, captured = {}, {}
+    for record in records:
+        hooks[record["runId"]] = [
+            name for name in record["cache"]
+            if input.components is None or any(fnmatchcase(name, pattern) for pattern in input.components)
+        ]
+        # The saved hook points cover the requested patterns the run had captured all of
+        captured[record["runId"]] = record["captured"] if input.components is None else sorted({
+            *hooks[record["runId"]], *(pattern for pattern in input.components if covers(record["captured"], [pattern]))
+        })
+
+    save_session(path, {
+        "modelName": ts.model_name,
+        "precision": ts.precision,
+        "cacheDType": ts.cache_dtype,
+        "lastPrompt": ts.last_prompt,
+        "ablations": ts.ablations,
+        "patches": ts.patches,
+        "logicalClock": ts.logical_clock,
+        "referenceRunId": ts.reference_run_id,
+    }, records, hooks, captured)
+    return session_summary(input.name, read_manifest(path))
+
+@app.put("/api/session/load")
+@worker.endpoint()
+def session_load(input: SessionItem):
+    """
+    Restores a saved session, switching to its model if needed
+
+    Saved runs go back in the activation store memory mapped from the session's files, so their
+    activations are read from disk as they're used rather than recomputed, and running a saved
+    prompt with the saved interventions again returns the saved run.
+    """
+    path = named_session(input.name)
+    if not (path / MANIFEST_FILE).exists():
+        raise HTTPException(status_code=404, detail=f"Unknown session: {input.name}")
+    try:
+        manifest = read_manifest(path)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if (manifest["modelName"], manifest["precision"], manifest["cacheDType"]) != (ts.model_name, ts.precision, ts.cache_dtype):
+        ts.set_model(manifest["modelName"], manifest["precision"], manifest["cacheDType"])
+
+    ts.last_prompt = manifest["lastPrompt"]
+    ts.ablations = manifest["ablations"]
+    ts.patches = manifest["patches"]
+    ts.interventions.compile(ts.ablations, ts.patches)
+    # Ahead of every client, so they take the loaded state on their next sync
+    ts.logical_clock = max(ts.logical_clock, manifest["logicalClock"]) + 1
+
+    for run in manifest["runs"]:
+        record = load_session_run(path, run, ts.model.cfg.device)
+        ts.activations.put_mapped(record, path / run["file"])
+        ts.result_cache.put(record["key"], record["runId"])
+        ts.latest_run_ids[(record["modelName"], record["precision"])] = record["runId"]
+    reference_run_id = manifest["referenceRunId"]
+    ts.reference_run_id = reference_run_id if reference_run_id in ts.activations.runs else None
 
     return {
+        **session_summary(input.name, manifest),
         "server_logical_clock": ts.logical_clock,
-        "patches": ts.patches
+        "ablations": ts.ablations,
+        "patches": ts.patches,
     }
 
-app.mount("/", StaticFiles(directory="/frontend_dist", html=True), name="out")
+@app.get("/api/session/list")
+def session_list():
+    """Saved sessions, newest first"""
+    directory = sessions_dir()
+    paths = sorted(directory.glob(f'*/{MANIFEST_FILE}'), key=lambda path: path.stat().st_mtime, reverse=True) if directory.exists() else []
+    return [session_summary(path.parent.name, read_manifest(path.parent)) for path in paths]
+
+app.mount("/", StaticFiles(directory=join(dirname(__file__), 'frontend_dist'), html=True), name="out")
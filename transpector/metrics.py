@@ -0,0 +1,155 @@
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Iterator, Sequence
+
+LabelValues = tuple[str, ...]
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = tuple(float(4**n * 1024) for n in range(11)) # 1KiB to 1GiB
+
+METRICS_MEDIA_TYPE = 'text/plain; version=0.0.4' # Responses add the charset
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Metric(ABC):
+    kind = ''
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+
+    def label_values(self, labels: dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} takes labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    @abstractmethod
+    def samples(self) -> list[str]:
+        ...
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}', *self.samples()])
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        super().__init__(name, help, label_names)
+        self.values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            values = dict(self.values)
+        return [f'{self.name}{format_labels(self.label_names, key)} {value}' for key, value in values.items()]
+
+
+class Histogram(Metric):
+    """Counts of observations under each bucket's upper bound, plus their sum and count"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = (), buckets: Sequence[float] = SECONDS_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: the (non cumulative) count of each bucket and of +Inf, the sum
+        self.values: dict[LabelValues, tuple[list[int], float]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self.label_values(labels)
+        with self.lock:
+            counts, total = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+
+        lines = []
+        names = (*self.label_names, 'le')
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip([*map(str, self.buckets), '+Inf'], counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{format_labels(names, (*key, bound))} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.label_names, key)} {total}')
+            lines.append(f'{self.name}_count{format_labels(self.label_names, key)} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric already registered: {metric.name}")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, label_names: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, label_names)) # type: ignore
+
+    def histogram(self, name: str, help: str, label_names: Sequence[str] = (), buckets: Sequence[float] = SECONDS_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, label_names, buckets)) # type: ignore
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text exposition format"""
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    'transpector_stage_seconds',
+    'Time spent in each stage of serving a request, stages can nest (forward includes interventions)',
+    ['stage'],
+)
+request_seconds = registry.histogram('transpector_request_seconds', 'Time to respond to each endpoint', ['path', 'method'])
+response_bytes = registry.histogram(
+    'transpector_response_bytes', 'Size of each endpoint\'s response bodies', ['path', 'method'], BYTES_BUCKETS
+)
+cached_bytes = registry.counter(
+    'transpector_cached_bytes_total', 'Bytes of activations cached by model runs, per hook point', ['hook']
+)
+runs = registry.counter(
+    'transpector_runs_total', 'Prompt runs by whether they were computed, resumed from a stored run, or stored', ['result']
+)
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """
+    Times a stage into `transpector_stage_seconds`. Times are wall clock on the calling thread, GPU
+    work that hasn't been waited on counts towards whichever later stage waits for it.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage=stage)
+
+
+def hook_label(hook_name: str) -> str:
+    """A hook name with its block number replaced, so hook points of every block share a label"""
+    return re.sub(r'^blocks\.\d+\.', 'blocks.*.', hook_name)
@@ -1,26 +1,114 @@
-from typing import Callable
-from transformer_lens import HookedTransformer, HookedTransformerConfig
+from contextlib import contextmanager
+from typing import Any, Callable, Literal, Optional
+from transformer_lens import HookedTransformer
 from transformer_lens.hook_points import HookPoint
-from transformer_lens.loading_from_pretrained import OFFICIAL_MODEL_NAMES, get_pretrained_model_config
-from jaxtyping import Float
+from transpector.quantization import quantize_int8
+from transpector.weight_cache import load_cached_model
+from jaxtyping import Float, Integer
 import torch as t
 import torch.nn.functional as F
 
 Logits = Float[t.Tensor, "batch position d_vocab"]
 Tokens = Float[t.Tensor, "batch position"]
+AttentionMask = Integer[t.Tensor, "batch position"]
 
-def get_available_models() -> list[HookedTransformerConfig]:
-    return [get_pretrained_model_config(m) for m in OFFICIAL_MODEL_NAMES]
+Reduction = Literal['norm', 'mean', 'max'] # Reductions over the last (d_model / d_head) dimension
 
-def load_model(model_name: str):
-    return HookedTransformer.from_pretrained(model_name)
+Precision = Literal['float32', 'float16', 'bfloat16', 'int8'] # int8 is weight only, computed in float32
+CacheDType = Literal['float32', 'float16', 'bfloat16'] # Dtypes cached activations can be stored in
+
+# Phases of loading a model, in the order they happen, see `ModelPool.status`
+LoadPhase = Literal['queued', 'loadingCached', 'loadingPretrained', 'savingCache', 'quantizing', 'warmingUp', 'ready', 'failed', 'skipped']
+PhaseCallback = Callable[[LoadPhase], None]
+
+def load_model(model_name: str, precision: Precision = 'float32', on_phase: Optional[PhaseCallback] = None) -> HookedTransformer:
+    if precision == 'int8':
+        model = load_cached_model(model_name, on_phase=on_phase) # type: ignore
+        if on_phase is not None:
+            on_phase('quantizing')
+        return quantize_int8(model)
+    return load_cached_model(model_name, {"dtype": precision}, on_phase) # type: ignore
+
+def warm_up(model: HookedTransformer):
+    """Runs a tiny forward pass so allocator and kernel setup happen before the first real run"""
+    with t.inference_mode():
+        model(t.zeros((1, 2), dtype=t.long, device=model.cfg.device))
+    if t.cuda.is_available():
+        t.cuda.synchronize()
     
 def per_token_losses(logits: Logits, tokens: Tokens):
     log_probs = F.log_softmax(logits, dim=-1)
     pred_log_probs = t.gather(log_probs[:, :-1], -1, tokens[:, 1:, None])[..., 0]
-    return -pred_log_probs[0]
+    return -pred_log_probs
+
+def position_dims(hook_name: str) -> tuple[int, ...]:
+    """Dimensions of a cached activation that index token positions, batch is always dimension 0"""
+    if hook_name.endswith(('hook_pattern', 'hook_attn_scores')):
+        return (2, 3) # [batch head query_pos key_pos]
+    return (1,)
+
+def select_positions(hook_name: str, activation: t.Tensor, positions: t.Tensor) -> t.Tensor:
+    """Keeps only the given token positions of a cached activation, e.g. to strip padding"""
+    for dim in position_dims(hook_name):
+        activation = activation.index_select(dim, positions.to(activation.device))
+    return activation
+
+def reduce_activation(activation: t.Tensor, reduction: Reduction) -> t.Tensor:
+    """
+    Reduces the last dimension of an activation, e.g. giving per-head norms for [batch pos head
+    d_head] tensors or per-position summaries for [batch pos d_model] tensors
+    """
+    if reduction == 'norm':
+        return activation.norm(dim=-1)
+    elif reduction == 'mean':
+        return activation.mean(dim=-1)
+    elif reduction == 'max':
+        return activation.max(dim=-1).values
+    raise ValueError(f"Unknown reduction: {reduction}")
+
+def topk_logits(logits: Logits, k: int):
+    """Top k logits (and their token ids) at each position"""
+    return logits.topk(min(k, logits.shape[-1]), dim=-1)
+
+def hook_layer(hook_name: str, n_layers: int) -> int:
+    """Index of the block a hook point belongs to, embeddings count as 0 and ln_final as n_layers"""
+    match hook_name.split('.'):
+        case ['blocks', blockno, *_]:
+            return int(blockno)
+        case ['ln_final', *_] | ['unembed', *_]:
+            return n_layers
+        case _:
+            return 0
+
+def to_py_slice(slices: list[list[int]]) -> tuple[slice, ...]:
+    """Converts a [[from, to], ...] slice (where `to` of -1 means the end) to a python slice"""
+    return tuple(slice(r0, r1 if r1!=-1 else None) for (r0, r1) in slices)
 
 def sliceByMinShape(*tensors: t.Tensor):
     return [slice(0, r) for r in min([t.shape for t in tensors])]
 
+@contextmanager
+def activation_grads_only(model: t.nn.Module):
+    """
+    Gradients flow to activations but not parameters for the duration, so a backward pass doesn't
+    allocate a gradient for every weight. Use with `input_grad_hooks` so activations need grads.
+    """
+    params = [p for p in model.parameters() if p.requires_grad]
+    for p in params:
+        p.requires_grad_(False)
+    try:
+        with t.enable_grad():
+            yield
+    finally:
+        for p in params:
+            p.requires_grad_(True)
+
+def requires_grad_hook(activation: t.Tensor, hook: HookPoint) -> t.Tensor:
+    return activation if activation.requires_grad else activation.detach().requires_grad_()
+
+# Makes the embeddings require grad, so the whole residual stream does without parameter grads
+input_grad_hooks: list[tuple[Any, Callable[..., Any]]] = [
+    (lambda name: name in ('hook_embed', 'hook_pos_embed'), requires_grad_hook),
+]
+
 pattern_hook_names_filter: Callable[[str], bool] = lambda name: name.endswith("pattern")
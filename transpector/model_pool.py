@@ -0,0 +1,219 @@
+import gc
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional, TypedDict
+from transformer_lens import HookedTransformer
+from transpector.catalog import estimate_model_bytes
+from transpector.model import LoadPhase, Precision, load_model, warm_up
+import torch as t
+
+
+PoolKey = tuple[str, Precision] # The same model at different precisions are separate entries
+
+# Rough share of a load done by the start of each phase, loading weights takes most of it
+PHASE_PROGRESS: dict[LoadPhase, float] = {
+    'queued': 0.0,
+    'loadingCached': 0.05,
+    'loadingPretrained': 0.05,
+    'savingCache': 0.7,
+    'quantizing': 0.8,
+    'warmingUp': 0.9,
+    'ready': 1.0,
+    'failed': 1.0,
+    'skipped': 1.0,
+}
+FINISHED_PHASES: tuple[LoadPhase, ...] = ('ready', 'failed', 'skipped')
+
+class LoadStatus(TypedDict):
+    phase: LoadPhase
+    started: float # time.monotonic() of when the load was asked for
+    phaseStarted: float
+    error: Optional[str]
+
+
+def model_nbytes(model: t.nn.Module) -> int:
+    return sum(p.numel() * p.element_size() for p in [*model.parameters(), *model.buffers()])
+
+
+class ModelPool:
+    """
+    Keeps recently used models resident under a memory budget so switching between them doesn't
+    reload weights, evicting the least recently used model first
+
+    Models can be preloaded on a background thread while another model is in use. Asking for a
+    model that is still preloading waits for that load instead of starting a second one. A preload
+    that won't fit beside the model in use, going by `estimate` before it's loaded or by its size
+    after, is skipped and left to load when it's asked for.
+
+    With `warm_up` every model runs a tiny forward pass once loaded, before it's handed out.
+    """
+
+    def __init__(
+            self,
+            max_bytes: int,
+            load: Callable[..., HookedTransformer] = load_model,
+            estimate: Callable[[str, Precision], int] = estimate_model_bytes,
+            warm_up: bool = True,
+    ):
+        self.max_bytes = max_bytes
+        self.load = load
+        self.estimate = estimate
+        self.warm_up = warm_up
+        self.models: OrderedDict[PoolKey, HookedTransformer] = OrderedDict()
+        self.loading: dict[PoolKey, Future[Optional[HookedTransformer]]] = {}
+        self.load_status: dict[PoolKey, LoadStatus] = {}
+        self.lock = threading.Lock()
+        self.preloader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='transpector-preload')
+
+    @property
+    def nbytes(self) -> int:
+        return sum(model_nbytes(model) for model in self.models.values())
+
+    def get(self, model_name: str, precision: Precision = 'float32') -> HookedTransformer:
+        """The model, loading it if it isn't resident and making it the most recently used"""
+        key = (model_name, precision)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+            loading = self.loading.get(key)
+
+        model = loading.result() if loading is not None else None
+        return self.add(key, model if model is not None else self.load_tracked(key))
+
+    def resident(self, model_name: str, precision: Precision = 'float32') -> Optional[HookedTransformer]:
+        """The model if it's resident, without loading it or changing the eviction order"""
+        with self.lock:
+            return self.models.get((model_name, precision))
+
+    def preload(self, model_name: str, precision: Precision = 'float32') -> Optional[Future[Optional[HookedTransformer]]]:
+        """
+        Starts loading a model in the background, None if it's already resident. The future's
+        result is None if the preload was skipped before loading.
+        """
+        key = (model_name, precision)
+        with self.lock:
+            if key in self.models:
+                return None
+            if key not in self.loading:
+                self.set_phase(key, 'queued')
+                self.loading[key] = self.preloader.submit(self.preload_model, key)
+            return self.loading[key]
+
+    def set_phase(self, key: PoolKey, phase: LoadPhase, error: Optional[str] = None):
+        now = time.monotonic()
+        status = self.load_status.get(key)
+        started = status["started"] if status is not None and status["phase"] not in FINISHED_PHASES else now
+        self.load_status[key] = {"phase": phase, "started": started, "phaseStarted": now, "error": error}
+
+    def load_tracked(self, key: PoolKey) -> HookedTransformer:
+        """Loads (and warms up) a model, recording the phase it's in for `status`"""
+        on_phase = lambda phase: self.set_phase(key, phase)
+        on_phase('queued')
+        try:
+            model = self.load(*key, on_phase=on_phase)
+            if self.warm_up:
+                on_phase('warmingUp')
+                warm_up(model)
+        except Exception as e:
+            self.set_phase(key, 'failed', error=str(e))
+            raise
+        on_phase('ready')
+        return model
+
+    def preload_model(self, key: PoolKey) -> Optional[HookedTransformer]:
+        try:
+            # A preload shouldn't push out the model that's in use (the most recently used)
+            with self.lock:
+                in_use = next(reversed(self.models), None)
+                in_use_bytes = model_nbytes(self.models[in_use]) if in_use is not None else 0
+            if in_use is not None:
+                try:
+                    estimate = self.estimate(*key)
+                except Exception:
+                    estimate = 0 # Unknown, checked once it's loaded instead
+                if in_use_bytes + estimate > self.max_bytes:
+                    self.skip(key, in_use, in_use_bytes + estimate)
+                    return None
+
+            model = self.load_tracked(key)
+            with self.lock:
+                # In as least recent, and dropped again if the estimate was off and the budget can't hold both
+                self.models[key] = model
+                self.models.move_to_end(key, last=False)
+            self.evict(keep={key, in_use})
+            with self.lock:
+                nbytes = self.nbytes
+                if nbytes > self.max_bytes:
+                    self.models.pop(key, None)
+            if nbytes > self.max_bytes:
+                self.skip(key, in_use, nbytes)
+            return model
+        finally:
+            with self.lock:
+                self.loading.pop(key, None)
+
+    def skip(self, key: PoolKey, in_use: Optional[PoolKey], nbytes: int):
+        beside = f" beside {in_use[0]} ({in_use[1]})" if in_use is not None else ''
+        self.set_phase(key, 'skipped', error=(
+            f"Preload skipped, needs about {nbytes / 1024**3:.2f}GiB{beside} "
+            f"over the pool's {self.max_bytes / 1024**3:.2f}GiB"
+        ))
+
+    def add(self, key: PoolKey, model: HookedTransformer) -> HookedTransformer:
+        with self.lock:
+            self.models[key] = model
+            self.models.move_to_end(key)
+        self.evict(keep={key})
+        return model
+
+    def evict(self, keep: set[Optional[PoolKey]]):
+        """Drops least recently used models until the pool fits its budget, never dropping those in `keep`"""
+        evicted = False
+        with self.lock:
+            total = self.nbytes
+            for key in list(self.models):
+                if total <= self.max_bytes:
+                    break
+                if key in keep:
+                    continue
+                total -= model_nbytes(self.models.pop(key))
+                self.load_status.pop(key, None)
+                evicted = True
+
+        if evicted:
+            gc.collect()
+            if t.cuda.is_available():
+                t.cuda.empty_cache()
+
+    def load_progress(self, key: PoolKey):
+        """Phase and rough progress of the latest load of a model, None if it was never loaded"""
+        status = self.load_status.get(key)
+        if status is None:
+            return None
+        # A finished load's time is the time it took
+        done = status["phase"] in FINISHED_PHASES
+        now = status["phaseStarted"] if done else time.monotonic()
+        return {
+            "modelName": key[0],
+            "precision": key[1],
+            "phase": status["phase"],
+            "progress": PHASE_PROGRESS[status["phase"]],
+            "elapsed": now - status["started"],
+            "phaseElapsed": 0.0 if done else now - status["phaseStarted"],
+            "error": status["error"],
+        }
+
+    def status(self):
+        with self.lock:
+            return {
+                "resident": [
+                    {"modelName": model_name, "precision": precision, "bytes": model_nbytes(model)}
+                    for (model_name, precision), model in self.models.items()
+                ],
+                "loading": [{"modelName": model_name, "precision": precision} for model_name, precision in self.loading],
+                "bytes": self.nbytes,
+                "maxBytes": self.max_bytes,
+            }
@@ -0,0 +1,43 @@
+from transformer_lens import HookedTransformer
+from torch.nn.utils import parametrize
+import torch as t
+
+
+class Int8Weight(t.nn.Module):
+    """
+    Parametrization storing a weight as int8 with an absmax scale per output channel, the weight
+    is dequantized to the scale's dtype whenever it's used
+
+    `reduce_dim` is the dimension the scale is shared over, the input dimension of matmul weights
+    and the d_model dimension of embeddings (so every token gets its own scale).
+    """
+
+    def __init__(self, reduce_dim: int):
+        super().__init__()
+        self.reduce_dim = reduce_dim
+
+    def forward(self, quantized: t.Tensor, scale: t.Tensor) -> t.Tensor:
+        return quantized.to(scale.dtype) * scale
+
+    def right_inverse(self, weight: t.Tensor) -> tuple[t.Tensor, t.Tensor]:
+        scale = weight.abs().amax(dim=self.reduce_dim, keepdim=True).clamp(min=1e-12) / 127
+        return (weight / scale).round().clamp(-127, 127).to(t.int8), scale
+
+
+def quantize_int8(model: HookedTransformer) -> HookedTransformer:
+    """
+    Weight only int8 quantization of a model's W_* matrices, cutting their memory by 4x
+
+    TransformerLens multiplies its weights with einsums rather than `nn.Linear`, so torch's dynamic
+    quantization doesn't apply. Instead weights are stored as int8 and dequantized as they're read,
+    compute stays in the model's dtype.
+    """
+    for module in list(model.modules()):
+        for name, param in list(module.named_parameters(recurse=False)):
+            if not name.startswith('W_') or param.dim() < 2:
+                continue
+            # int8 tensors can't require grad, so neither can the quantized weight
+            param.requires_grad_(False)
+            reduce_dim = -1 if name in ('W_E', 'W_pos') else -2
+            parametrize.register_parametrization(module, name, Int8Weight(reduce_dim), unsafe=True)
+    return model
@@ -0,0 +1,84 @@
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Any, Optional
+import torch as t
+
+
+def fingerprint(model_name: str, tokens: t.Tensor, *state: Any) -> str:
+    """
+    Canonical hash of everything that determines the result of a forward pass: the model, the
+    token ids and any other state such as the precision and the intervention (ablation/patch)
+    state. Dict ordering doesn't change the hash.
+    """
+    canonical = json.dumps(
+        {"model": model_name, "tokens": tokens.tolist(), "state": state},
+        sort_keys=True,
+        separators=(',', ':'),
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class CachedRun:
+    def __init__(self, run_id: str):
+        self.run_id = run_id # The run's activations are held by the activation store
+        self.responses: dict[str, bytes] = {} # Encoded responses keyed by the options that produced them
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(response) for response in self.responses.values())
+
+
+class RunResultCache:
+    """
+    LRU index from `fingerprint` to the run that produced it, under a memory budget
+
+    Entries also hold any responses already encoded from the run, so a repeated request can be
+    answered without touching the model. The run itself is looked up in the activation store, an
+    entry whose run has been evicted from there is stale and is dropped with `drop_run`, so the
+    index holds no more entries than the store holds runs.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, CachedRun] = OrderedDict()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(entry.nbytes for entry in self.entries.values())
+
+    def get(self, key: str) -> Optional[CachedRun]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, run_id: str) -> CachedRun:
+        entry = CachedRun(run_id)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        return entry
+
+    def pop(self, key: str):
+        self.entries.pop(key, None)
+
+    def drop_run(self, run_id: str):
+        """Drops the entries of a run, for when it leaves the activation store"""
+        for key in [key for key, entry in self.entries.items() if entry.run_id == run_id]:
+            del self.entries[key]
+
+    def add_response(self, key: str, options_key: str, response: bytes):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry.responses[options_key] = response
+            self.evict()
+
+    def evict(self):
+        """Drops least recently used entries until the cache fits its budget"""
+        total = self.nbytes
+        while total > self.max_bytes and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            total -= entry.nbytes
+
+    def clear(self):
+        self.entries.clear()
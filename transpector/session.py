@@ -0,0 +1,162 @@
+import json
+import os
+import re
+import shutil
+from importlib.metadata import version
+from pathlib import Path
+from typing import Any, Optional, TypedDict
+from safetensors.torch import load_file, save_file
+from transpector.activation_store import Cache, RunId, RunRecord
+from transpector.interventions import AblationsType, PatchesType
+from transpector.model import CacheDType, Precision
+from transpector.weight_cache import cache_dir
+import torch as t
+
+SESSION_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+RUNS_DIR = 'runs'
+
+# Keys of a run's tensors in its safetensors file, activations are under their hook names
+CACHE_PREFIX = 'cache/'
+RUN_TENSORS = ('tokens', 'attentionMask', 'logits', 'loss')
+
+SESSION_NAME = re.compile(r'^[\w.-]+$')
+
+
+class SessionRun(TypedDict):
+    runId: RunId
+    key: str
+    modelName: str
+    precision: Precision
+    prompt: list[str]
+    ablations: AblationsType
+    patches: PatchesType
+    captured: Optional[list[str]] # Hook name patterns the run covers once loaded, see `covers`
+    referenceRunId: Optional[RunId]
+    file: str # Relative to the session directory
+    hooks: list[str] # Hook points saved
+
+
+class SessionManifest(TypedDict):
+    version: int
+    transformerLens: str
+    modelName: str
+    precision: Precision
+    cacheDType: Optional[CacheDType]
+    lastPrompt: list[str]
+    ablations: AblationsType
+    patches: PatchesType
+    logicalClock: int
+    referenceRunId: Optional[RunId]
+    runs: list[SessionRun]
+
+
+def sessions_dir() -> Path:
+    """Where sessions are saved, set with TRANSPECTOR_SESSION_DIR"""
+    sessions = os.environ.get('TRANSPECTOR_SESSION_DIR')
+    return Path(sessions).expanduser() if sessions else cache_dir() / 'sessions'
+
+
+def session_path(name: str) -> Path:
+    if not SESSION_NAME.match(name) or name.startswith('.'):
+        raise ValueError(f"Invalid session name: {name}")
+    return sessions_dir() / name
+
+
+def save_session(
+        path: Path,
+        state: dict[str, Any],
+        records: list[RunRecord],
+        hooks: dict[RunId, list[str]],
+        captured: dict[RunId, Optional[list[str]]],
+):
+    """
+    Writes a session: a JSON manifest of the session `state` (see `SessionManifest`) and the runs,
+    and one safetensors file per run holding its tokens, logits, loss and the activations of the
+    hook points in `hooks`, which `captured` describes as patterns. Activations keep the dtype
+    they were cached in, so loaded runs give the same results (see `Modelling.cache_dtype` for
+    caching them smaller). Written atomically, so a session is never read half written.
+
+    safetensors files are memory mapped when loaded, so a loaded session's activations are only
+    read from disk as they're used.
+    """
+    tmp = path.with_name(path.name + '.tmp')
+    shutil.rmtree(tmp, ignore_errors=True)
+    (tmp / RUNS_DIR).mkdir(parents=True)
+
+    runs: list[SessionRun] = []
+    for record in records:
+        run_hooks = hooks[record["runId"]]
+        # Activations can share storage, which safetensors doesn't allow, so each gets its own copy
+        tensors = {
+            **{name: record[name].detach().cpu().clone() for name in RUN_TENSORS}, # type: ignore
+            **{
+                CACHE_PREFIX + name: record["cache"][name].detach().cpu().clone(memory_format=t.contiguous_format)
+                for name in run_hooks
+            },
+        }
+        file = f"{RUNS_DIR}/{record['runId']}.safetensors"
+        save_file(tensors, tmp / file)
+        runs.append({
+            "runId": record["runId"],
+            "key": record["key"],
+            "modelName": record["modelName"],
+            "precision": record["precision"],
+            "prompt": record["prompt"],
+            "ablations": record["ablations"],
+            "patches": record["patches"],
+            "captured": captured[record["runId"]],
+            "referenceRunId": record["referenceRunId"],
+            "file": file,
+            "hooks": run_hooks,
+        })
+
+    manifest = {
+        "version": SESSION_VERSION, "transformerLens": version('transformer_lens'), **state, "runs": runs,
+    }
+    (tmp / MANIFEST_FILE).write_text(json.dumps(manifest))
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+
+
+def read_manifest(path: Path) -> SessionManifest:
+    manifest: SessionManifest = json.loads((path / MANIFEST_FILE).read_text())
+    if manifest["version"] != SESSION_VERSION:
+        raise ValueError(f"Unsupported session version: {manifest['version']}")
+    return manifest
+
+
+def load_session_run(path: Path, run: SessionRun, device: t.device | str) -> RunRecord:
+    """
+    A saved run with its activations memory mapped from the session file. The small run tensors
+    are moved to the model's device, activations stay mapped until read.
+    """
+    tensors = load_file(path / run["file"])
+    cache: Cache = {name.removeprefix(CACHE_PREFIX): value for name, value in tensors.items() if name.startswith(CACHE_PREFIX)}
+    return {
+        "runId": run["runId"],
+        "key": run["key"],
+        "modelName": run["modelName"],
+        "precision": run["precision"],
+        "prompt": run["prompt"],
+        "tokens": tensors["tokens"].to(device),
+        "attentionMask": tensors["attentionMask"].to(device),
+        "logits": tensors["logits"].to(device),
+        "loss": tensors["loss"].to(device),
+        "cache": cache,
+        "ablations": run["ablations"],
+        "patches": run["patches"],
+        "captured": run["captured"],
+        "referenceRunId": run.get("referenceRunId"),
+    }
+
+
+def session_summary(name: str, manifest: SessionManifest) -> dict[str, Any]:
+    return {
+        "name": name,
+        "modelName": manifest["modelName"],
+        "precision": manifest["precision"],
+        "lastPrompt": manifest["lastPrompt"],
+        "runs": [{"runId": run["runId"], "prompt": run["prompt"], "hooks": len(run["hooks"])} for run in manifest["runs"]],
+        "transformerLens": manifest["transformerLens"],
+    }
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import shutil
+from importlib.metadata import version
+from pathlib import Path
+from typing import Any, Callable, Optional
+from safetensors.torch import load_file, save_file
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+from transformer_lens.utils import get_device
+from transformers import AutoTokenizer
+import torch as t
+
+# Options passed to `HookedTransformer.from_pretrained`, they change the processed weights so
+# they're part of the cache key
+ProcessingOptions = dict[str, Any]
+
+default_processing: ProcessingOptions = {
+    "fold_ln": True,
+    "center_writing_weights": True,
+    "center_unembed": True,
+    "fold_value_biases": True,
+    "refactor_factored_attn_matrices": False,
+    "dtype": "float32",
+}
+
+WEIGHTS_FILE = 'model.safetensors'
+CONFIG_FILE = 'config.json'
+TOKENIZER_DIR = 'tokenizer'
+
+
+def cache_dir() -> Path:
+    """Root of Transpector's on disk caches, set with TRANSPECTOR_CACHE_DIR"""
+    return Path(os.environ.get('TRANSPECTOR_CACHE_DIR', '~/.cache/transpector')).expanduser()
+
+
+def weights_dir(model_name: str, options: ProcessingOptions) -> Path:
+    """
+    Directory of a model's processed weights, keyed by the model, the processing options and the
+    transformer_lens version (which decides how checkpoints are converted)
+    """
+    key = json.dumps(
+        {"model": model_name, "options": options, "transformer_lens": version('transformer_lens')},
+        sort_keys=True,
+    )
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+    return cache_dir() / 'weights' / f"{model_name.replace('/', '--')}-{digest}"
+
+
+def config_to_json(cfg: HookedTransformerConfig) -> dict[str, Any]:
+    config = dict(cfg.to_dict())
+    config["dtype"] = str(cfg.dtype).removeprefix('torch.')
+    config.pop("device", None) # Chosen when loading, the cache may be shared between machines
+    return config
+
+
+def config_from_json(config: dict[str, Any]) -> HookedTransformerConfig:
+    return HookedTransformerConfig.from_dict({**config, "dtype": getattr(t, config["dtype"]), "device": get_device()})
+
+
+def save_weights(model: HookedTransformer, path: Path):
+    """Writes a model's processed state dict, config and tokenizer, atomically so a partial write is never loaded"""
+    tmp = path.with_name(path.name + '.tmp')
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+
+    # safetensors refuses tensors that share memory, so every tensor gets its own contiguous copy
+    state_dict = {name: tensor.detach().cpu().contiguous().clone() for name, tensor in model.state_dict().items()}
+    save_file(state_dict, tmp / WEIGHTS_FILE)
+    (tmp / CONFIG_FILE).write_text(json.dumps(config_to_json(model.cfg)))
+    if model.tokenizer is not None:
+        model.tokenizer.save_pretrained(tmp / TOKENIZER_DIR)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+
+
+def load_weights(path: Path) -> HookedTransformer:
+    """
+    Builds a model from cached weights without converting a checkpoint: the model is created on
+    the meta device and the memory mapped tensors are assigned to it in place of fresh parameters
+    """
+    cfg = config_from_json(json.loads((path / CONFIG_FILE).read_text()))
+    tokenizer = AutoTokenizer.from_pretrained(path / TOKENIZER_DIR) if (path / TOKENIZER_DIR).exists() else None
+
+    with t.device('meta'):
+        model = HookedTransformer(cfg, tokenizer=tokenizer, move_to_device=False)
+    model.load_state_dict(load_file(path / WEIGHTS_FILE), strict=True, assign=True)
+
+    meta = [name for name, tensor in [*model.named_parameters(), *model.named_buffers()] if tensor.is_meta]
+    if meta:
+        raise ValueError(f"Cached weights are missing tensors: {meta}")
+
+    return model.to(cfg.device)
+
+
+def load_cached_model(
+        model_name: str,
+        options: Optional[ProcessingOptions] = None,
+        on_phase: Optional[Callable[[str], None]] = None,
+) -> HookedTransformer:
+    """
+    Loads a model from the weight cache, converting it with `HookedTransformer.from_pretrained` and
+    caching the result on a miss. Works offline once a model is cached.
+
+    `on_phase` is called as loading moves between 'loadingCached', 'loadingPretrained' and
+    'savingCache'.
+    """
+    report = on_phase or (lambda phase: None)
+    options = {**default_processing, **(options or {})}
+    path = weights_dir(model_name, options)
+
+    if (path / WEIGHTS_FILE).exists():
+        report('loadingCached')
+        try:
+            return load_weights(path)
+        except Exception as e:
+            print(f'Ignoring unreadable weight cache for {model_name}: {e}')
+
+    report('loadingPretrained')
+    model = HookedTransformer.from_pretrained(model_name, **options)
+    report('savingCache')
+    try:
+        save_weights(model, path)
+    except OSError as e:
+        print(f'Could not cache weights for {model_name}: {e}')
+    return model
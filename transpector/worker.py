@@ -0,0 +1,120 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from typing import Any, AsyncIterator, Callable, Optional
+from fastapi import Request
+
+
+class Superseded(Exception):
+    """Raised for a queued job dropped because the same client queued a newer one"""
+
+
+class Job:
+    def __init__(self, fn: Callable[[], Any], future: asyncio.Future, supersede_key: Optional[tuple[str, str]]):
+        self.fn = fn
+        self.future = future
+        self.supersede_key = supersede_key
+
+
+def client_id(request: Request) -> str:
+    """Identifies the client a request came from, clients can name themselves with X-Client-Id"""
+    return request.headers.get('x-client-id') or (request.client.host if request.client else 'unknown')
+
+
+class ModelWorker:
+    """
+    Runs every job that touches the model one at a time on a dedicated thread, fed by an asyncio
+    queue so endpoints can await their results without blocking the event loop
+
+    Jobs queued with a supersede key replace any job with the same key still waiting in the queue,
+    the older job's caller gets `Superseded` and the job never runs.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='transpector-model')
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.queue: Optional[asyncio.Queue[Job]] = None
+        self.task: Optional[asyncio.Task] = None
+        self.waiting: dict[tuple[str, str], Job] = {}
+
+    def ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop or self.task is None or self.task.done():
+            self.loop = loop
+            self.queue = asyncio.Queue()
+            self.waiting = {}
+            self.task = loop.create_task(self.run())
+
+    async def submit(self, fn: Callable[..., Any], *args: Any, supersede_key: Optional[tuple[str, str]] = None, **kwargs: Any):
+        self.ensure_started()
+        assert self.loop is not None and self.queue is not None
+
+        job = Job(partial(fn, *args, **kwargs), self.loop.create_future(), supersede_key)
+        if supersede_key is not None:
+            older = self.waiting.get(supersede_key)
+            if older is not None and not older.future.done():
+                older.future.set_exception(Superseded(f"Superseded by a newer {supersede_key[1]} request"))
+            self.waiting[supersede_key] = job
+
+        await self.queue.put(job)
+        return await job.future
+
+    async def run(self):
+        assert self.loop is not None and self.queue is not None
+        while True:
+            job = await self.queue.get()
+            if job.supersede_key is not None and self.waiting.get(job.supersede_key) is job:
+                del self.waiting[job.supersede_key]
+
+            # Superseded, or the caller stopped waiting
+            if job.future.done():
+                continue
+
+            try:
+                result = await self.loop.run_in_executor(self.executor, job.fn)
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+
+    async def stream(self, fn: Callable[..., Any], *args: Any, supersede_key: Optional[tuple[str, str]] = None, **kwargs: Any) -> AsyncIterator[Any]:
+        """
+        Runs `fn(emit, *args, **kwargs)` on the worker, yielding everything it passes to `emit` as
+        soon as it's emitted and then its return value. `emit` is called from the worker thread, so
+        items are handed to the event loop with `call_soon_threadsafe`. If the consumer stops early
+        the job is cancelled, and dropped if it hasn't started yet.
+        """
+        loop = asyncio.get_running_loop()
+        items: asyncio.Queue[Any] = asyncio.Queue()
+        finished = object()
+
+        def emit(item: Any):
+            loop.call_soon_threadsafe(items.put_nowait, item)
+
+        job = asyncio.ensure_future(self.submit(fn, emit, *args, supersede_key=supersede_key, **kwargs))
+        # Emitted items are queued on the loop before the job's result, so this always comes last
+        job.add_done_callback(lambda _: items.put_nowait(finished))
+        try:
+            while (item := await items.get()) is not finished:
+                yield item
+            yield job.result()
+        finally:
+            job.cancel()
+
+    def endpoint(self, supersede: Optional[str] = None):
+        """
+        Turns a sync endpoint into an async one that runs on the worker. With `supersede`, a newer
+        call from the same client drops this one if it is still queued, the endpoint must then take
+        a `request: Request` argument to identify the client.
+        """
+        def decorator(fn: Callable[..., Any]):
+            @wraps(fn)
+            async def wrapper(*args: Any, **kwargs: Any):
+                supersede_key = None
+                if supersede is not None:
+                    supersede_key = (client_id(kwargs['request']), supersede)
+                return await self.submit(fn, *args, supersede_key=supersede_key, **kwargs)
+            return wrapper
+        return decorator